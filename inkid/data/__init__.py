@@ -1,13 +1,29 @@
 from .dataset import Dataset
 from .dataset import DataSource
+from .dataset import FeatureMetadata
 from .dataset import RegionPointSampler
 from .dataset import RegionSource
 from .dataset import SubvolumeGeneratorInfo
 from .dataset import VolumeSource
+from .dataset import add_cache_arguments
+from .dataset import add_ppm_arguments
+from .dataset import add_volume_arguments
 from .dataset import add_subvolume_arguments
+from .dataset import augment_features
+from .dataset import collate_features
 from .dataset import flatten_data_sources_list
+from .dataset import ppm_args_from_storage
+from .dataset import worker_init_fn
+
+from .cache import get_cache_dir
+from .cache import set_cache_dir
 
 from .ppm import PPM
 
+from .shards import ShardDataset
+from .shards import ShardWriter
+
 from .volume import Volume
 from .volume import get_component_vectors_from_normal
+from .volume import get_sampling_threads
+from .volume import set_sampling_threads
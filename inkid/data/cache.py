@@ -0,0 +1,225 @@
+"""On-disk cache of arrays decoded from data source files.
+
+Arrays derived from a file, e.g. the planes of a compact PPM or a
+decoded label image, are saved as .npy files. Each is keyed by the
+source file's absolute path, modification time and size, so editing the
+source invalidates its entries. When the source is opened again the
+cached arrays are memory mapped instead of being rebuilt.
+
+The cache is off unless a directory is given, by $INKID_CACHE_DIR or
+set_cache_dir(). Entries are never evicted, so the directory is left for
+the user to manage.
+
+Subvolumes sampled at a data source's points can also be kept here, see
+SubvolumeCache.
+
+"""
+
+import fcntl
+import hashlib
+import logging
+import os
+import tempfile
+from typing import Callable, Dict, List, Optional
+from urllib.parse import urlsplit
+
+import numpy as np
+
+# Bump to invalidate existing cache entries when the cached contents change
+CACHE_FORMAT_VERSION = 1
+
+_cache_dir: Optional[str] = os.environ.get("INKID_CACHE_DIR") or None
+
+
+def set_cache_dir(directory: Optional[str]) -> None:
+    """Set the directory cached arrays are kept in, or None to disable caching.
+
+    Defaults to $INKID_CACHE_DIR, and caching is disabled if that is not
+    set.
+
+    """
+    global _cache_dir
+    _cache_dir = directory
+
+
+def get_cache_dir() -> Optional[str]:
+    return _cache_dir or None
+
+
+def _cache_paths(source_path: str, name: str, keys: List[str]) -> Dict[str, str]:
+    stat = os.stat(source_path)
+    key = hashlib.sha1(
+        "\0".join(
+            [
+                str(CACHE_FORMAT_VERSION),
+                os.path.abspath(source_path),
+                str(stat.st_mtime_ns),
+                str(stat.st_size),
+                name,
+            ]
+        ).encode("utf-8")
+    ).hexdigest()
+    stem = os.path.splitext(os.path.basename(source_path))[0]
+    return {
+        k: os.path.join(get_cache_dir(), f"{stem}-{name}-{key[:16]}-{k}.npy")
+        for k in keys
+    }
+
+
+def cached_arrays(
+    source_path: str,
+    name: str,
+    keys: List[str],
+    build: Callable[[], Dict[str, np.ndarray]],
+) -> Dict[str, np.ndarray]:
+    """Return the arrays named by keys derived from source_path, building them if not cached.
+
+    Cached arrays are memory mapped copy-on-write, so they can be
+    modified like in-memory arrays without changing the cache. If the
+    cache is disabled or source_path is a URL, build() is just called.
+
+    Args:
+        source_path: The file the arrays are derived from.
+        name: Distinguishes different arrays derived from the same file.
+        keys: The names of the arrays returned by build().
+        build: Function returning a dict of the arrays.
+
+    """
+    if get_cache_dir() is None or urlsplit(source_path).scheme != "":
+        return build()
+    paths = _cache_paths(source_path, name, keys)
+    try:
+        return {k: np.load(path, mmap_mode="c") for k, path in paths.items()}
+    except (OSError, ValueError):
+        pass
+
+    arrays = build()
+    try:
+        os.makedirs(get_cache_dir(), exist_ok=True)
+        for k, path in paths.items():
+            # Write to a temporary file first so a partial file is never loaded
+            fd, tmp_path = tempfile.mkstemp(dir=get_cache_dir(), suffix=".npy.tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    np.save(f, np.ascontiguousarray(arrays[k]))
+                os.replace(tmp_path, path)
+            except BaseException:
+                # Entries are never evicted, so nothing else would remove it
+                os.remove(tmp_path)
+                raise
+    except OSError as e:
+        logging.warning(f"Could not cache arrays for {source_path}: {e}")
+    return arrays
+
+
+def cached_array(
+    source_path: str, name: str, build: Callable[[], np.ndarray]
+) -> np.ndarray:
+    """Return the single array derived from source_path, as for cached_arrays()."""
+    return cached_arrays(source_path, name, [name], lambda: {name: build()})[name]
+
+
+class SubvolumeCache:
+    """Memory-mapped store of the subvolumes sampled at a fixed list of points.
+
+    Each point has one record in a .npy file holding its subvolume and
+    whether it has been filled, so the first pass over the points samples
+    the volume and later passes are reads from the file. Only worth using
+    where sampling is deterministic, i.e. without jitter or augmentation.
+
+    The file is opened lazily, so a cache can be handed to DataLoader
+    workers, which then fill disjoint records of the same file. Opening
+    holds a lock on a .lock file next to it, so only the first process
+    creates the file and the others map that same file.
+
+    """
+
+    def __init__(self, path: str, num: int, shape: tuple, dtype) -> None:
+        self.path = path
+        self.dtype = np.dtype(
+            [("filled", np.bool_), ("subvolume", np.dtype(dtype), tuple(shape))]
+        )
+        self.num = num
+        self._records: Optional[np.ndarray] = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_records"] = None
+        return state
+
+    def _open(self) -> np.ndarray:
+        if self._records is None:
+            directory = os.path.dirname(self.path)
+            os.makedirs(directory, exist_ok=True)
+            # Without the lock a process could map the file just before another
+            # replaces it, and fill records that are never read again
+            with open(self.path + ".lock", "w") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    self._records = self._load()
+                except (OSError, ValueError):
+                    # Create the file under a temporary name so a partial file is never loaded
+                    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".npy.tmp")
+                    os.close(fd)
+                    try:
+                        np.lib.format.open_memmap(
+                            tmp_path, mode="w+", dtype=self.dtype, shape=(self.num,)
+                        ).flush()
+                        os.replace(tmp_path, self.path)
+                    except BaseException:
+                        os.remove(tmp_path)
+                        raise
+                    self._records = self._load()
+        return self._records
+
+    def _load(self) -> np.ndarray:
+        records = np.load(self.path, mmap_mode="r+")
+        if records.dtype != self.dtype or records.shape != (self.num,):
+            raise ValueError(f"{self.path} does not match the cache")
+        return records
+
+    def get(
+        self, items: np.ndarray, sample: Callable[[np.ndarray], np.ndarray]
+    ) -> np.ndarray:
+        """Return the subvolumes of the given items, sampling any not yet cached.
+
+        Args:
+            items: Indices of the points to get the subvolumes of.
+            sample: Function taking the positions in items of those not
+                yet cached and returning their subvolumes.
+
+        """
+        records = self._open()
+        items = np.asarray(items, dtype=np.intp)
+        subvolumes = records["subvolume"][items]
+        missing = ~records["filled"][items]
+        if missing.any():
+            sampled = sample(np.flatnonzero(missing))
+            subvolumes[missing] = sampled
+            # Write the subvolumes before marking them filled, for readers in other workers
+            records["subvolume"][items[missing]] = sampled
+            records["filled"][items[missing]] = True
+        return subvolumes
+
+
+def subvolume_cache(
+    name: str, keys: List[str], num: int, shape: tuple, dtype
+) -> Optional[SubvolumeCache]:
+    """Return the SubvolumeCache identified by name and keys, or None if caching is disabled.
+
+    Args:
+        name: Readable part of the file name, e.g. the data source name.
+        keys: Everything that determines the subvolumes, e.g. the source
+            file, the points and the subvolume arguments.
+        num: The number of points.
+        shape: The shape of one subvolume.
+        dtype: The dtype of the subvolumes.
+
+    """
+    if get_cache_dir() is None:
+        return None
+    key = hashlib.sha1(
+        "\0".join([str(CACHE_FORMAT_VERSION), *keys]).encode("utf-8")
+    ).hexdigest()
+    path = os.path.join(get_cache_dir(), f"{name}-subvolumes-{key[:16]}.npy")
+    return SubvolumeCache(path, num, shape, dtype)
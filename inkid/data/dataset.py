@@ -2,19 +2,21 @@
 from __future__ import annotations
 
 from abc import ABC, abstractmethod
-from collections import namedtuple
+import bisect
 from dataclasses import dataclass
+import functools
+import hashlib
+import itertools
 import json
 import math
 import os
 import random
-from typing import Dict, List, Optional, Tuple
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple, Union
 
 import jsonschema
 import numpy as np
 from PIL import Image, ImageFilter
 import torch
-import torchvision.transforms as transforms
 import wandb
 
 import inkid
@@ -46,7 +48,7 @@ class SubvolumeGeneratorInfo:
     jitter_max: int = 4
     augment_subvolume: bool = True
 
-    method_choices = ["nearest_neighbor", "interpolated"]
+    method_choices = ["nearest_neighbor", "interpolated", "grid_sample"]
 
 
 # How subvolumes are retrieved
@@ -99,17 +101,203 @@ def add_subvolume_arguments(parser):
     )
 
 
+# How volumes are stored
+def add_volume_arguments(parser):
+    parser.add_argument(
+        "--volume-storage",
+        default="memory",
+        choices=inkid.data.Volume.storage_choices,
+        help="how to hold volume data: fully in memory, in shared memory that DataLoader workers "
+        "attach to, in a chunked cache file memory-mapped from next to the volume (built on first "
+        "use), or lazily decoding slices on demand",
+    )
+    parser.add_argument(
+        "--volume-slice-cache-gb",
+        metavar="GB",
+        type=float,
+        default=4,
+        help="maximum size of the decoded slice cache of each lazy volume",
+    )
+    parser.add_argument(
+        "--volume-load-workers",
+        metavar="n",
+        type=int,
+        default=None,
+        help="number of threads decoding volume slices (default: based on the number of CPUs)",
+    )
+    parser.add_argument(
+        "--volume-sampling-threads",
+        metavar="n",
+        type=int,
+        default=None,
+        help="number of threads sampling subvolumes in each process (default: number of CPUs, "
+        "divided between the DataLoader workers)",
+    )
+
+
+# How PPMs are stored
+def add_ppm_arguments(parser):
+    parser.add_argument(
+        "--ppm-storage",
+        default="full",
+        choices=["full", "compact", "quantized"],
+        help="how to hold PPM data: as the float64 file contents, as float32 points and "
+        "normals, or as float32 points and int16 normals",
+    )
+
+
+def add_cache_arguments(parser):
+    parser.add_argument(
+        "--data-cache-dir",
+        metavar="path",
+        default=None,
+        help="directory caching decoded label images and compact PPMs, or an empty string "
+        "to disable the cache (default: $INKID_CACHE_DIR, else no cache)",
+    )
+    parser.add_argument(
+        "--cache-features",
+        action="store_true",
+        help="keep the validation and prediction subvolumes in the data cache directory "
+        "after they are first sampled, so later evaluations read them from disk",
+    )
+
+
+def ppm_args_from_storage(storage: str) -> dict:
+    """Map a --ppm-storage choice to keyword arguments for PPM.from_path()."""
+    return dict(compact=storage != "full", quantize_normals=storage == "quantized")
+
+
+def augment_features(
+    features: torch.Tensor, generator: Optional[torch.Generator] = None
+) -> torch.Tensor:
+    """Randomly flip each subvolume of a [B, C, D, H, W] batch, in place.
+
+    Each subvolume is flipped along W and, independently, along H with
+    probability 0.5, as RandomHorizontalFlip() and RandomVerticalFlip()
+    would per sample. Runs on whatever device the batch is on.
+
+    """
+    for dim in (-1, -2):
+        flip = torch.rand(features.shape[0], generator=generator) < 0.5
+        flip = flip.nonzero().squeeze(1).to(features.device)
+        features[flip] = features[flip].flip(dim)
+    return features
+
+
 # Tuple (not dataclass) I believe because needs to be passed through PyTorch and needs to be basic structure
-FeatureMetadata = namedtuple(
-    "FeatureMetadata",
-    ("path", "surface_x", "surface_y", "x", "y", "z", "n_x", "n_y", "n_z"),
-    defaults=None,
-)
+class FeatureMetadata(NamedTuple):
+    """Where a feature came from.
+
+    source_index is the index of the feature's source in Dataset.sources
+    (-1 if the source was used on its own). coordinates holds surface_x,
+    surface_y, x, y, z, n_x, n_y and n_z as float32. collate_features()
+    stacks a batch of these into an [N] tensor and an [N, 8] tensor,
+    which the properties index the same way.
+
+    """
+
+    source_index: Union[int, torch.Tensor]
+    coordinates: Union[np.ndarray, torch.Tensor]
+
+    COORDINATES = ("surface_x", "surface_y", "x", "y", "z", "n_x", "n_y", "n_z")
+
+    @staticmethod
+    def from_coordinates(*coordinates, source_index: int = -1) -> FeatureMetadata:
+        return FeatureMetadata(source_index, np.array(coordinates, dtype=np.float32))
+
+    surface_x = property(lambda self: self.coordinates[..., 0])
+    surface_y = property(lambda self: self.coordinates[..., 1])
+    x = property(lambda self: self.coordinates[..., 2])
+    y = property(lambda self: self.coordinates[..., 3])
+    z = property(lambda self: self.coordinates[..., 4])
+    n_x = property(lambda self: self.coordinates[..., 5])
+    n_y = property(lambda self: self.coordinates[..., 6])
+    n_z = property(lambda self: self.coordinates[..., 7])
+
+
+def uint16_to_value_range(values: np.ndarray, value_range: Tuple[float, float]):
+    """Map uint16 subvolume values onto value_range as Volume.get_subvolumes() does."""
+    low, high = value_range
+    scale = np.float32(1.0 / np.iinfo(np.uint16).max)
+    mean = np.float32(-low / (high - low))
+    std = np.float32(1.0 / (high - low))
+    return (values.astype(np.float32) * scale - mean) / std
+
+
+def value_range_to_uint16(values: np.ndarray, value_range: Tuple[float, float]):
+    """Map subvolume values in value_range back onto uint16, the inverse of uint16_to_value_range()."""
+    low, high = value_range
+    values = (np.asarray(values, dtype=np.float32) - low) / (high - low)
+    values = np.rint(values * np.iinfo(np.uint16).max)
+    return np.clip(values, 0, np.iinfo(np.uint16).max).astype(np.uint16)
+
+
+def subvolume_args(feature_args: dict) -> dict:
+    """Select the feature args that Volume.get_subvolumes() takes.
+
+    Volume.get_subvolume() also accepts (and ignores) e.g. normalize and
+    augment_subvolume. A device, used by the grid_sample method, is
+    passed on as well.
+
+    """
+    names = (
+        "shape_voxels",
+        "shape_microns",
+        "move_along_normal",
+        "jitter_max",
+        "method",
+        "device",
+    )
+    return {name: feature_args[name] for name in names if name in feature_args}
+
+
+def collate_features(items: List[dict]) -> dict:
+    """Collate dataset items into a batch, for DataLoader(collate_fn=...).
+
+    Stacks the metadata of the whole batch into two tensors instead of
+    collating it field by field.
+
+    """
+    batch = torch.utils.data.default_collate(
+        [{k: v for k, v in item.items() if k != "feature_metadata"} for item in items]
+    )
+    batch["feature_metadata"] = FeatureMetadata(
+        torch.tensor([item["feature_metadata"].source_index for item in items]),
+        torch.from_numpy(
+            np.stack([item["feature_metadata"].coordinates for item in items])
+        ),
+    )
+    return batch
+
+
+def worker_init_fn(
+    cache_dir: Optional[str], sampling_threads: Optional[int]
+) -> Callable[[int], None]:
+    """Return a DataLoader(worker_init_fn=...) applying these inkid.data settings in each worker.
+
+    Workers started with the spawn context import inkid afresh, so
+    set_cache_dir() and set_sampling_threads() calls made in the main
+    process do not reach them.
+
+    """
+    return functools.partial(
+        _init_worker, cache_dir=cache_dir, sampling_threads=sampling_threads
+    )
+
+
+def _init_worker(
+    worker_id: int, cache_dir: Optional[str], sampling_threads: Optional[int]
+) -> None:
+    inkid.data.set_cache_dir(cache_dir)
+    inkid.data.set_sampling_threads(sampling_threads)
 
 
 class DataSource(ABC):
     """Can be either a region or a volume. Produces inputs (e.g. subvolumes) and possibly labels."""
 
+    # Bumped whenever the length of any source may have changed, see Dataset.update_index()
+    length_generation: int = 0
+
     def __init__(self, path: str) -> None:
         self.path = path
         source_file_contents, relative_url = inkid.util.get_raw_data_from_file_or_url(
@@ -145,8 +333,22 @@ class DataSource(ABC):
     def __getitem__(self, item):
         raise NotImplementedError
 
+    def get_items(self, items: List[int]) -> List[dict]:
+        """Return several items at once. Sources override this to share work between the items."""
+        return [self[item] for item in items]
+
+    @staticmethod
+    def length_may_have_changed() -> None:
+        """Mark the items of the datasets in this process for reindexing."""
+        DataSource.length_generation += 1
+
     @staticmethod
-    def from_path(path: str, lazy_load: bool = False) -> DataSource:
+    def from_path(
+        path: str,
+        lazy_load: bool = False,
+        volume_args: Optional[dict] = None,
+        ppm_args: Optional[dict] = None,
+    ) -> DataSource:
         """Check first whether this is a region or volume data source, then instantiate accordingly.
 
         Also checks to make sure the old region set file format was not provided. If it was,
@@ -163,9 +365,11 @@ class DataSource(ABC):
                 f"\tpython inkid/scripts/update_data_file.py {path}"
             )
         if source_json.get("type") == "region":
-            return RegionSource(path, lazy_load=lazy_load)
+            return RegionSource(
+                path, lazy_load=lazy_load, volume_args=volume_args, ppm_args=ppm_args
+            )
         elif source_json.get("type") == "volume":
-            return VolumeSource(path)
+            return VolumeSource(path, volume_args=volume_args)
         else:
             raise ValueError(
                 f'Source file {path} does not specify valid "type" of "region" or "volume"'
@@ -179,20 +383,29 @@ class RegionSource(DataSource):
 
     """
 
-    def __init__(self, path: str, lazy_load: bool = False) -> None:
+    def __init__(
+        self,
+        path: str,
+        lazy_load: bool = False,
+        volume_args: Optional[dict] = None,
+        ppm_args: Optional[dict] = None,
+    ) -> None:
         super().__init__(path)
 
         # Initialize region's PPM, volume, etc
-        self._ppm: inkid.data.PPM = inkid.data.PPM.from_path(self.source_json["ppm"], lazy_load=lazy_load)
-        self.bounding_box: Tuple[int, int, int, int] = (
+        self._ppm: inkid.data.PPM = inkid.data.PPM.from_path(
+            self.source_json["ppm"], lazy_load=lazy_load, **(ppm_args or {})
+        )
+        self.bounding_box = (
             self.source_json["bounding_box"] or self.get_default_bounds()
         )
         self._invert_normals: bool = self.source_json["invert_normals"]
+        self._ppm_args: dict = ppm_args or {}
         if lazy_load:
             self.volume = None
         else:
             self.volume: inkid.data.Volume = inkid.data.Volume.from_path(
-                self.source_json["volume"]
+                self.source_json["volume"], **(volume_args or {})
             )
 
         # Mask and label images
@@ -202,41 +415,41 @@ class RegionSource(DataSource):
             None,
             None,
         )
+        # Decoded images are cached on disk, see inkid.data.cache
         if self.source_json["mask"] is not None:
-            self._mask = np.array(Image.open(self.source_json["mask"]))
+            self._mask = inkid.data.cache.cached_array(
+                self.source_json["mask"], "mask", self._load_mask
+            )
         if self.source_json["ink_label"] is not None:
-            im = Image.open(self.source_json["ink_label"]).convert(
-                "L"
-            )  # Allow RGB mode images
-            self._ink_label = np.array(im)
+            self._ink_label = inkid.data.cache.cached_array(
+                self.source_json["ink_label"], "ink_label", self._load_ink_label
+            )
         if self.source_json["rgb_label"] is not None:
-            im = Image.open(self.source_json["rgb_label"]).convert("RGB")
-            self._rgb_label = np.array(im).astype(np.float32)
-            # Make sure RGB image loaded wasn't more than 8 bit
-            assert np.amax(self._rgb_label) <= np.iinfo(np.uint8).max
-            # Map from [0, 255] to [0, 1]
-            self._rgb_label /= np.iinfo(np.uint8).max
+            self._rgb_label = inkid.data.cache.cached_array(
+                self.source_json["rgb_label"], "rgb_label", self._load_rgb_label
+            )
         if self.source_json["volcart_texture_label"] is not None:
-            im = Image.open(self.source_json["volcart_texture_label"])
-            # Assuming image is uint16 data but Pillow loads it as uint32 ('I')
-            assert im.mode == "I"
-            self._volcart_texture_label = np.array(im).astype(np.float32)
-            # Make sure data seems to be 16 bit (not a perfect check)
-            assert (
-                np.iinfo(np.uint8).max
-                <= np.amax(self._volcart_texture_label)
-                <= np.iinfo(np.uint16).max
+            self._volcart_texture_label = inkid.data.cache.cached_array(
+                self.source_json["volcart_texture_label"],
+                "volcart_texture_label",
+                self._load_volcart_texture_label,
             )
-            # Normalize to [0.0, 1.0]
-            self._volcart_texture_label /= np.iinfo(np.uint16).max
 
-        # This region generates points, here we create the empty list
-        self._points = list()
+        # Label images padded for patch extraction, see _label_patches()
+        self._padded_labels: Dict[Tuple[str, Tuple[int, int]], np.ndarray] = dict()
+
+        # This region generates points as an (N, 2) array of (x, y), here we create it empty
+        self._points = np.empty((0, 2), dtype=np.int32)
         # Mark that this list needs updating so that it will be filled before being accessed
         self._points_list_needs_update: bool = True
 
         self.sampler = RegionPointSampler()
 
+        # Whether to keep the subvolumes sampled at the points on disk, see _get_feature_cache()
+        self.cache_features: bool = False
+        self._feature_cache: Optional[inkid.data.cache.SubvolumeCache] = None
+        self._feature_cache_args: Optional[dict] = None
+
         # Prediction images
         self._ink_classes_prediction_image = np.zeros(
             (self._ppm.height, self._ppm.width), np.uint16
@@ -251,6 +464,34 @@ class RegionSource(DataSource):
         )
         self._volcart_texture_prediction_image_written_to = False
 
+    def _load_mask(self) -> np.ndarray:
+        return np.array(Image.open(self.source_json["mask"]))
+
+    def _load_ink_label(self) -> np.ndarray:
+        im = Image.open(self.source_json["ink_label"]).convert(
+            "L"
+        )  # Allow RGB mode images
+        return np.array(im)
+
+    def _load_rgb_label(self) -> np.ndarray:
+        im = Image.open(self.source_json["rgb_label"]).convert("RGB")
+        # Kept as uint8, mapped to [0, 1] by points_to_rgb_values_labels()
+        return np.array(im)
+
+    def _load_volcart_texture_label(self) -> np.ndarray:
+        im = Image.open(self.source_json["volcart_texture_label"])
+        # Assuming image is uint16 data but Pillow loads it as uint32 ('I')
+        assert im.mode == "I"
+        volcart_texture_label = np.array(im)
+        # Make sure data seems to be 16 bit (not a perfect check)
+        assert (
+            np.iinfo(np.uint8).max
+            <= np.amax(volcart_texture_label)
+            <= np.iinfo(np.uint16).max
+        )
+        # Kept as uint16, mapped to [0, 1] by points_to_volcart_texture_labels()
+        return volcart_texture_label.astype(np.uint16)
+
     @property
     def name(self) -> str:
         return os.path.splitext(os.path.basename(self.path))[0]
@@ -261,53 +502,105 @@ class RegionSource(DataSource):
         return len(self._points)
 
     def __getitem__(self, item):
+        return self.get_items([item])[0]
+
+    def get_items(self, items: List[int]) -> List[dict]:
+        """Return several items at once, reading the PPM, volume and labels once for all of them."""
         if self._points_list_needs_update:
             self.update_points_list()
-        # Get the point (x, y) from list of points
-        surface_x, surface_y = self._points[item]
-        # Read that value from PPM
-        x, y, z, n_x, n_y, n_z = self._ppm.get_point_with_normal(surface_x, surface_y)
-        # Invert normal if needed
+        # Get the points (x, y) from list of points
+        surface_points = self._points[np.asarray(items, dtype=np.intp)]
+        # Read those values from PPM
+        points, normals = self._ppm.get_points_and_normals(
+            surface_points[:, 0], surface_points[:, 1]
+        )
+        # Invert normals if needed
         if self._invert_normals:
-            n_x, n_y, n_z = -n_x, -n_y, -n_z
+            normals = -normals
         # Get the feature metadata (useful for e.g. knowing where this feature came from on the surface)
-        feature_metadata = FeatureMetadata(
-            self.path, surface_x, surface_y, x, y, z, n_x, n_y, n_z
-        )
-        # Get the feature
-        feature = self.volume.get_subvolume(
-            center=(x, y, z), normal=(n_x, n_y, n_z), **self.feature_args
-        )
-
-        transform = transforms.Compose(
-            [
-                inkid.util.uint16_to_float32_normalized_0_1,
-                torch.from_numpy,
-                transforms.RandomHorizontalFlip(),
-                transforms.RandomVerticalFlip(),
-                transforms.Normalize((0.5,), (0.5,)),
-            ]
-        )
-        feature = transform(feature)
-
-        item = {
-            "feature_metadata": feature_metadata,
-            "feature": feature,
-        }
-        # Get the label
-        if "ink_classes" in self.label_types:
-            item["ink_classes"] = self.point_to_ink_classes_label(
-                (surface_x, surface_y), **self.label_args["ink_classes"]
+        coordinates = np.concatenate((surface_points, points, normals), axis=1)
+        coordinates = coordinates.astype(np.float32)
+        # Get the features
+        # Sampled straight into [-1, 1], as Normalize((0.5,), (0.5,)) of values in [0, 1]
+        # Augmented per batch by augment_features()
+        args = subvolume_args(self.feature_args)
+        feature_cache = self._get_feature_cache(args)
+        if feature_cache is None:
+            features = self.volume.get_subvolumes(
+                points, normals, value_range=(-1, 1), **args
             )
-        if "rgb_values" in self.label_types:
-            item["rgb_values"] = self.point_to_rgb_values_label(
-                (surface_x, surface_y), **self.label_args["rgb_values"]
+        elif feature_cache.dtype["subvolume"].base == np.uint16:
+            features = feature_cache.get(
+                items,
+                lambda missing: self.volume.get_subvolumes(
+                    points[missing], normals[missing], **args
+                ),
             )
-        if "volcart_texture" in self.label_types:
-            item["volcart_texture"] = self.point_to_volcart_texture_label(
-                (surface_x, surface_y), **self.label_args["volcart_texture"]
+            features = uint16_to_value_range(features, (-1, 1))
+        else:
+            features = feature_cache.get(
+                items,
+                lambda missing: self.volume.get_subvolumes(
+                    points[missing], normals[missing], value_range=(-1, 1), **args
+                ),
             )
-        return item
+        features = torch.from_numpy(features)
+        batch = [
+            {
+                "feature_metadata": FeatureMetadata(-1, coordinates[i]),
+                "feature": features[i],
+            }
+            for i in range(len(items))
+        ]
+        # Get the labels
+        for label_type, points_to_labels in [
+            ("ink_classes", self.points_to_ink_classes_labels),
+            ("rgb_values", self.points_to_rgb_values_labels),
+            ("volcart_texture", self.points_to_volcart_texture_labels),
+        ]:
+            if label_type in self.label_types:
+                labels = points_to_labels(
+                    surface_points, **self.label_args[label_type]
+                )
+                for item, label in zip(batch, labels):
+                    item[label_type] = label
+        return batch
+
+    def _get_feature_cache(
+        self, args: dict
+    ) -> Optional[inkid.data.cache.SubvolumeCache]:
+        """Return the on-disk cache of the subvolumes at this region's points, if enabled.
+
+        Only used when cache_features is set and the subvolumes are not
+        jittered, e.g. for validation and prediction, where every pass
+        over the points samples the same subvolumes. Nearest neighbor
+        subvolumes are kept as uint16, others as float32 in [-1, 1]. The
+        cache is keyed by the volume's data_version() too, so it is not
+        reused once the volume is reconstructed again.
+
+        """
+        if not self.cache_features or args.get("jitter_max"):
+            return None
+        if self._feature_cache_args != args:
+            nearest_neighbor = args.get("method") in (None, "nearest_neighbor")
+            self._feature_cache = inkid.data.cache.subvolume_cache(
+                self.name,
+                [
+                    json.dumps(self.source_json, sort_keys=True),
+                    self.volume.data_version(),
+                    json.dumps(self._ppm_args, sort_keys=True),
+                    # The device only changes where grid_sample runs
+                    json.dumps(
+                        {k: v for k, v in args.items() if k != "device"}, sort_keys=True
+                    ),
+                    hashlib.sha1(self._points.tobytes()).hexdigest(),
+                ],
+                len(self._points),
+                (1, *args["shape_voxels"]),
+                np.uint16 if nearest_neighbor else np.float32,
+            )
+            self._feature_cache_args = args
+        return self._feature_cache
 
     def update_points_list(self) -> None:
         """Update the list of points after changes to the bounding box, grid spacing, or some other options."""
@@ -327,33 +620,31 @@ class RegionSource(DataSource):
                 ImageFilter.MaxFilter(dilation_kernel_width)
             )
             self.sampler.ambiguous_labels_mask = np.array(ambiguous_labels_mask)
-        positive_points = list()
-        negative_points = list()
-        unlabeled_points = list()
+        # Candidate points on the grid, in row-major order
         x0, y0, x1, y1 = self.bounding_box
-        for y in range(y0, y1, self.sampler.grid_spacing):
-            for x in range(x0, x1, self.sampler.grid_spacing):
-                if not self.is_on_surface(x, y):
-                    continue
-                if self.sampler.specify_inkness is not None:
-                    if self.sampler.specify_inkness and not self.is_ink(x, y):
-                        continue
-                    elif not self.sampler.specify_inkness and self.is_ink(x, y):
-                        continue
-                # Filter out points with ambiguous ink labels
-                if self.sampler.ambiguous_labels_mask is not None:
-                    if self.sampler.ambiguous_labels_mask[y, x] != 0:
-                        continue
-                if (
-                    self.sampler.oversampling_ink_ratio is not None
-                    or self.sampler.undersampling_ink_ratio is not None
-                ):
-                    if self.is_ink(x, y):
-                        positive_points.append((x, y))
-                    else:
-                        negative_points.append((x, y))
-                else:
-                    unlabeled_points.append((x, y))
+        grid_ys, grid_xs = np.meshgrid(
+            np.arange(y0, y1, self.sampler.grid_spacing, dtype=np.int32),
+            np.arange(x0, x1, self.sampler.grid_spacing, dtype=np.int32),
+            indexing="ij",
+        )
+        points = np.stack((grid_xs.ravel(), grid_ys.ravel()), axis=1)
+        points = points[self.surface_mask_at(points)]
+        xs, ys = points[:, 0], points[:, 1]
+        if self.sampler.specify_inkness is not None:
+            ink = self._ink_label[ys, xs] != 0
+            points = points[ink == self.sampler.specify_inkness]
+            xs, ys = points[:, 0], points[:, 1]
+        # Filter out points with ambiguous ink labels
+        if self.sampler.ambiguous_labels_mask is not None:
+            points = points[self.sampler.ambiguous_labels_mask[ys, xs] == 0]
+            xs, ys = points[:, 0], points[:, 1]
+        if (
+            self.sampler.oversampling_ink_ratio is not None
+            or self.sampler.undersampling_ink_ratio is not None
+        ):
+            ink = self._ink_label[ys, xs] != 0
+            positive_points = points[ink]
+            negative_points = points[~ink]
 
         """
         For the given ink ratio,
@@ -374,8 +665,10 @@ class RegionSource(DataSource):
                 * negative_ratio
                 / self.sampler.undersampling_ink_ratio
             )
-            self._points = positive_points + random.choices(
-                negative_points, k=negatives_needed
+            # Same draws from random as random.choices(negative_points, k=...)
+            chosen = random.choices(range(len(negative_points)), k=negatives_needed)
+            self._points = np.concatenate(
+                (positive_points, negative_points[np.array(chosen, dtype=np.intp)])
             )
         elif self.sampler.oversampling_ink_ratio is not None:
             negative_ratio = 1.0 - self.sampler.oversampling_ink_ratio
@@ -389,14 +682,14 @@ class RegionSource(DataSource):
                 if positives_needed < len(positive_points)
                 else int(positives_needed / len(positive_points))
             )
-            extended_positive_points = list(
-                np.repeat(np.array(positive_points), positive_reps, axis=0)
-            )
-            self._points = extended_positive_points + negative_points
+            extended_positive_points = np.repeat(positive_points, positive_reps, axis=0)
+            self._points = np.concatenate((extended_positive_points, negative_points))
         else:
-            self._points = unlabeled_points
+            self._points = points
 
         self._points_list_needs_update = False
+        # Cached subvolumes are only valid for the points they were sampled at
+        self._feature_cache_args = None
 
     @property
     def sampler(self):
@@ -406,11 +699,51 @@ class RegionSource(DataSource):
     def sampler(self, sampler: RegionPointSampler):
         self._sampler = sampler
         self._points_list_needs_update = True
+        self.length_may_have_changed()
+
+    @property
+    def bounding_box(self) -> Tuple[int, int, int, int]:
+        return self._bounding_box
+
+    @bounding_box.setter
+    def bounding_box(self, bounding_box: Tuple[int, int, int, int]):
+        self._bounding_box = bounding_box
+        self._points_list_needs_update = True
+        self.length_may_have_changed()
 
     def is_ink(self, x: int, y: int) -> bool:
         assert self._ink_label is not None
         return self._ink_label[y, x] != 0
 
+    def surface_mask_at(self, points: np.ndarray, r: int = 1) -> np.ndarray:
+        """Return is_on_surface() of each (x, y) row of an (N, 2) array of points.
+
+        Points outside of the mask are not on the surface.
+
+        """
+        assert self._mask is not None
+        on_mask = self._mask != 0
+        if on_mask.ndim == 3:
+            on_mask = np.all(on_mask, axis=2)
+        height, width = on_mask.shape
+        # Erode with a (2r+1)^2 square, which is cut short at the high edges
+        # of the mask (as the slice in is_on_surface() is)
+        padded = np.pad(on_mask, r, constant_values=True)
+        eroded_columns = np.ones((height, width + 2 * r), dtype=bool)
+        for dy in range(2 * r + 1):
+            eroded_columns &= padded[dy : dy + height]
+        eroded = np.ones((height, width), dtype=bool)
+        for dx in range(2 * r + 1):
+            eroded &= eroded_columns[:, dx : dx + width]
+        # The slice in is_on_surface() is empty if it starts below zero
+        eroded[:r] = False
+        eroded[:, :r] = False
+        xs, ys = points[:, 0], points[:, 1]
+        inside = (0 <= xs) & (xs < width) & (0 <= ys) & (ys < height)
+        result = np.zeros(len(points), dtype=bool)
+        result[inside] = eroded[ys[inside], xs[inside]]
+        return result
+
     def is_on_surface(self, x: int, y: int, r: int = 1) -> bool:
         """Return whether a point is on the surface mask.
 
@@ -427,73 +760,74 @@ class RegionSource(DataSource):
         """Return the full bounds of the PPM in (x0, y0, x1, y1) format."""
         return 0, 0, self._ppm.width, self._ppm.height
 
+    def _label_patches(self, label_type: str, points, shape) -> np.ndarray:
+        """Return the [h, w] patch of a label image centred on each (x, y) of points.
+
+        Patch pixels outside of the image are zero, as are patches of
+        points too far outside of it to overlap it. The label image is
+        padded once per label type and shape, by a whole patch beyond the
+        edges, then each patch is a window of the padded image, so a
+        whole batch is gathered with one indexing operation.
+
+        """
+        shape = tuple(shape)
+        key = (label_type, shape)
+        if key not in self._padded_labels:
+            if label_type == "ink_classes":
+                assert self._ink_label is not None
+                # 0 = no ink, 1 = ink
+                image = self._ink_label != 0
+            elif label_type == "rgb_values":
+                assert self._rgb_label is not None
+                image = self._rgb_label
+            else:
+                assert self._volcart_texture_label is not None
+                image = self._volcart_texture_label
+            # Calculate distance from center to edges of square we are sampling
+            y_d, x_d = np.array(shape) // 2
+            # A patch beyond each edge, for points outside the image near its edges
+            padding = (
+                (shape[0] + y_d, 2 * shape[0] - y_d),
+                (shape[1] + x_d, 2 * shape[1] - x_d),
+            )
+            padded = np.pad(image, padding + ((0, 0),) * (image.ndim - 2))
+            self._padded_labels[key] = np.lib.stride_tricks.sliding_window_view(
+                padded, shape, axis=(0, 1)
+            )
+        # [H + 2h + 1, W + 2w + 1, (C,) h, w], window (y + h, x + w) is centred on (x, y)
+        windows = self._padded_labels[key]
+        points = np.asarray(points).reshape(-1, 2)
+        xs, ys = points[:, 0] + shape[1], points[:, 1] + shape[0]
+        inside = (
+            (0 <= xs) & (xs < windows.shape[1]) & (0 <= ys) & (ys < windows.shape[0])
+        )
+        patches = np.zeros((len(points),) + windows.shape[2:], dtype=np.float32)
+        patches[inside] = windows[ys[inside], xs[inside]]
+        return patches
+
+    def points_to_ink_classes_labels(self, points, shape):
+        """Return the [N, h, w] ink class labels of an [N, 2] array of (x, y) points."""
+        return torch.from_numpy(self._label_patches("ink_classes", points, shape)).long()
+
+    def points_to_rgb_values_labels(self, points, shape):
+        """Return the [N, 3, h, w] RGB labels of an [N, 2] array of (x, y) points."""
+        # Map from [0, 255] to [0, 1]
+        return self._label_patches("rgb_values", points, shape) / np.iinfo(np.uint8).max
+
+    def points_to_volcart_texture_labels(self, points, shape):
+        """Return the [N, 1, h, w] texture labels of an [N, 2] array of (x, y) points."""
+        # Normalize to [0.0, 1.0]
+        patches = self._label_patches("volcart_texture", points, shape)
+        return patches[:, np.newaxis] / np.iinfo(np.uint16).max
+
     def point_to_ink_classes_label(self, point, shape):
-        # 0 = no ink, 1 = ink
-        assert self._ink_label is not None
-        x, y = point
-        label = np.zeros(shape).astype(np.float32)  # Create array of no-ink labels
-        y_d, x_d = (
-            np.array(shape) // 2
-        )  # Calculate distance from center to edges of square we are sampling
-        # Iterate over label indices
-        for idx, _ in np.ndenumerate(label):
-            y_idx, x_idx = idx
-            y_s = (
-                y - y_d + y_idx
-            )  # Sample point is center minus distance (half edge length) plus label index
-            x_s = x - x_d + x_idx
-            # Bounds check to make sure inside PPM
-            if (
-                0 <= y_s < self._ink_label.shape[0]
-                and 0 <= x_s < self._ink_label.shape[1]
-            ):
-                if self._ink_label[y_s, x_s] != 0:
-                    label[y_idx, x_idx] = 1.0  # Mark this "ink"
-        return torch.Tensor(label).long()
+        return self.points_to_ink_classes_labels(point, shape)[0]
 
     def point_to_rgb_values_label(self, point, shape):
-        assert self._rgb_label is not None
-        x, y = point
-        label = np.zeros((3,) + shape).astype(np.float32)
-        y_d, x_d = (
-            np.array(shape) // 2
-        )  # Calculate distance from center to edges of square we are sampling
-        # Iterate over label indices
-        for idx, _ in np.ndenumerate(label):
-            _, y_idx, x_idx = idx
-            y_s = (
-                y - y_d + y_idx
-            )  # Sample point is center minus distance (half edge length) plus label index
-            x_s = x - x_d + x_idx
-            # Bounds check to make sure inside PPM
-            if (
-                0 <= y_s < self._rgb_label.shape[0]
-                and 0 <= x_s < self._rgb_label.shape[1]
-            ):
-                label[:, y_idx, x_idx] = self._rgb_label[y_s, x_s]
-        return label
+        return self.points_to_rgb_values_labels(point, shape)[0]
 
     def point_to_volcart_texture_label(self, point, shape):
-        assert self._volcart_texture_label is not None
-        x, y = point
-        label = np.zeros((1,) + shape).astype(np.float32)
-        y_d, x_d = (
-            np.array(shape) // 2
-        )  # Calculate distance from center to edges of square we are sampling
-        # Iterate over label indices
-        for idx, _ in np.ndenumerate(label):
-            _, y_idx, x_idx = idx
-            y_s = (
-                y - y_d + y_idx
-            )  # Sample point is center minus distance (half edge length) plus label index
-            x_s = x - x_d + x_idx
-            # Bounds check to make sure inside PPM
-            if (
-                0 <= y_s < self._volcart_texture_label.shape[0]
-                and 0 <= x_s < self._volcart_texture_label.shape[1]
-            ):
-                label[0, y_idx, x_idx] = self._volcart_texture_label[y_s, x_s]
-        return label
+        return self.points_to_volcart_texture_labels(point, shape)[0]
 
     def store_prediction(self, x, y, prediction, label_type):
         """Store an incoming prediction in the corresponding prediction image buffer.
@@ -502,48 +836,69 @@ class RegionSource(DataSource):
         a single point rather than a rectangular region.
 
         """
-        # Repeat prediction to fill grid square so prediction image is not single pixels in sea of blackness
-        if prediction.shape[1] == 1 and prediction.shape[2] == 1:
-            prediction = np.repeat(
-                prediction, repeats=self.sampler.grid_spacing, axis=1
+        self.store_predictions([x], [y], np.asarray(prediction)[np.newaxis], label_type)
+
+    def store_predictions(self, xs, ys, predictions, label_type):
+        """Store a batch of predictions centred on (xs[i], ys[i]) in the prediction image buffer.
+
+        The predictions have shape [N, d, h, w], as for store_prediction(). They are
+        written in order, so where they overlap the later prediction is kept.
+
+        """
+        predictions = np.asarray(predictions)
+        xs = np.asarray(xs, dtype=np.int64)
+        ys = np.asarray(ys, dtype=np.int64)
+        if label_type == "ink_classes":
+            # Convert ink class probability to image intensity
+            values = predictions[:, 1] * np.iinfo(np.uint16).max
+            image = self._ink_classes_prediction_image
+        elif label_type == "rgb_values":
+            # Rescale from [0, 1] to [0, 255] and restrict value to uint8 range
+            values = np.clip(
+                predictions * np.iinfo(np.uint8).max, 0, np.iinfo(np.uint8).max
             )
-            prediction = np.repeat(
-                prediction, repeats=self.sampler.grid_spacing, axis=2
+            values = np.moveaxis(values, 1, -1)
+            image = self._rgb_values_prediction_image
+        elif label_type == "volcart_texture":
+            # Rescale from [0, 1] and restrict value to uint16 range
+            values = np.clip(
+                predictions[:, 0] * np.iinfo(np.uint16).max,
+                0,
+                np.iinfo(np.uint16).max,
             )
-        # Calculate distance from center to edges of square we are writing
-        y_d, x_d = np.array(prediction.shape)[1:] // 2
-        # Iterate over label indices
-        for idx in np.ndindex(prediction.shape[1:]):
-            y_idx, x_idx = idx
-            value = prediction[:, y_idx, x_idx]
-            # Sample point in PPM space is center minus distance (half edge length) plus label index
-            y_s = y - y_d + y_idx
-            x_s = x - x_d + x_idx
-            # Bounds check to make sure inside PPM
-            if 0 <= x_s < self._ppm.width and 0 <= y_s < self._ppm.height:
-                if label_type == "ink_classes":
-                    # Convert ink class probability to image intensity
-                    v = value[1] * np.iinfo(np.uint16).max
-                    self._ink_classes_prediction_image[y_s, x_s] = v
-                    self._ink_classes_prediction_image_written_to = True
-                elif label_type == "rgb_values":
-                    # Rescale from [0, 1] to [0, 255]
-                    v = value * np.iinfo(np.uint8).max
-                    # Restrict value to uint8 range
-                    v = np.clip(v, 0, np.iinfo(np.uint8).max)
-                    self._rgb_values_prediction_image[y_s, x_s] = v
-                    self._rgb_values_prediction_image_written_to = True
-                elif label_type == "volcart_texture":
-                    # Rescale from [0, 1]
-                    v = value[0] * np.iinfo(np.uint16).max
-                    # Restrict value to uint16 range
-                    v = np.clip(v, 0, np.iinfo(np.uint16).max)
-                    self._volcart_texture_prediction_image[y_s, x_s] = v
-                    self._volcart_texture_prediction_image_written_to = True
-                else:
-                    raise ValueError(
-                        f"Unknown label_type: {label_type} used for prediction"
-                    )
+            image = self._volcart_texture_prediction_image
+        else:
+            raise ValueError(f"Unknown label_type: {label_type} used for prediction")
+        # Repeat prediction to fill grid square so prediction image is not single pixels in sea of blackness
+        h, w = predictions.shape[2:4]
+        if h == 1 and w == 1:
+            h = w = self.sampler.grid_spacing
+            values = np.broadcast_to(values, (len(values), h, w) + values.shape[3:])
+        # Sample point in PPM space is center minus distance (half edge length) plus label index
+        y_s = (ys - h // 2)[:, np.newaxis, np.newaxis] + np.arange(h)[:, np.newaxis]
+        x_s = (xs - w // 2)[:, np.newaxis, np.newaxis] + np.arange(w)
+        y_s, x_s = np.broadcast_arrays(y_s, x_s)
+        # Bounds check to make sure inside PPM
+        inside = (
+            (0 <= x_s)
+            & (x_s < self._ppm.width)
+            & (0 <= y_s)
+            & (y_s < self._ppm.height)
+        )
+        pixels = (y_s * self._ppm.width + x_s)[inside]
+        values = values[inside]
+        if len(pixels) == 0:
+            return
+        # Keep only the last write to each pixel
+        _, last_from_end = np.unique(pixels[::-1], return_index=True)
+        last = len(pixels) - 1 - last_from_end
+        image.reshape((-1,) + image.shape[2:])[pixels[last]] = values[last]
+        if label_type == "ink_classes":
+            self._ink_classes_prediction_image_written_to = True
+        elif label_type == "rgb_values":
+            self._rgb_values_prediction_image_written_to = True
+        else:
+            self._volcart_texture_prediction_image_written_to = True
 
     def write_predictions(self, directory, suffix, step=-1):
         """Write the buffered prediction images to disk."""
@@ -612,7 +967,7 @@ class VolumeSource(DataSource):
 
     """
 
-    def __init__(self, path: str) -> None:
+    def __init__(self, path: str, volume_args: Optional[dict] = None) -> None:
         super().__init__(path)
 
         self.volume_bounding_box = self.source_json.get("volume_bounding_box")
@@ -621,6 +976,7 @@ class VolumeSource(DataSource):
         self.volume: inkid.data.Volume = inkid.data.Volume.from_path(
             self.source_json["volume"],
             bounding_box=self.volume_bounding_box,
+            **(volume_args or {}),
         )
 
     def __len__(self):
@@ -630,43 +986,48 @@ class VolumeSource(DataSource):
         # there is one for every voxel. So we just return a large number instead.
         return 100000
 
-    def __getitem__(self, _):
-        # Random 3d position
-        shape = self.volume.shape()
-        x = random.random() * shape[2]
-        y = random.random() * shape[1]
-        z = random.random() * shape[0]
-
-        # Random 3d direction https://math.stackexchange.com/a/44691
-        theta = random.random() * 2 * math.pi
-        zed = random.random() * 2 - 1
-        n_x = math.sqrt(1 - zed**2) * math.cos(theta)
-        n_y = math.sqrt(1 - zed**2) * math.sin(theta)
-        n_z = zed
-
-        # Get the feature metadata (useful for e.g. knowing where this feature came from on the surface)
-        feature_metadata = FeatureMetadata(self.path, -1, -1, x, y, z, n_x, n_y, n_z)
-        # Get the feature
-        feature = self.volume.get_subvolume(
-            center=(x, y, z), normal=(n_x, n_y, n_z), **self.feature_args
-        )
+    def __getitem__(self, item):
+        return self.get_items([item])[0]
 
-        transform = transforms.Compose(
-            [
-                inkid.util.uint16_to_float32_normalized_0_1,
-                torch.from_numpy,
-                transforms.RandomHorizontalFlip(),
-                transforms.RandomVerticalFlip(),
-                transforms.Normalize((0.5,), (0.5,)),
-            ]
+    def get_items(self, items: List[int]) -> List[dict]:
+        """Return several items at once, sampling all of their subvolumes in one call."""
+        shape = self.volume.shape()
+        coordinates = np.full((len(items), len(FeatureMetadata.COORDINATES)), -1.0)
+        for i in range(len(items)):
+            # Random 3d position
+            x = random.random() * shape[2]
+            y = random.random() * shape[1]
+            z = random.random() * shape[0]
+
+            # Random 3d direction https://math.stackexchange.com/a/44691
+            theta = random.random() * 2 * math.pi
+            zed = random.random() * 2 - 1
+            n_x = math.sqrt(1 - zed**2) * math.cos(theta)
+            n_y = math.sqrt(1 - zed**2) * math.sin(theta)
+            n_z = zed
+
+            coordinates[i, 2:] = x, y, z, n_x, n_y, n_z
+
+        # Get the features
+        # Sampled straight into [-1, 1], as Normalize((0.5,), (0.5,)) of values in [0, 1]
+        # Augmented per batch by augment_features()
+        features = torch.from_numpy(
+            self.volume.get_subvolumes(
+                coordinates[:, 2:5],
+                coordinates[:, 5:8],
+                value_range=(-1, 1),
+                **subvolume_args(self.feature_args),
+            )
         )
-        feature = transform(feature)
-
-        item = {
-            "feature_metadata": feature_metadata,
-            "feature": feature,
-        }
-        return item
+        # Get the feature metadata (useful for e.g. knowing where this feature came from on the surface)
+        coordinates = coordinates.astype(np.float32)
+        return [
+            {
+                "feature_metadata": FeatureMetadata(-1, coordinates[i]),
+                "feature": features[i],
+            }
+            for i in range(len(items))
+        ]
 
 
 def flatten_data_sources_list(source_paths: List[str]) -> List[str]:
@@ -716,7 +1077,13 @@ class Dataset(torch.utils.data.Dataset):
 
     """
 
-    def __init__(self, source_paths: List[str], lazy_load: bool = False) -> None:
+    def __init__(
+        self,
+        source_paths: List[str],
+        lazy_load: bool = False,
+        volume_args: Optional[dict] = None,
+        ppm_args: Optional[dict] = None,
+    ) -> None:
         """Initialize the dataset given .json data source and/or .txt dataset paths.
 
         This recursively expands any provided .txt dataset files until there is just a
@@ -725,23 +1092,100 @@ class Dataset(torch.utils.data.Dataset):
 
         Args:
             source_paths: A list of .txt dataset or .json data source file paths.
+            lazy_load: Defer loading PPMs and volumes until they are needed.
+            volume_args: Keyword arguments passed on to Volume.from_path(), e.g. storage.
+            ppm_args: Keyword arguments passed on to PPM.from_path(), e.g. compact.
 
         """
         source_paths = flatten_data_sources_list(source_paths)
+        # Running total of the source lengths, and what it was computed from, see update_index()
+        self._cumulative_lengths: Optional[List[int]] = None
+        self._indexed_sources: Optional[List[DataSource]] = None
+        self._indexed_num_sources: int = 0
+        self._indexed_generation: int = 0
         self.sources: List[DataSource] = list()
         for source_path in source_paths:
-            self.sources.append(DataSource.from_path(source_path, lazy_load=lazy_load))
+            self.sources.append(
+                DataSource.from_path(
+                    source_path,
+                    lazy_load=lazy_load,
+                    volume_args=volume_args,
+                    ppm_args=ppm_args,
+                )
+            )
+
+    def update_index(self) -> None:
+        """Recompute where each source's items start in the dataset.
+
+        Called by len(), and by lookups when the index may be stale:
+        after a region's sampler or bounding box is set (see
+        DataSource.length_may_have_changed()), or after sources are
+        added, removed or the list of sources is replaced. Call it
+        directly after changing a source's length any other way.
+
+        """
+        self._cumulative_lengths = list(
+            itertools.accumulate(len(source) for source in self.sources)
+        )
+        self._indexed_sources = self.sources
+        self._indexed_num_sources = len(self.sources)
+        self._indexed_generation = DataSource.length_generation
+
+    def _ensure_index(self) -> None:
+        if (
+            self._cumulative_lengths is None
+            or self._indexed_generation != DataSource.length_generation
+            or self._indexed_sources is not self.sources
+            or self._indexed_num_sources != len(self.sources)
+        ):
+            self.update_index()
 
     def __len__(self) -> int:
-        return sum([len(source) for source in self.sources])
+        self.update_index()
+        return self._cumulative_lengths[-1] if self._cumulative_lengths else 0
+
+    def source_index(self, idx: int) -> Tuple[int, int]:
+        """Return the index of the source of an item and the item's index within it."""
+        self._ensure_index()
+        total = self._cumulative_lengths[-1] if self._cumulative_lengths else 0
+        if idx < 0:
+            idx += total
+        if not 0 <= idx < total:
+            raise IndexError
+        source_idx = bisect.bisect_right(self._cumulative_lengths, idx)
+        start = self._cumulative_lengths[source_idx - 1] if source_idx > 0 else 0
+        return source_idx, idx - start
 
     def __getitem__(self, idx: int):
-        for source in self.sources:
-            source_len = len(source)
-            if idx < source_len:
-                return source[idx]
-            idx -= source_len
-        raise IndexError
+        source_idx, source_item = self.source_index(idx)
+        item = self.sources[source_idx][source_item]
+        item["feature_metadata"] = item["feature_metadata"]._replace(
+            source_index=source_idx
+        )
+        return item
+
+    def __getitems__(self, indices: List[int]) -> List[dict]:
+        """Return the items of a batch, fetching each source's items together.
+
+        DataLoader calls this with all of a batch's indices, so each source
+        samples its part of the batch in one call to its get_items().
+
+        """
+        items_by_source: Dict[int, List[Tuple[int, int]]] = dict()
+        for position, idx in enumerate(indices):
+            source_idx, source_item = self.source_index(idx)
+            items_by_source.setdefault(source_idx, []).append((position, source_item))
+        batch = [None] * len(indices)
+        for source_idx, positions_and_items in items_by_source.items():
+            positions, source_items = zip(*positions_and_items)
+            for position, item in zip(
+                positions, self.sources[source_idx].get_items(list(source_items))
+            ):
+                item["feature_metadata"] = item["feature_metadata"]._replace(
+                    source_index=source_idx
+                )
+                batch[position] = item
+        return batch
 
     def regions(self) -> list[RegionSource]:
         return [source for source in self.sources if isinstance(source, RegionSource)]
@@ -753,6 +1197,7 @@ class Dataset(torch.utils.data.Dataset):
         region = self.regions()[n]
         for i, source in enumerate(self.sources):
             if source.path == region.path:
+                self._cumulative_lengths = None
                 return self.sources.pop(i)
         raise ValueError("No source found with same path as desired region.")
 
@@ -1,22 +1,47 @@
 # For PPM.initialized_ppms https://stackoverflow.com/a/33533514
 from __future__ import annotations
 
+import io
 import logging
 import re
-import struct
-from typing import Dict, Optional
+from typing import BinaryIO, Dict, Optional, Tuple, Union
+from urllib.parse import urlsplit
 
 import numpy as np
-from tqdm import tqdm
 
 import inkid.util
+from inkid.data.cache import cached_arrays
 
 
 class PPM:
-    initialized_ppms: Dict[str, PPM] = dict()
+    initialized_ppms: Dict[Tuple[str, Union[bool, str], bool, bool], PPM] = dict()
 
-    def __init__(self, path: str, lazy_load: bool = False):
+    # Quantized normal components are stored as round(n * NORMAL_SCALE)
+    NORMAL_SCALE = np.iinfo(np.int16).max
+
+    def __init__(
+        self,
+        path: str,
+        lazy_load: bool = False,
+        memory_map: Union[bool, str] = False,
+        compact: bool = False,
+        quantize_normals: bool = False,
+    ):
+        """Open a PPM, loading its data unless lazy_load.
+
+        With compact, the float64 data array is not kept. Instead the
+        points and normals are stored in separate float32 planes
+        self.points and self.normals, plus a bitmask of non-empty
+        pixels. With quantize_normals as well, the normals are stored as
+        int16. For a 6-dim PPM this takes half (or with quantized
+        normals, 3/8) of the memory. Channels beyond the normals are
+        dropped.
+
+        """
         self._path = path
+        self._memory_map = memory_map
+        self._compact = compact or quantize_normals
+        self._quantize_normals = quantize_normals
 
         header = PPM.parse_ppm_header(path)
         self.width: int = header["width"]
@@ -25,8 +50,17 @@ class PPM:
         self.ordered: bool = header["ordered"]
         self.type: str = header["type"]
         self.version: str = header["version"]
+        self._data_offset: int = header["data_offset"]
 
         self.data: Optional[np.typing.ArrayLike] = None
+        self.points: Optional[np.ndarray] = None
+        self.normals: Optional[np.ndarray] = None
+        self._valid_bits: Optional[np.ndarray] = None
+
+        if self._compact and self.dim < 6:
+            raise ValueError(
+                f"Compact PPMs need points and normals but {path} has dim {self.dim}"
+            )
 
         logging.info(
             f"Initialized PPM for {self._path} with width {self.width}, "
@@ -37,21 +71,58 @@ class PPM:
             self.ensure_loaded()
 
     def is_loaded(self):
-        return self.data is not None
+        return self.data is not None or self.points is not None
+
+    @property
+    def is_compact(self) -> bool:
+        return self._compact
 
     def ensure_loaded(self):
         if not self.is_loaded():
             self.load_ppm_data()
 
     @classmethod
-    def from_path(cls, path: str, lazy_load: bool = False) -> PPM:
-        if path in cls.initialized_ppms:
-            return cls.initialized_ppms[path]
-        cls.initialized_ppms[path] = PPM(path, lazy_load=lazy_load)
-        return cls.initialized_ppms[path]
+    def from_path(
+        cls,
+        path: str,
+        lazy_load: bool = False,
+        memory_map: Union[bool, str] = False,
+        compact: bool = False,
+        quantize_normals: bool = False,
+    ) -> PPM:
+        # PPMs stored differently are cached separately
+        key = (path, memory_map, compact or quantize_normals, quantize_normals)
+        if key in cls.initialized_ppms:
+            return cls.initialized_ppms[key]
+        cls.initialized_ppms[key] = PPM(
+            path,
+            lazy_load=lazy_load,
+            memory_map=memory_map,
+            compact=compact,
+            quantize_normals=quantize_normals,
+        )
+        return cls.initialized_ppms[key]
+
+    @staticmethod
+    def is_local_path(path: str) -> bool:
+        return urlsplit(path).scheme == ""
 
     @staticmethod
     def parse_ppm_header(filename):
+        """Parse the header of a PPM file or URL.
+
+        Also returns the byte offset of the data following the header
+        as "data_offset". Only the header is read, also from a URL if
+        the server supports range requests.
+
+        """
+        with inkid.util.open_file_or_url(
+            filename, buffer_size=io.DEFAULT_BUFFER_SIZE
+        ) as f:
+            return PPM._parse_ppm_header(f)
+
+    @staticmethod
+    def _parse_ppm_header(data: BinaryIO):
         comments_re = re.compile("^#")
         width_re = re.compile("^width")
         height_re = re.compile("^height")
@@ -63,7 +134,6 @@ class PPM:
 
         width, height, dim, ordered, val_type, version = [None] * 6
 
-        data = inkid.util.get_raw_data_from_file_or_url(filename)
         while True:
             line = data.readline().decode("utf-8")
             if comments_re.match(line):
@@ -95,6 +165,7 @@ class PPM:
             "ordered": ordered,
             "type": val_type,
             "version": version,
+            "data_offset": data.tell(),
         }
 
     @staticmethod
@@ -107,21 +178,52 @@ class PPM:
         ordered: bool = True,
         version: str = "1.0",
     ):
+        """Write a PPM header followed by its float64 payload.
+
+        The payload is written in contiguous blocks of rows rather than
+        one value at a time. Only one block is converted in memory at
+        once, so data can be a memory map larger than available RAM.
+
+        """
         with open(path, "wb") as f:
             logging.info("Writing PPM to file {}...".format(path))
-            f.write("width: {}\n".format(width).encode("utf-8"))
-            f.write("height: {}\n".format(height).encode("utf-8"))
-            f.write("dim: {}\n".format(dim).encode("utf-8"))
-            f.write(
-                "ordered: {}\n".format("true" if ordered else "false").encode("utf-8")
+            PPM.write_ppm_header(f, width, height, dim, ordered, version)
+            PPM.write_ppm_payload(f, data, width, height, dim)
+
+    @staticmethod
+    def write_ppm_header(
+        f: BinaryIO,
+        width: int,
+        height: int,
+        dim: int,
+        ordered: bool = True,
+        version: str = "1.0",
+    ) -> None:
+        f.write("width: {}\n".format(width).encode("utf-8"))
+        f.write("height: {}\n".format(height).encode("utf-8"))
+        f.write("dim: {}\n".format(dim).encode("utf-8"))
+        f.write("ordered: {}\n".format("true" if ordered else "false").encode("utf-8"))
+        f.write("type: double\n".encode("utf-8"))
+        f.write("version: {}\n".format(version).encode("utf-8"))
+        f.write("<>\n".encode("utf-8"))
+
+    @staticmethod
+    def write_ppm_payload(
+        f: BinaryIO,
+        data: np.typing.ArrayLike,
+        width: int,
+        height: int,
+        dim: int,
+        chunk_bytes: int = 64 * 2**20,
+    ) -> None:
+        if np.shape(data) != (height, width, dim):
+            raise ValueError(
+                f"PPM data has shape {np.shape(data)}, expected {(height, width, dim)}"
             )
-            f.write("type: double\n".encode("utf-8"))
-            f.write("version: {}\n".format(version).encode("utf-8"))
-            f.write("<>\n".encode("utf-8"))
-            for y in tqdm(range(height)):
-                for x in range(width):
-                    for idx in range(dim):
-                        f.write(struct.pack("d", data[y, x, idx]))
+        rows_per_chunk = max(1, chunk_bytes // max(1, width * dim * 8))
+        for y in range(0, height, rows_per_chunk):
+            rows = np.ascontiguousarray(data[y : y + rows_per_chunk], dtype=np.float64)
+            f.write(memoryview(rows).cast("B"))
 
     def load_ppm_data(self):
         """Read the PPM file data and store it in the PPM object.
@@ -133,79 +235,228 @@ class PPM:
         normals, the first component of the normal vector for the PPM
         origin would be at self._data[0, 0, 3].
 
+        The payload is read in one call following the header, straight
+        into the array, also from a URL. If the PPM was opened with
+        memory_map, a local file is instead mapped and pages are only
+        read from disk when accessed. memory_map=True maps the file
+        copy-on-write (np.memmap mode "c"), so translate() and other
+        modifications only change pages in memory, never the file. Any
+        other np.memmap mode may be passed instead, e.g. "r+" to have
+        translate() modify the file in place or "r" to make the data
+        read-only.
+
+        A compact PPM is converted from a read-only mapping a block of
+        rows at a time, so the float64 data is never held in memory. The
+        converted planes are kept in the inkid.data.cache directory and
+        memory mapped from there when the PPM is opened again.
+
         """
         logging.info(
             f"Loading PPM data for {self._path} with width {self.width}, "
             f"height {self.height}, dim {self.dim}..."
         )
 
-        self.data = np.empty((self.height, self.width, self.dim))
+        if self._compact:
+            planes = cached_arrays(
+                self._path,
+                "compact-quantized" if self._quantize_normals else "compact",
+                ["points", "normals", "valid_bits"],
+                lambda: self._compact_planes(self._read_data()),
+            )
+            self.points = planes["points"]
+            self.normals = planes["normals"]
+            self._valid_bits = planes["valid_bits"]
+        else:
+            self.data = self._read_data()
+
+    def _read_data(self) -> np.ndarray:
+        shape = (self.height, self.width, self.dim)
+        count = self.height * self.width * self.dim
+        if not self.is_local_path(self._path):
+            data = np.empty(count, dtype=np.float64)
+            with inkid.util.open_file_or_url(self._path) as f:
+                f.seek(self._data_offset)
+                if f.readinto(memoryview(data).cast("B")) != data.nbytes:
+                    raise ValueError(
+                        f"PPM {self._path} is shorter than its header states"
+                    )
+        elif self._memory_map or self._compact:
+            if isinstance(self._memory_map, str):
+                mode = self._memory_map
+            else:
+                # Compact planes are only converted from the mapping, never modified
+                mode = "c" if self._memory_map else "r"
+            data = np.memmap(
+                self._path,
+                dtype=np.float64,
+                mode=mode,
+                offset=self._data_offset,
+                shape=shape,
+            )
+        else:
+            data = np.fromfile(
+                self._path, dtype=np.float64, count=count, offset=self._data_offset
+            )
+            if data.size != count:
+                raise ValueError(f"PPM {self._path} is shorter than its header states")
+        return data.reshape(shape)
+
+    def _compact_planes(self, data: np.ndarray) -> Dict[str, np.ndarray]:
+        points = np.empty((self.height, self.width, 3), dtype=np.float32)
+        normals = np.empty(
+            (self.height, self.width, 3),
+            dtype=np.int16 if self._quantize_normals else np.float32,
+        )
+        valid_bits = np.empty((self.height, (self.width + 7) // 8), dtype=np.uint8)
+        rows_per_chunk = self._rows_per_chunk(self.width)
+        for y in range(0, self.height, rows_per_chunk):
+            block = data[y : y + rows_per_chunk]
+            rows = slice(y, y + len(block))
+            points[rows] = block[:, :, 0:3]
+            if self._quantize_normals:
+                normals[rows] = np.rint(
+                    np.clip(block[:, :, 3:6], -1, 1) * self.NORMAL_SCALE
+                )
+            else:
+                normals[rows] = block[:, :, 3:6]
+            valid_bits[rows] = np.packbits(np.any(block != 0, axis=2), axis=1)
+        return dict(points=points, normals=normals, valid_bits=valid_bits)
+
+    def _require_full_data(self, operation: str) -> None:
+        if self._compact:
+            raise ValueError(
+                f"{operation} needs the full PPM data, open {self._path} without compact"
+            )
+
+    def _dequantize_normals(self, normals: np.ndarray) -> np.ndarray:
+        if self._quantize_normals:
+            return normals.astype(np.float32) / self.NORMAL_SCALE
+        return normals
 
-        data = inkid.util.get_raw_data_from_file_or_url(self._path)
-        header_terminator_re = re.compile("^<>$")
-        while True:
-            line = data.readline().decode("utf-8")
-            if header_terminator_re.match(line):
-                break
+    def valid_mask(self) -> np.ndarray:
+        """Return a boolean (height, width) array of the non-empty pixels."""
+        self.ensure_loaded()
+        if self._compact:
+            return np.unpackbits(self._valid_bits, axis=1, count=self.width).view(bool)
+        return np.any(self.data != 0, axis=2)
 
-        for y in tqdm(range(self.height)):
-            for x in range(self.width):
-                for idx in range(self.dim):
-                    # Only works if dim == 6: (x, y, z, n_x, n_y, n_z)
-                    if self.dim == 6:
-                        self.data[y, x, idx] = struct.unpack("d", data.read(8))[0]
-        print()
+    def is_valid(self, ppm_x: int, ppm_y: int) -> bool:
+        self.ensure_loaded()
+        if self._compact:
+            return bool(self._valid_bits[ppm_y, ppm_x >> 3] >> (7 - (ppm_x & 7)) & 1)
+        return bool(np.any(self.data[ppm_y, ppm_x] != 0))
 
     def get_point_with_normal(self, ppm_x, ppm_y):
         self.ensure_loaded()
+        if self._compact:
+            point, normal = self.get_point_and_normal(ppm_x, ppm_y)
+            return np.concatenate((point, normal))
         return self.data[ppm_y][ppm_x]
 
-    def scale_down_by(self, scale_factor):
+    def get_point_and_normal(
+        self, ppm_x: int, ppm_y: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Return the (3,) point and (3,) normal vector at a pixel."""
+        self.ensure_loaded()
+        if self._compact:
+            return (
+                self.points[ppm_y, ppm_x],
+                self._dequantize_normals(self.normals[ppm_y, ppm_x]),
+            )
+        return self.data[ppm_y, ppm_x, 0:3], self.data[ppm_y, ppm_x, 3:6]
+
+    def get_points_and_normals(
+        self, ppm_xs: np.typing.ArrayLike, ppm_ys: np.typing.ArrayLike
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Return the (N, 3) points and (N, 3) normal vectors at N pixels."""
+        self.ensure_loaded()
+        if self._compact:
+            return (
+                self.points[ppm_ys, ppm_xs],
+                self._dequantize_normals(self.normals[ppm_ys, ppm_xs]),
+            )
+        pixels = self.data[ppm_ys, ppm_xs]
+        return pixels[:, 0:3], pixels[:, 3:6]
+
+    def scale_down_by(self, scale_factor: int, average: bool = False) -> None:
+        """Downscale the PPM by an integer factor on both axes.
+
+        By default every scale_factor-th pixel is kept. For a memory
+        mapped PPM this is a strided view of the mapping and nothing is
+        read until the data is accessed. With average, each output pixel
+        instead averages the non-empty pixels of its input block and its
+        normal is rescaled to unit length.
+
+        """
         self.ensure_loaded()
+        self._require_full_data("Downscaling")
 
         self.width //= scale_factor
         self.height //= scale_factor
 
-        new_data = np.empty((self.height, self.width, self.dim))
-
         logging.info(
             "Downscaling PPM by factor of {} on all axes...".format(scale_factor)
         )
-        for y in tqdm(range(self.height)):
-            for x in range(self.width):
-                for idx in range(self.dim):
-                    new_data[y, x, idx] = self.data[
-                        y * scale_factor, x * scale_factor, idx
-                    ]
-
+        if not average:
+            new_data = self.data[::scale_factor, ::scale_factor][
+                : self.height, : self.width
+            ]
+            if not isinstance(self.data, np.memmap):
+                new_data = new_data.copy()
+            self.data = new_data
+            return
+
+        new_data = np.zeros((self.height, self.width, self.dim))
+        rows_per_chunk = self._rows_per_chunk(self.width * scale_factor**2)
+        for y in range(0, self.height, rows_per_chunk):
+            y_end = min(y + rows_per_chunk, self.height)
+            block = self.data[
+                y * scale_factor : y_end * scale_factor, : self.width * scale_factor
+            ].reshape(y_end - y, scale_factor, self.width, scale_factor, self.dim)
+            nonempty = np.any(block != 0, axis=4, keepdims=True)
+            counts = nonempty.sum(axis=(1, 3))
+            sums = np.where(nonempty, block, 0).sum(axis=(1, 3))
+            np.divide(sums, counts, out=new_data[y:y_end], where=counts > 0)
+        if self.dim >= 6:
+            normals = new_data[:, :, 3:6]
+            lengths = np.linalg.norm(normals, axis=2, keepdims=True)
+            np.divide(normals, lengths, out=normals, where=lengths > 0)
         self.data = new_data
 
     def translate(self, dx: int, dy: int, dz: int) -> None:
-        for ppm_y in tqdm(range(self.height)):
-            for ppm_x in range(self.width):
-                if np.any(self.data[ppm_y, ppm_x]):  # Leave empty pixels unchanged
-                    vol_x, vol_y, vol_z = self.data[ppm_y, ppm_x, 0:3]
-                    self.data[ppm_y, ppm_x, 0] = vol_x + dx
-                    self.data[ppm_y, ppm_x, 1] = vol_y + dy
-                    self.data[ppm_y, ppm_x, 2] = vol_z + dz
+        """Add (dx, dy, dz) to the point of every non-empty pixel.
 
-    def write(self, filename):
+        The data is modified in place, a block of rows at a time, so a
+        PPM memory mapped with mode "r+" is translated on disk without
+        being read into memory as a whole.
+
+        """
         self.ensure_loaded()
 
-        with open(filename, "wb") as f:
-            logging.info("Writing PPM to file {}...".format(filename))
-            f.write("width: {}\n".format(self.width).encode("utf-8"))
-            f.write("height: {}\n".format(self.height).encode("utf-8"))
-            f.write("dim: {}\n".format(self.dim).encode("utf-8"))
-            f.write(
-                "ordered: {}\n".format("true" if self.ordered else "false").encode(
-                    "utf-8"
-                )
-            )
-            f.write("type: double\n".encode("utf-8"))
-            f.write("version: {}\n".format(self.version).encode("utf-8"))
-            f.write("<>\n".encode("utf-8"))
-            for y in tqdm(range(self.height)):
-                for x in range(self.width):
-                    for idx in range(self.dim):
-                        f.write(struct.pack("d", self.data[y, x, idx]))
+        if self._compact:
+            self.points[self.valid_mask()] += np.array([dx, dy, dz], dtype=np.float32)
+            return
+
+        offset = np.array([dx, dy, dz], dtype=self.data.dtype)
+        rows_per_chunk = self._rows_per_chunk(self.width)
+        for y in range(0, self.height, rows_per_chunk):
+            block = self.data[y : y + rows_per_chunk]
+            nonempty = np.any(block != 0, axis=2)  # Leave empty pixels unchanged
+            block[:, :, 0:3][nonempty] += offset
+
+    def _rows_per_chunk(self, pixels_per_row: int, chunk_bytes: int = 64 * 2**20):
+        return max(1, chunk_bytes // max(1, pixels_per_row * self.dim * 8))
+
+    def write(self, filename):
+        self.ensure_loaded()
+        self._require_full_data("Writing")
+
+        PPM.write_ppm_from_data(
+            filename,
+            self.data,
+            self.width,
+            self.height,
+            self.dim,
+            self.ordered,
+            self.version,
+        )
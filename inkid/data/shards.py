@@ -0,0 +1,207 @@
+"""Datasets exported to fixed-size shards for streaming training.
+
+A shard directory holds an index.json and, for each shard, one .npy file
+per array: the subvolumes as uint16, the feature metadata and any
+labels. Shards are written by ShardWriter, e.g. from
+inkid/scripts/generate_subvolumes.py --shards, and read back
+sequentially by ShardDataset without loading any volume.
+
+"""
+
+import json
+import os
+import random
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+
+from .dataset import FeatureMetadata, uint16_to_value_range, value_range_to_uint16
+
+# Bump when the layout of shard directories changes
+SHARD_FORMAT_VERSION = 1
+SHARD_INDEX = "index.json"
+
+
+class ShardWriter:
+    """Write collated dataset batches to fixed-size shards in a directory.
+
+    Batches are buffered until a shard is full, so shards all hold
+    shard_size items except for the last. The index is written by
+    close(), or on leaving a with block.
+
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        shard_size: int = 1024,
+        value_range: Tuple[float, float] = (-1, 1),
+        source_json: Optional[dict] = None,
+    ) -> None:
+        """Start writing shards to directory.
+
+        Args:
+            directory: Where to write the shards and index.
+            shard_size: Number of items per shard.
+            value_range: The range the subvolume values were sampled into.
+            source_json: The data sources of the batches, recorded in the index.
+
+        """
+        self.directory = directory
+        self.shard_size = shard_size
+        self.value_range = value_range
+        self.source_json = source_json or {}
+        self._buffers: Dict[str, List[np.ndarray]] = dict()
+        self._buffered = 0
+        self._arrays: Dict[str, dict] = dict()
+        self._shards: List[dict] = list()
+        os.makedirs(directory, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+    def write(self, batch: dict) -> None:
+        """Add a batch collated by inkid.data.collate_features()."""
+        metadata = batch["feature_metadata"]
+        arrays = {
+            "feature": value_range_to_uint16(batch["feature"], self.value_range),
+            "source_index": np.asarray(metadata.source_index, dtype=np.int32),
+            "coordinates": np.asarray(metadata.coordinates, dtype=np.float32),
+        }
+        for key, value in batch.items():
+            if key not in ("feature", "feature_metadata"):
+                arrays[key] = np.asarray(value)
+        for key, array in arrays.items():
+            self._arrays.setdefault(
+                key, dict(dtype=array.dtype.str, shape=list(array.shape[1:]))
+            )
+            self._buffers.setdefault(key, []).append(array)
+        self._buffered += len(arrays["feature"])
+        while self._buffered >= self.shard_size:
+            self._write_shard(self.shard_size)
+
+    def _write_shard(self, length: int) -> None:
+        prefix = f"shard-{len(self._shards):05d}"
+        for key, buffer in self._buffers.items():
+            array = np.concatenate(buffer)
+            np.save(os.path.join(self.directory, f"{prefix}-{key}.npy"), array[:length])
+            self._buffers[key] = [array[length:]]
+        self._buffered -= length
+        self._shards.append(dict(prefix=prefix, length=length))
+
+    def close(self) -> None:
+        """Write the last, partial shard and the index."""
+        if self._buffered > 0:
+            self._write_shard(self._buffered)
+        index = dict(
+            format_version=SHARD_FORMAT_VERSION,
+            length=sum(shard["length"] for shard in self._shards),
+            value_range=list(self.value_range),
+            arrays=self._arrays,
+            shards=self._shards,
+            sources=self.source_json,
+        )
+        with open(os.path.join(self.directory, SHARD_INDEX), "w") as f:
+            json.dump(index, f, indent=4)
+
+
+class ShardDataset(torch.utils.data.IterableDataset):
+    """Stream the items of a shard directory written by ShardWriter.
+
+    Each shard is memory mapped and read in order, and no volume is
+    loaded. Subvolumes are converted from uint16 one item at a time as
+    they are yielded, so a shard is never held in memory as float32.
+    With DataLoader workers, each worker reads a separate subset of the
+    shards. Items are dicts like those of inkid.data.Dataset, to be
+    batched with inkid.data.collate_features().
+
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        shuffle: bool = False,
+        label_types: Optional[List[str]] = None,
+    ) -> None:
+        """Open the shard directory written by ShardWriter.
+
+        Args:
+            directory: The shard directory.
+            shuffle: Shuffle the order of the shards and of the items
+                within each shard, differently on every pass.
+            label_types: The labels to read, or None for all labels in the
+                shards. "autoencoded" needs no stored label and is skipped.
+
+        """
+        self.directory = directory
+        self.shuffle = shuffle
+        with open(os.path.join(directory, SHARD_INDEX)) as f:
+            self.index = json.load(f)
+        if self.index["format_version"] != SHARD_FORMAT_VERSION:
+            raise ValueError(
+                f"{directory} has shard format version {self.index['format_version']}, "
+                f"expected {SHARD_FORMAT_VERSION}"
+            )
+        available = [
+            key
+            for key in self.index["arrays"]
+            if key not in ("feature", "source_index", "coordinates")
+        ]
+        if label_types is None:
+            label_types = available
+        missing = [t for t in label_types if t not in available and t != "autoencoded"]
+        if len(missing) > 0:
+            raise ValueError(f"{directory} has no {', '.join(missing)} labels")
+        self.label_types = [t for t in label_types if t in available]
+
+    def __len__(self) -> int:
+        return self.index["length"]
+
+    def source_json(self) -> dict:
+        return self.index["sources"]
+
+    def _load(
+        self, shard: dict, key: str, mmap_mode: Optional[str] = None
+    ) -> np.ndarray:
+        return np.load(
+            os.path.join(self.directory, f"{shard['prefix']}-{key}.npy"),
+            mmap_mode=mmap_mode,
+        )
+
+    def __iter__(self):
+        shards = self.index["shards"]
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is not None:
+            shards = shards[worker_info.id :: worker_info.num_workers]
+        if self.shuffle:
+            shards = random.sample(shards, len(shards))
+        for shard in shards:
+            # The per-item metadata is small, the subvolumes and labels are mapped
+            features = self._load(shard, "feature", mmap_mode="r")
+            source_index = self._load(shard, "source_index").tolist()
+            coordinates = self._load(shard, "coordinates")
+            labels = {
+                label_type: self._load(shard, label_type, mmap_mode="r")
+                for label_type in self.label_types
+            }
+            order = range(shard["length"])
+            if self.shuffle:
+                order = random.sample(order, len(order))
+            for i in order:
+                item = {
+                    "feature_metadata": FeatureMetadata(
+                        source_index[i], coordinates[i]
+                    ),
+                    "feature": torch.from_numpy(
+                        uint16_to_value_range(features[i], self.index["value_range"])
+                    ),
+                }
+                for label_type, label in labels.items():
+                    # Copied out of the read-only map
+                    item[label_type] = torch.from_numpy(np.array(label[i]))
+                yield item
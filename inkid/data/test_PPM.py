@@ -0,0 +1,267 @@
+import functools
+import http.server
+import os
+import re
+import tempfile
+import threading
+import unittest
+
+import numpy as np
+
+import inkid
+
+
+def write_test_ppm(directory, height=12, width=17, dim=6, seed=0):
+    data = np.random.default_rng(seed).uniform(-100, 100, (height, width, dim))
+    path = os.path.join(directory, "test.ppm")
+    inkid.data.PPM.write_ppm_from_data(path, data, width, height, dim)
+    return path, data
+
+
+class RangeRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """Serves files, answering Range requests with 206 Partial Content."""
+
+    bytes_sent = 0
+
+    def log_message(self, *args):
+        pass
+
+    def send_head(self):
+        match = re.fullmatch(r"bytes=(\d+)-(\d+)", self.headers.get("Range", ""))
+        if match is None:
+            return super().send_head()
+        with open(self.translate_path(self.path), "rb") as f:
+            start, end = int(match.group(1)), int(match.group(2))
+            f.seek(start)
+            body = f.read(end - start + 1)
+        self.send_response(206)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        RangeRequestHandler.bytes_sent += len(body)
+        self.wfile.write(body)
+
+    def end_headers(self):
+        self.send_header("Accept-Ranges", "bytes")
+        super().end_headers()
+
+
+def serve_directory(directory, handler):
+    server = http.server.ThreadingHTTPServer(
+        ("127.0.0.1", 0), functools.partial(handler, directory=directory)
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class PPMTestCase(unittest.TestCase):
+    def test_header_reports_data_offset(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path, data = write_test_ppm(directory)
+            header = inkid.data.PPM.parse_ppm_header(path)
+            self.assertEqual(header["width"], 17)
+            self.assertEqual(header["height"], 12)
+            self.assertEqual(header["data_offset"], os.path.getsize(path) - data.nbytes)
+
+    def test_load_matches_written_data(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path, data = write_test_ppm(directory)
+            np.testing.assert_array_equal(inkid.data.PPM(path).data, data)
+
+    def test_load_any_dim(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path, data = write_test_ppm(directory, dim=3)
+            np.testing.assert_array_equal(inkid.data.PPM(path).data, data)
+
+    def test_memory_map_matches_written_data(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path, data = write_test_ppm(directory)
+            ppm = inkid.data.PPM(path, memory_map=True)
+            self.assertIsInstance(ppm.data.base, np.memmap)
+            np.testing.assert_array_equal(ppm.data, data)
+            self.assertFalse(inkid.data.PPM(path, memory_map="r").data.flags.writeable)
+            del ppm
+
+    def test_memory_map_modifications_stay_in_memory(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path, data = write_test_ppm(directory)
+            ppm = inkid.data.PPM(path, memory_map=True)
+            ppm.translate(5, 6, 7)
+            expected = data.copy()
+            expected[:, :, 0:3] += [5, 6, 7]
+            np.testing.assert_array_equal(ppm.data, expected)
+            np.testing.assert_array_equal(inkid.data.PPM(path).data, data)
+            del ppm
+
+    def test_truncated_file_raises(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path, data = write_test_ppm(directory)
+            with open(path, "r+b") as f:
+                f.truncate(os.path.getsize(path) - 8)
+            with self.assertRaises(ValueError):
+                inkid.data.PPM(path)
+
+    def test_chunked_write_matches_data(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path, data = write_test_ppm(directory)
+            chunked_path = os.path.join(directory, "chunked.ppm")
+            with open(chunked_path, "wb") as f:
+                inkid.data.PPM.write_ppm_header(f, 17, 12, 6)
+                inkid.data.PPM.write_ppm_payload(f, data, 17, 12, 6, chunk_bytes=1000)
+            with open(path, "rb") as a, open(chunked_path, "rb") as b:
+                self.assertEqual(a.read(), b.read())
+
+    def test_write_round_trips(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path, data = write_test_ppm(directory)
+            ppm = inkid.data.PPM(path, memory_map=True)
+            copy_path = os.path.join(directory, "copy.ppm")
+            ppm.write(copy_path)
+            np.testing.assert_array_equal(inkid.data.PPM(copy_path).data, data)
+            del ppm
+
+    def test_translate_skips_empty_pixels(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path, data = write_test_ppm(directory)
+            data[3, 4] = 0
+            inkid.data.PPM.write_ppm_from_data(path, data, 17, 12, 6)
+            ppm = inkid.data.PPM(path)
+            ppm.translate(1, -2, 3)
+            expected = data.copy()
+            expected[:, :, 0:3] += [1, -2, 3]
+            expected[3, 4] = 0
+            np.testing.assert_array_equal(ppm.data, expected)
+
+    def test_translate_memory_map_in_place(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path, data = write_test_ppm(directory)
+            ppm = inkid.data.PPM(path, memory_map="r+")
+            ppm.translate(5, 6, 7)
+            ppm.data.base.flush()
+            del ppm
+            expected = data.copy()
+            expected[:, :, 0:3] += [5, 6, 7]
+            np.testing.assert_array_equal(inkid.data.PPM(path).data, expected)
+
+    def test_scale_down_by(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path, data = write_test_ppm(directory)
+            for memory_map in (False, True):
+                ppm = inkid.data.PPM(path, memory_map=memory_map)
+                ppm.scale_down_by(5)
+                self.assertEqual((ppm.height, ppm.width), (2, 3))
+                np.testing.assert_array_equal(ppm.data, data[0:10:5, 0:15:5])
+                del ppm
+
+    def test_scale_down_by_average(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path, data = write_test_ppm(directory)
+            data[0:2, 0:2] = 0
+            data[0, 2] = 0
+            inkid.data.PPM.write_ppm_from_data(path, data, 17, 12, 6)
+            ppm = inkid.data.PPM(path)
+            ppm.scale_down_by(2, average=True)
+            self.assertEqual(ppm.data.shape, (6, 8, 6))
+            np.testing.assert_array_equal(ppm.data[0, 0], 0)
+            block = data[0:2, 2:4].reshape(4, 6)[1:]
+            np.testing.assert_allclose(ppm.data[0, 1, 0:3], block[:, 0:3].mean(axis=0))
+            normal = block[:, 3:6].mean(axis=0)
+            np.testing.assert_allclose(
+                ppm.data[0, 1, 3:6], normal / np.linalg.norm(normal)
+            )
+
+    def test_compact_matches_full(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path, data = write_test_ppm(directory)
+            data[:, :, 3:6] /= np.linalg.norm(data[:, :, 3:6], axis=2, keepdims=True)
+            data[2, 9] = 0
+            inkid.data.PPM.write_ppm_from_data(path, data, 17, 12, 6)
+            full = inkid.data.PPM(path)
+            for quantize_normals, atol in ((False, 1e-6), (True, 1e-4)):
+                compact = inkid.data.PPM(
+                    path, compact=True, quantize_normals=quantize_normals
+                )
+                self.assertIsNone(compact.data)
+                self.assertEqual(compact.points.dtype, np.float32)
+                np.testing.assert_array_equal(compact.valid_mask(), full.valid_mask())
+                self.assertFalse(compact.is_valid(9, 2))
+                self.assertTrue(compact.is_valid(8, 2))
+                xs, ys = np.array([0, 16, 9, 3]), np.array([0, 11, 2, 7])
+                points, normals = compact.get_points_and_normals(xs, ys)
+                np.testing.assert_allclose(points, data[ys, xs, 0:3], rtol=1e-6)
+                np.testing.assert_allclose(normals, data[ys, xs, 3:6], atol=atol)
+                point, normal = compact.get_point_and_normal(16, 11)
+                np.testing.assert_allclose(point, data[11, 16, 0:3], rtol=1e-6)
+                np.testing.assert_allclose(normal, data[11, 16, 3:6], atol=atol)
+
+    def test_compact_translate(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path, data = write_test_ppm(directory)
+            data[3, 4] = 0
+            inkid.data.PPM.write_ppm_from_data(path, data, 17, 12, 6)
+            ppm = inkid.data.PPM(path, compact=True)
+            ppm.translate(1, -2, 3)
+            expected = data[:, :, 0:3] + [1, -2, 3]
+            expected[3, 4] = 0
+            np.testing.assert_allclose(ppm.points, expected, rtol=1e-6)
+            with self.assertRaises(ValueError):
+                ppm.write(os.path.join(directory, "copy.ppm"))
+
+    def test_compact_planes_are_cached(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path, data = write_test_ppm(directory)
+            cache_dir = inkid.data.get_cache_dir()
+            inkid.data.set_cache_dir(os.path.join(directory, "cache"))
+            try:
+                built = inkid.data.PPM(path, compact=True)
+                self.assertNotIsInstance(built.points, np.memmap)
+                cached = inkid.data.PPM(path, compact=True)
+                self.assertIsInstance(cached.points, np.memmap)
+                np.testing.assert_array_equal(cached.points, built.points)
+                np.testing.assert_array_equal(cached.normals, built.normals)
+                np.testing.assert_array_equal(cached.valid_mask(), built.valid_mask())
+                # Translating a cached PPM must not change the cache
+                cached.translate(1, 1, 1)
+                reopened = inkid.data.PPM(path, compact=True)
+                np.testing.assert_array_equal(reopened.points, built.points)
+                # Rewriting the PPM invalidates its cache entries
+                data[0, 0, 0] += 1
+                inkid.data.PPM.write_ppm_from_data(path, data, 17, 12, 6)
+                os.utime(path, ns=(0, 0))
+                rewritten = inkid.data.PPM(path, compact=True)
+                self.assertNotIsInstance(rewritten.points, np.memmap)
+                self.assertEqual(rewritten.points[0, 0, 0], np.float32(data[0, 0, 0]))
+                del built, cached, reopened, rewritten
+            finally:
+                inkid.data.set_cache_dir(cache_dir)
+
+    def test_url_reads_only_requested_ranges(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path, data = write_test_ppm(directory, height=100, width=100)
+            server = serve_directory(directory, RangeRequestHandler)
+            try:
+                url = f"http://127.0.0.1:{server.server_port}/test.ppm"
+                RangeRequestHandler.bytes_sent = 0
+                ppm = inkid.data.PPM(url, lazy_load=True)
+                self.assertEqual(ppm.width, 100)
+                self.assertLess(RangeRequestHandler.bytes_sent, data.nbytes // 10)
+                ppm.ensure_loaded()
+                np.testing.assert_array_equal(ppm.data, data)
+            finally:
+                server.shutdown()
+                server.server_close()
+
+    def test_url_without_range_support(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path, data = write_test_ppm(directory)
+            server = serve_directory(directory, http.server.SimpleHTTPRequestHandler)
+            try:
+                url = f"http://127.0.0.1:{server.server_port}/test.ppm"
+                ppm = inkid.data.PPM(url)
+                np.testing.assert_array_equal(ppm.data, data)
+            finally:
+                server.shutdown()
+                server.server_close()
+
+
+if __name__ == "__main__":
+    unittest.main()
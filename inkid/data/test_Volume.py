@@ -1,8 +1,41 @@
+import fcntl
+import json
+import os
+import pickle
+import random
+import subprocess
+import sys
+import tempfile
 import unittest
+import unittest.mock
+
+import numpy as np
+from PIL import Image
+import torch
+import torchvision
 
 import inkid
 
 
+def write_test_volume(directory, shape=(70, 90, 130), seed=0):
+    """Write a random (z, y, x) uint16 volume as .tif slices with a meta.json, and return the data."""
+    rng = np.random.default_rng(seed)
+    data = rng.integers(0, np.iinfo(np.uint16).max, size=shape, dtype=np.uint16)
+    for z in range(shape[0]):
+        Image.fromarray(data[z]).save(os.path.join(directory, f"{z:03}.tif"))
+    with open(os.path.join(directory, "meta.json"), "w") as f:
+        json.dump(
+            {
+                "slices": shape[0],
+                "height": shape[1],
+                "width": shape[2],
+                "voxelsize": 10.0,
+            },
+            f,
+        )
+    return data
+
+
 class VectorMathTestCase(unittest.TestCase):
     def test_get_component_vectors_from_normal_trivial(self):
         normal = {"x": 0, "y": 0, "z": 1}
@@ -41,5 +74,480 @@ class VectorMathTestCase(unittest.TestCase):
         )
 
 
+class VolumeStorageTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.path = self._tmp_dir.name
+        self.data = write_test_volume(self.path)
+
+    def tearDown(self) -> None:
+        self._tmp_dir.cleanup()
+
+    def test_parallel_load(self):
+        bounding_box = (5, 3, 2, 125, 88, 68)
+        for num_workers in [1, 3]:
+            volume = inkid.data.Volume(
+                self.path, bounding_box=bounding_box, num_workers=num_workers
+            )
+            for z in [0, 31, 65]:
+                np.testing.assert_array_equal(
+                    volume.z_slice(z), self.data[z + 2, 3:88, 5:125]
+                )
+
+    def test_uncompressed_and_compressed_slices_match(self):
+        bounding_box = (5, 3, 2, 125, 88, 68)
+        with tempfile.TemporaryDirectory() as compressed_path:
+            for z in range(self.data.shape[0]):
+                Image.fromarray(self.data[z]).save(
+                    os.path.join(compressed_path, f"{z:03}.tif"),
+                    compression="tiff_lzw",
+                )
+            with open(os.path.join(self.path, "meta.json")) as src, open(
+                os.path.join(compressed_path, "meta.json"), "w"
+            ) as dst:
+                dst.write(src.read())
+            raw = inkid.data.Volume(self.path, bounding_box=bounding_box)
+            decoded = inkid.data.Volume(compressed_path, bounding_box=bounding_box)
+            for z in [0, 31, 65]:
+                np.testing.assert_array_equal(raw.z_slice(z), decoded.z_slice(z))
+                np.testing.assert_array_equal(
+                    raw.z_slice(z), self.data[z + 2, 3:88, 5:125]
+                )
+
+    def test_chunked_matches_memory(self):
+        bounding_box = (5, 3, 2, 125, 88, 68)
+        memory = inkid.data.Volume(self.path, bounding_box=bounding_box)
+        chunked = inkid.data.Volume(
+            self.path, bounding_box=bounding_box, storage="chunked"
+        )
+        self.assertTrue(os.path.exists(chunked.brick_cache_path()))
+        self.assertEqual(memory.shape(), chunked.shape())
+        np.testing.assert_array_equal(chunked.z_slice(65), self.data[67, 3:88, 5:125])
+        np.testing.assert_array_equal(chunked.x_slice(0), memory.x_slice(0))
+        np.testing.assert_array_equal(chunked.y_slice(-1), memory.y_slice(-1))
+        for method in ["nearest_neighbor", "interpolated"]:
+            args = dict(
+                center=(60.3, 40.7, 30.2),
+                normal=(0.2, -0.3, 0.9),
+                shape_voxels=(16, 16, 16),
+                shape_microns=None,
+                move_along_normal=0,
+                jitter_max=0,
+                augment_subvolume=False,
+                method=method,
+            )
+            np.testing.assert_array_equal(
+                memory.get_subvolume(**args), chunked.get_subvolume(**args)
+            )
+        # A second volume reuses the existing cache
+        mtime = os.path.getmtime(chunked.brick_cache_path())
+        reopened = inkid.data.Volume(
+            self.path, bounding_box=bounding_box, storage="chunked"
+        )
+        self.assertEqual(mtime, os.path.getmtime(reopened.brick_cache_path()))
+        np.testing.assert_array_equal(reopened.z_slice(0), memory.z_slice(0))
+
+    def test_chunked_cache_tracks_slices(self):
+        chunked = inkid.data.Volume(self.path, storage="chunked")
+        first_cache = chunked.brick_cache_path()
+        # Replacing a slice selects a new cache and removes the stale one
+        self.data[10] = 0
+        Image.fromarray(self.data[10]).save(os.path.join(self.path, "010.tif"))
+        reopened = inkid.data.Volume(self.path, storage="chunked")
+        self.assertNotEqual(reopened.brick_cache_path(), first_cache)
+        self.assertFalse(os.path.exists(first_cache))
+        np.testing.assert_array_equal(reopened.z_slice(10), self.data[10])
+        self.assertEqual(
+            [f for f in os.listdir(self.path) if f.startswith(".")],
+            [os.path.basename(reopened.brick_cache_path())],
+        )
+
+    def test_data_version_tracks_slices(self):
+        volume = inkid.data.Volume(self.path, storage="lazy")
+        version = volume.data_version()
+        self.assertEqual(volume.data_version(), version)
+        slice_path = os.path.join(self.path, "005.tif")
+        stat = os.stat(slice_path)
+        # Touched after every other file of the volume
+        os.utime(slice_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**10))
+        self.assertNotEqual(volume.data_version(), version)
+
+    def test_chunked_cache_falls_back_when_volume_is_read_only(self):
+        mkstemp = tempfile.mkstemp
+
+        def read_only_mkstemp(*args, dir=None, **kwargs):
+            if dir == self.path:
+                raise PermissionError(f"{dir} is read-only")
+            return mkstemp(*args, dir=dir, **kwargs)
+
+        cache_dir = inkid.data.get_cache_dir()
+        with tempfile.TemporaryDirectory() as directory:
+            with unittest.mock.patch("tempfile.mkstemp", read_only_mkstemp):
+                try:
+                    inkid.data.set_cache_dir(directory)
+                    chunked = inkid.data.Volume(self.path, storage="chunked")
+                    self.assertEqual(
+                        os.path.dirname(chunked.brick_cache_path()), directory
+                    )
+                    np.testing.assert_array_equal(chunked.z_slice(3), self.data[3])
+                    # Without a cache directory the volume is loaded into memory
+                    inkid.data.set_cache_dir(None)
+                    memory = inkid.data.Volume(self.path, storage="chunked")
+                    self.assertIsNone(memory.brick_cache_path())
+                    np.testing.assert_array_equal(memory.z_slice(3), self.data[3])
+                finally:
+                    inkid.data.set_cache_dir(cache_dir)
+
+    def test_lazy_loads_only_needed_slices(self):
+        memory = inkid.data.Volume(self.path)
+        slice_bytes = self.data.shape[1] * self.data.shape[2] * 2
+        lazy = inkid.data.Volume(
+            self.path, storage="lazy", slice_cache_bytes=20 * slice_bytes
+        )
+        self.assertEqual(lazy.cached_slices(), [])
+        args = dict(
+            center=(60.3, 40.7, 30.2),
+            normal=(0.2, -0.3, 0.9),
+            shape_voxels=(8, 8, 8),
+            shape_microns=None,
+            move_along_normal=0,
+            jitter_max=0,
+            augment_subvolume=False,
+        )
+        for method in ["nearest_neighbor", "interpolated"]:
+            np.testing.assert_array_equal(
+                memory.get_subvolume(method=method, **args),
+                lazy.get_subvolume(method=method, **args),
+            )
+        self.assertTrue(0 < len(lazy.cached_slices()) < 20)
+        self.assertTrue(all(20 <= z <= 40 for z in lazy.cached_slices()))
+        # Reading every slice evicts down to the budget on the next request
+        np.testing.assert_array_equal(lazy.x_slice(7), self.data[:, :, 7])
+        np.testing.assert_array_equal(lazy.z_slice(3), self.data[3])
+        self.assertEqual(len(lazy.cached_slices()), 20)
+        self.assertIn(3, lazy.cached_slices())
+
+    def test_shared_volume_removes_files_of_killed_processes(self):
+        shared_dir = os.path.dirname(
+            inkid.data.Volume(self.path, storage="shared").shared_path()
+        )
+        # Files are judged by their lock, not by the process ID in their name
+        pid = os.getpid()
+        stale_path = os.path.join(shared_dir, f"inkid_volume_{pid}_stale.npy")
+        live_path = os.path.join(shared_dir, f"inkid_volume_{pid}_live.npy")
+        empty_path = os.path.join(shared_dir, f"inkid_volume_{pid}_empty.npy")
+        lock = None
+        try:
+            for path in (stale_path, live_path):
+                np.save(path, np.zeros(1))
+            open(empty_path, "w").close()
+            lock = os.open(live_path, os.O_RDONLY)
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            shared = inkid.data.Volume(self.path, storage="shared")
+            self.assertFalse(os.path.exists(stale_path))
+            self.assertTrue(os.path.exists(live_path))
+            self.assertTrue(os.path.exists(empty_path))
+            self.assertTrue(os.path.exists(shared.shared_path()))
+            # Another process sees the file of this one as live
+            subprocess.run(
+                [
+                    sys.executable,
+                    "-c",
+                    "import inkid, sys; "
+                    "inkid.data.Volume(sys.argv[1], storage='shared')",
+                    self.path,
+                ],
+                check=True,
+            )
+            self.assertTrue(os.path.exists(shared.shared_path()))
+        finally:
+            if lock is not None:
+                os.close(lock)
+            for path in (stale_path, live_path, empty_path):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def test_shared_volume_attaches_when_unpickled(self):
+        bounding_box = (5, 3, 2, 125, 88, 68)
+        shared = inkid.data.Volume(
+            self.path, bounding_box=bounding_box, storage="shared"
+        )
+        self.assertTrue(os.path.exists(shared.shared_path()))
+        # The unpickled copy must not decode any slices
+        for filename in os.listdir(self.path):
+            if filename.endswith(".tif"):
+                os.remove(os.path.join(self.path, filename))
+        attached = pickle.loads(pickle.dumps(shared))
+        self.assertEqual(attached.shared_path(), shared.shared_path())
+        self.assertEqual(attached.shape(), shared.shape())
+        np.testing.assert_array_equal(attached.z_slice(65), self.data[67, 3:88, 5:125])
+        args = dict(
+            center=(60.3, 40.7, 30.2),
+            normal=(0.2, -0.3, 0.9),
+            shape_voxels=(16, 16, 16),
+            shape_microns=None,
+            move_along_normal=0,
+            jitter_max=0,
+            augment_subvolume=False,
+            method="interpolated",
+        )
+        np.testing.assert_array_equal(
+            shared.get_subvolume(**args), attached.get_subvolume(**args)
+        )
+
+    def test_get_subvolumes_matches_get_subvolume(self):
+        volume = inkid.data.Volume(self.path)
+        rng = np.random.default_rng(1)
+        centers = rng.uniform((0, 0, 0), (130, 90, 70), size=(12, 3))
+        normals = rng.normal(size=(12, 3))
+        normals[3] = 0
+        args = dict(
+            shape_voxels=(6, 8, 10),
+            shape_microns=(60, 100, 100),
+            move_along_normal=1.5,
+            jitter_max=2,
+        )
+        for method in ["nearest_neighbor", "interpolated"]:
+            random.seed(7)
+            expected = np.stack(
+                [
+                    volume.get_subvolume(
+                        center=center,
+                        normal=normal,
+                        method=method,
+                        augment_subvolume=False,
+                        **args,
+                    )
+                    for center, normal in zip(centers, normals)
+                ]
+            )
+            random.seed(7)
+            batch = volume.get_subvolumes(centers, normals, method=method, **args)
+            self.assertEqual(batch.dtype, np.uint16)
+            np.testing.assert_array_equal(batch, expected)
+            random.seed(7)
+            out = np.full((12, 1, 6, 8, 10), -1, dtype=np.float32)
+            self.assertIs(
+                volume.get_subvolumes(centers, normals, method=method, out=out, **args),
+                out,
+            )
+            np.testing.assert_array_equal(out, expected.astype(np.float32))
+
+    def test_threaded_sampling_matches_serial(self):
+        volume = inkid.data.Volume(self.path)
+        rng = np.random.default_rng(2)
+        centers = rng.uniform((0, 0, 0), (130, 90, 70), size=(9, 3))
+        normals = rng.normal(size=(9, 3))
+        args = dict(shape_voxels=(7, 8, 9), shape_microns=None)
+        try:
+            for method in ["nearest_neighbor", "interpolated"]:
+                inkid.data.set_sampling_threads(1)
+                serial = volume.get_subvolumes(centers, normals, method=method, **args)
+                serial_single = volume.get_subvolumes(
+                    centers[:1], normals[:1], method=method, **args
+                )
+                inkid.data.set_sampling_threads(3)
+                np.testing.assert_array_equal(
+                    volume.get_subvolumes(centers, normals, method=method, **args),
+                    serial,
+                )
+                np.testing.assert_array_equal(
+                    volume.get_subvolumes(
+                        centers[:1], normals[:1], method=method, **args
+                    ),
+                    serial_single,
+                )
+        finally:
+            inkid.data.set_sampling_threads(None)
+
+    def test_sampling_threads_are_divided_between_workers(self):
+        class ThreadsDataset(torch.utils.data.Dataset):
+            def __len__(self):
+                return 4
+
+            def __getitem__(self, item):
+                return inkid.data.get_sampling_threads()
+
+        cpus = inkid.data.get_sampling_threads()
+        threads = torch.utils.data.DataLoader(ThreadsDataset(), num_workers=2)
+        self.assertEqual(
+            [int(t) for t in threads], [max(1, cpus // 2)] * len(ThreadsDataset())
+        )
+        try:
+            inkid.data.set_sampling_threads(3)
+            self.assertEqual(inkid.data.get_sampling_threads(), 3)
+        finally:
+            inkid.data.set_sampling_threads(None)
+        self.assertEqual(inkid.data.get_sampling_threads(), cpus)
+
+    def test_interpolation_matches_trilinear_reference(self):
+        padded = np.pad(self.data.astype(np.float64), 1)
+
+        def voxel(x, y, z):
+            # Zero outside the volume, as in the kernel
+            inside = (
+                (x >= -1)
+                & (y >= -1)
+                & (z >= -1)
+                & (x <= self.data.shape[2])
+                & (y <= self.data.shape[1])
+                & (z <= self.data.shape[0])
+            )
+            x, y, z = [
+                np.clip(a + 1, 0, n - 1) for a, n in zip((x, y, z), padded.shape[::-1])
+            ]
+            return np.where(inside, padded[z, y, x], 0)
+
+        def reference(center, shape):
+            # With normal (0, 0, 1) the subvolume axes are the volume axes
+            offsets = [np.trunc(np.arange(n) - (n - 1) / 2 + 0.5) for n in shape]
+            z, y, x = np.meshgrid(
+                *[c + o for c, o in zip(center[::-1], offsets)], indexing="ij"
+            )
+            x0, y0, z0 = np.floor(x), np.floor(y), np.floor(z)
+            dx, dy, dz = x - x0, y - y0, z - z0
+            x0, y0, z0 = x0.astype(int), y0.astype(int), z0.astype(int)
+            c00 = voxel(x0, y0, z0) * (1 - dx) + voxel(x0 + 1, y0, z0) * dx
+            c10 = voxel(x0, y0 + 1, z0) * (1 - dx) + voxel(x0 + 1, y0 + 1, z0) * dx
+            c01 = voxel(x0, y0, z0 + 1) * (1 - dx) + voxel(x0 + 1, y0, z0 + 1) * dx
+            c11 = (
+                voxel(x0, y0 + 1, z0 + 1) * (1 - dx)
+                + voxel(x0 + 1, y0 + 1, z0 + 1) * dx
+            )
+            c0 = c00 * (1 - dy) + c10 * dy
+            c1 = c01 * (1 - dy) + c11 * dy
+            return (c0 * (1 - dz) + c1 * dz).astype(np.uint16)
+
+        shape = (6, 7, 8)
+        for storage in ["memory", "chunked"]:
+            volume = inkid.data.Volume(self.path, storage=storage)
+            # Inside the volume, and overlapping the low and high edges
+            for center in [
+                (60.25, 40.5, 30.75),
+                (1.25, 2.5, 0.75),
+                (128.5, 88.25, 68.5),
+            ]:
+                subvolume = volume.get_subvolume(
+                    center=center,
+                    normal=(0, 0, 1),
+                    shape_voxels=shape,
+                    shape_microns=None,
+                    move_along_normal=0,
+                    jitter_max=0,
+                    augment_subvolume=False,
+                    method="interpolated",
+                )
+                np.testing.assert_array_equal(subvolume[0], reference(center, shape))
+
+    def test_value_range_matches_normalized_pipeline(self):
+        volume = inkid.data.Volume(self.path)
+        args = dict(
+            center=(20.3, 88.9, 3.2),
+            normal=(0.3, 0.1, -0.8),
+            shape_voxels=(8, 8, 8),
+            shape_microns=None,
+            move_along_normal=0,
+            jitter_max=0,
+            augment_subvolume=False,
+        )
+        for method in ["nearest_neighbor", "interpolated"]:
+            raw = volume.get_subvolume(method=method, **args)
+            scaled = inkid.util.uint16_to_float32_normalized_0_1(raw)
+            np.testing.assert_array_equal(
+                volume.get_subvolume(method=method, value_range=(0, 1), **args), scaled
+            )
+            normalized = torchvision.transforms.Normalize((0.5,), (0.5,))(
+                torch.from_numpy(scaled)
+            ).numpy()
+            feature = volume.get_subvolume(method=method, value_range=(-1, 1), **args)
+            self.assertEqual(feature.dtype, np.float32)
+            np.testing.assert_array_equal(feature, normalized)
+
+    def test_grid_sample_matches_interpolated(self):
+        rng = np.random.default_rng(3)
+        # Including centers near and past the edges of the volume
+        centers = rng.uniform((-5, -5, -5), (135, 95, 75), size=(10, 3))
+        normals = rng.normal(size=(10, 3))
+        args = dict(shape_voxels=(8, 10, 12), shape_microns=(100, 80, 120))
+        for storage in ["memory", "lazy"]:
+            volume = inkid.data.Volume(self.path, storage=storage)
+            interpolated = volume.get_subvolumes(
+                centers, normals, method="interpolated", **args
+            )
+            grid_sampled = volume.get_subvolumes(
+                centers, normals, method="grid_sample", **args
+            )
+            self.assertEqual(grid_sampled.dtype, np.uint16)
+            # Positions are summed in a different order, which can move a value across an integer
+            np.testing.assert_allclose(grid_sampled, interpolated, atol=1, rtol=0)
+            features = volume.get_subvolumes(
+                centers, normals, method="grid_sample", value_range=(-1, 1), **args
+            )
+            np.testing.assert_allclose(
+                features, grid_sampled / np.iinfo(np.uint16).max * 2 - 1, atol=1e-6
+            )
+
+    def test_axis_aligned_subvolumes(self):
+        padded = np.pad(self.data, 2)
+        shape = (5, 6, 7)
+        offsets = [np.trunc(np.arange(n) - (n - 1) / 2 + 0.5) for n in shape]
+
+        def reference(center, axes, signs, method):
+            # Volume index along each subvolume axis (z, y, x), rounded as by the kernels
+            rounding = 0.5 if method == "nearest_neighbor" else 0
+            idx = [
+                np.trunc(center[axis] + sign * offset + rounding).astype(int)
+                for axis, sign, offset in zip(axes, signs, offsets)
+            ]
+            grids = np.meshgrid(*idx, indexing="ij")
+            coords = [None] * 3
+            for axis, grid in zip(axes, grids):
+                coords[axis] = grid
+            x, y, z = coords
+            inside = (
+                (x >= 0)
+                & (y >= 0)
+                & (z >= 0)
+                & (x < self.data.shape[2])
+                & (y < self.data.shape[1])
+                & (z < self.data.shape[0])
+            )
+            z, y, x = [
+                np.clip(c + 2, 0, n - 1) for c, n in zip((z, y, x), padded.shape)
+            ]
+            return np.where(inside, padded[z, y, x], 0)
+
+        volume = inkid.data.Volume(self.path)
+        for normal, axes, signs in [
+            # Subvolume (z, y, x) axes along volume axes (x=0, y=1, z=2)
+            ((0, 0, 1), (2, 1, 0), (1, 1, 1)),
+            ((0, 0, -1), (2, 0, 1), (-1, 1, 1)),
+            ((1, 0, 0), (0, 1, 2), (1, 1, -1)),
+        ]:
+            # Inside the volume, and overlapping the low and high edges
+            for center in [(60, 40, 30), (1, 0, 2), (128, 89, 68)]:
+                for method in ["nearest_neighbor", "interpolated"]:
+                    subvolume = volume.get_subvolume(
+                        center=center,
+                        normal=normal,
+                        shape_voxels=shape,
+                        shape_microns=None,
+                        move_along_normal=0,
+                        jitter_max=0,
+                        augment_subvolume=False,
+                        method=method,
+                    )
+                    np.testing.assert_array_equal(
+                        subvolume[0], reference(center, axes, signs, method)
+                    )
+
+    def test_pickle_keeps_storage(self):
+        for storage in ["memory", "chunked", "lazy"]:
+            volume = inkid.data.Volume(self.path, storage=storage)
+            copy = pickle.loads(pickle.dumps(volume))
+            self.assertEqual(copy.shape(), volume.shape())
+            np.testing.assert_array_equal(copy.y_slice(11), self.data[:, 11, :])
+
+
 if __name__ == "__main__":
     unittest.main()
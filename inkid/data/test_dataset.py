@@ -1,9 +1,68 @@
+import itertools
+import multiprocessing
 import os
+import random
+import subprocess
+import sys
+import tempfile
 import unittest
+import unittest.mock
+
+import numpy as np
+import torch
 
 import inkid
 
 
+class SettingsDataset(torch.utils.data.Dataset):
+    """Reports the inkid.data settings of the process loading each item."""
+
+    def __len__(self):
+        return 1
+
+    def __getitem__(self, item):
+        return inkid.data.get_cache_dir(), inkid.data.get_sampling_threads()
+
+
+def reference_points_list(region):
+    """The points of RegionSource.update_points_list(), computed pixel by pixel."""
+    sampler = region.sampler
+    positive_points, negative_points, unlabeled_points = [], [], []
+    x0, y0, x1, y1 = region.bounding_box
+    for y in range(y0, y1, sampler.grid_spacing):
+        for x in range(x0, x1, sampler.grid_spacing):
+            if not region.is_on_surface(x, y):
+                continue
+            if sampler.specify_inkness is not None:
+                if sampler.specify_inkness != region.is_ink(x, y):
+                    continue
+            if sampler.ambiguous_labels_mask is not None:
+                if sampler.ambiguous_labels_mask[y, x] != 0:
+                    continue
+            if (
+                sampler.oversampling_ink_ratio is not None
+                or sampler.undersampling_ink_ratio is not None
+            ):
+                if region.is_ink(x, y):
+                    positive_points.append((x, y))
+                else:
+                    negative_points.append((x, y))
+            else:
+                unlabeled_points.append((x, y))
+    if sampler.undersampling_ink_ratio is not None:
+        ratio = sampler.undersampling_ink_ratio
+        k = int(len(positive_points) * (1.0 - ratio) / ratio)
+        return positive_points + random.choices(negative_points, k=k)
+    if sampler.oversampling_ink_ratio is not None:
+        ratio = sampler.oversampling_ink_ratio
+        positives_needed = int(len(negative_points) * ratio / (1.0 - ratio))
+        reps = max(1, positives_needed // len(positive_points))
+        if positives_needed < len(positive_points):
+            reps = 1
+        return [p for p in positive_points for _ in range(reps)] + negative_points
+    return unlabeled_points
+
+
 class RegionSourceTestCase(unittest.TestCase):
     def test_multi_channel_ink_labels(self):
         test_file_path = os.path.join(
@@ -17,6 +76,563 @@ class RegionSourceTestCase(unittest.TestCase):
         self.assertTrue(region_source.is_ink(272, 148))
         self.assertFalse(region_source.is_ink(40, 40))
 
+    def test_points_list_matches_reference(self):
+        test_file_path = os.path.join(
+            os.path.dirname(inkid.__file__),
+            "examples",
+            "DummyTest.volpkg",
+            "working",
+            "DummyTestMultiChannelInkLabel.json",
+        )
+        region_source = inkid.data.RegionSource(test_file_path, lazy_load=True)
+        samplers = [
+            inkid.data.RegionPointSampler(),
+            inkid.data.RegionPointSampler(grid_spacing=3, specify_inkness=True),
+            inkid.data.RegionPointSampler(grid_spacing=2, specify_inkness=False),
+            inkid.data.RegionPointSampler(ambiguous_ink_labels_filter_radius=3),
+            inkid.data.RegionPointSampler(undersampling_ink_ratio=0.6),
+            inkid.data.RegionPointSampler(oversampling_ink_ratio=0.5),
+        ]
+        for sampler in samplers:
+            region_source.sampler = sampler
+            region_source.bounding_box = (0, 3, 290, 200)
+            random.seed(0)
+            region_source.update_points_list()
+            random.seed(0)
+            reference = reference_points_list(region_source)
+            self.assertEqual(region_source._points.dtype, np.int32)
+            self.assertEqual(
+                region_source._points.tolist(), [list(p) for p in reference]
+            )
+
+    def test_label_patches(self):
+        test_file_path = os.path.join(
+            os.path.dirname(inkid.__file__),
+            "examples",
+            "DummyTest.volpkg",
+            "working",
+            "DummyTestMultiChannelInkLabel.json",
+        )
+        region_source = inkid.data.RegionSource(test_file_path, lazy_load=True)
+        height, width = region_source._ink_label.shape
+        points = np.array(
+            [
+                (0, 0),
+                (width - 1, height - 1),
+                (320, 200),
+                (-3, 5),
+                (width + 2, 10),
+                # Outside of the image, with patches that may overlap its edges
+                (-1, 7),
+                (9, -2),
+                (width, height),
+                (width + 1, height // 2),
+                (-100, height + 100),
+            ]
+        )
+        for shape in [(1, 1), (4, 4), (5, 3)]:
+            ink = region_source.points_to_ink_classes_labels(points, shape)
+            rgb = region_source.points_to_rgb_values_labels(points, shape)
+            self.assertEqual(ink.dtype, torch.int64)
+            self.assertEqual(rgb.shape, (len(points), 3) + shape)
+            for i, (x, y) in enumerate(points):
+                for y_idx, x_idx in np.ndindex(shape):
+                    y_s = y - shape[0] // 2 + y_idx
+                    x_s = x - shape[1] // 2 + x_idx
+                    expected_ink, expected_rgb = 0, np.zeros(3)
+                    if 0 <= y_s < height and 0 <= x_s < width:
+                        expected_ink = int(region_source.is_ink(x_s, y_s))
+                        expected_rgb = (
+                            region_source._rgb_label[y_s, x_s].astype(np.float32) / 255
+                        )
+                    self.assertEqual(ink[i, y_idx, x_idx], expected_ink)
+                    np.testing.assert_array_equal(rgb[i, :, y_idx, x_idx], expected_rgb)
+            self.assertTrue(
+                torch.equal(
+                    region_source.point_to_ink_classes_label(tuple(points[2]), shape),
+                    ink[2],
+                )
+            )
+
+    def test_store_predictions(self):
+        test_file_path = os.path.join(
+            os.path.dirname(inkid.__file__),
+            "examples",
+            "DummyTest.volpkg",
+            "working",
+            "DummyTestMultiChannelInkLabel.json",
+        )
+        region_source = inkid.data.RegionSource(test_file_path, lazy_load=True)
+        region_source.sampler = inkid.data.RegionPointSampler(grid_spacing=4)
+        predictions = np.zeros((3, 2, 1, 1))
+        predictions[:, 1] = [[[0.25]], [[0.5]], [[1.0]]]
+        region_source.store_predictions(
+            [10, 12, 0], [20, 20, 0], predictions, "ink_classes"
+        )
+        image = region_source._ink_classes_prediction_image
+        # 1x1 predictions fill a grid square, later predictions overwrite earlier ones
+        self.assertEqual(image[18, 8], int(0.25 * 65535))
+        self.assertEqual(image[21, 9], int(0.25 * 65535))
+        self.assertEqual(image[21, 10], int(0.5 * 65535))
+        self.assertEqual(image[21, 13], int(0.5 * 65535))
+        self.assertEqual(image[21, 14], 0)
+        # Clipped at the edges of the PPM
+        self.assertEqual(image[1, 1], 65535)
+        self.assertEqual(image[2, 2], 0)
+        self.assertEqual(np.count_nonzero(image), 16 + 8 + 4)
+
+        rgb = np.random.default_rng(0).uniform(0, 1, (2, 3, 2, 2))
+        region_source.store_predictions([5, 6], [5, 5], rgb, "rgb_values")
+        np.testing.assert_array_equal(
+            region_source._rgb_values_prediction_image[4, 4],
+            (rgb[0, :, 0, 0] * 255).astype(np.uint8),
+        )
+        np.testing.assert_array_equal(
+            region_source._rgb_values_prediction_image[4, 5],
+            (rgb[1, :, 0, 0] * 255).astype(np.uint8),
+        )
+
+    def test_compact_ppm_matches_full(self):
+        test_file_path = os.path.join(
+            os.path.dirname(inkid.__file__),
+            "examples",
+            "DummyTest.volpkg",
+            "working",
+            "DummyTestMultiChannelInkLabel.json",
+        )
+        full = inkid.data.RegionSource(test_file_path)
+        compact = inkid.data.RegionSource(
+            test_file_path, ppm_args=inkid.data.ppm_args_from_storage("quantized")
+        )
+        self.assertTrue(compact._ppm.is_compact)
+        full.feature_args = compact.feature_args = dict(
+            shape_voxels=(4, 4, 4),
+            shape_microns=None,
+            move_along_normal=0,
+            jitter_max=0,
+            augment_subvolume=False,
+            method="nearest_neighbor",
+        )
+        for i in range(0, len(full), max(1, len(full) // 10)):
+            a, b = full[i]["feature_metadata"], compact[i]["feature_metadata"]
+            np.testing.assert_allclose(a.coordinates, b.coordinates, atol=1e-4)
+
+    def test_label_images_are_cached(self):
+        test_file_path = os.path.join(
+            os.path.dirname(inkid.__file__),
+            "examples",
+            "DummyTest.volpkg",
+            "working",
+            "DummyTestMultiChannelInkLabel.json",
+        )
+        cache_dir = inkid.data.get_cache_dir()
+        with tempfile.TemporaryDirectory() as directory:
+            inkid.data.set_cache_dir(directory)
+            try:
+                built = inkid.data.RegionSource(test_file_path, lazy_load=True)
+                cached = inkid.data.RegionSource(test_file_path, lazy_load=True)
+                self.assertIsInstance(cached._mask, np.memmap)
+                self.assertIsInstance(cached._ink_label, np.memmap)
+                np.testing.assert_array_equal(cached._mask, built._mask)
+                np.testing.assert_array_equal(cached._ink_label, built._ink_label)
+                # The RGB label is cached at the size of the 8-bit source image
+                self.assertEqual(cached._rgb_label.dtype, np.uint8)
+                np.testing.assert_array_equal(
+                    cached.points_to_rgb_values_labels([(320, 200)], (1, 1)),
+                    built.points_to_rgb_values_labels([(320, 200)], (1, 1)),
+                )
+                self.assertEqual(len(cached), len(built))
+                del built, cached
+            finally:
+                inkid.data.set_cache_dir(cache_dir)
+
+    def test_failed_cache_writes_leave_no_files(self):
+        cache_dir = inkid.data.get_cache_dir()
+        with tempfile.TemporaryDirectory() as directory:
+            source_path = os.path.join(directory, "source.txt")
+            open(source_path, "w").close()
+            inkid.data.set_cache_dir(os.path.join(directory, "cache"))
+            try:
+                with unittest.mock.patch(
+                    "numpy.save", side_effect=OSError("No space left on device")
+                ):
+                    array = inkid.data.cache.cached_array(
+                        source_path, "array", lambda: np.arange(3)
+                    )
+            finally:
+                inkid.data.set_cache_dir(cache_dir)
+            np.testing.assert_array_equal(array, np.arange(3))
+            self.assertEqual(os.listdir(os.path.join(directory, "cache")), [])
+
+    def test_cache_is_off_by_default(self):
+        self.assertEqual(
+            subprocess.run(
+                [
+                    sys.executable,
+                    "-c",
+                    "import inkid; print(inkid.data.get_cache_dir())",
+                ],
+                env={k: v for k, v in os.environ.items() if k != "INKID_CACHE_DIR"},
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout.strip(),
+            "None",
+        )
+
+    def test_cached_features_match_sampled(self):
+        test_file_path = os.path.join(
+            os.path.dirname(inkid.__file__),
+            "examples",
+            "DummyTest.volpkg",
+            "working",
+            "DummyTestMultiChannelInkLabel.json",
+        )
+        region = inkid.data.RegionSource(test_file_path)
+        items = list(range(0, len(region), max(1, len(region) // 16)))
+        cache_dir = inkid.data.get_cache_dir()
+        with tempfile.TemporaryDirectory() as directory:
+            inkid.data.set_cache_dir(directory)
+            try:
+                for method in ("nearest_neighbor", "interpolated"):
+                    region.feature_args = dict(
+                        shape_voxels=(4, 6, 6),
+                        shape_microns=None,
+                        move_along_normal=0,
+                        jitter_max=0,
+                        method=method,
+                    )
+                    region.cache_features = False
+                    expected = region.get_items(items)
+                    region.cache_features = True
+                    sampled = region.get_items(items)
+                    cache = region._feature_cache
+                    self.assertTrue(os.path.exists(cache.path))
+                    region.volume = None
+                    cached = region.get_items(items)
+                    region.volume = inkid.data.Volume.from_path(
+                        region.source_json["volume"]
+                    )
+                    for batch in (sampled, cached):
+                        for a, b in zip(batch, expected):
+                            self.assertTrue(torch.equal(a["feature"], b["feature"]))
+                    # Other points or subvolume args do not use the same cache
+                    region.feature_args["shape_voxels"] = (2, 6, 6)
+                    region.get_items(items[:1])
+                    self.assertNotEqual(region._feature_cache.path, cache.path)
+                    region.sampler = inkid.data.RegionPointSampler(grid_spacing=2)
+                    region._points_list_needs_update = True
+                    region.get_items(items[:1])
+                    self.assertNotEqual(region._feature_cache.path, cache.path)
+                    region.sampler = inkid.data.RegionPointSampler()
+                    region._points_list_needs_update = True
+                    # Nor does the volume once it is reconstructed again
+                    region.feature_args["shape_voxels"] = (4, 6, 6)
+                    region.get_items(items[:1])
+                    self.assertEqual(region._feature_cache.path, cache.path)
+                    metadata = os.path.join(region.source_json["volume"], "meta.json")
+                    stat = os.stat(metadata)
+                    os.utime(metadata, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**10))
+                    try:
+                        region._feature_cache_args = None
+                        region.get_items(items[:1])
+                    finally:
+                        os.utime(metadata, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+                    self.assertNotEqual(region._feature_cache.path, cache.path)
+            finally:
+                inkid.data.set_cache_dir(cache_dir)
+
+    def test_feature_cache_opened_by_concurrent_workers(self):
+        num_workers = 8
+        context = multiprocessing.get_context("fork")
+        barrier = context.Barrier(num_workers)
+
+        def fill(cache, i):
+            barrier.wait()
+            cache.get([i], lambda missing: np.full((len(missing), 1, 2), i))
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "region-subvolumes.npy")
+            # A stale file of another shape makes every worker want to create it
+            inkid.data.cache.SubvolumeCache(path, 1, (1, 2), np.uint16).get(
+                [0], lambda missing: np.zeros((1, 1, 2))
+            )
+            cache = inkid.data.cache.SubvolumeCache(
+                path, num_workers, (1, 2), np.uint16
+            )
+            workers = [
+                context.Process(target=fill, args=(cache, i))
+                for i in range(num_workers)
+            ]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+                self.assertEqual(worker.exitcode, 0)
+            # Every worker filled the same file, so nothing is sampled again
+            subvolumes = cache.get(range(num_workers), self.fail)
+            np.testing.assert_array_equal(
+                subvolumes[:, 0, 0], np.arange(num_workers, dtype=np.uint16)
+            )
+
+    def test_grid_sample_device_is_passed_on(self):
+        test_file_path = os.path.join(
+            os.path.dirname(inkid.__file__),
+            "examples",
+            "DummyTest.volpkg",
+            "working",
+            "DummyTestMultiChannelInkLabel.json",
+        )
+        region = inkid.data.RegionSource(test_file_path)
+        region.feature_args = dict(
+            shape_voxels=(4, 6, 6),
+            shape_microns=None,
+            move_along_normal=0,
+            jitter_max=0,
+            augment_subvolume=False,
+            method="grid_sample",
+            device=torch.device("cpu"),
+        )
+        self.assertEqual(
+            inkid.data.dataset.subvolume_args(region.feature_args)["device"],
+            torch.device("cpu"),
+        )
+        cache_dir = inkid.data.get_cache_dir()
+        with tempfile.TemporaryDirectory() as directory:
+            inkid.data.set_cache_dir(directory)
+            try:
+                region.cache_features = True
+                cached = region.get_items([0, 1])
+                region.cache_features = False
+                sampled = region.get_items([0, 1])
+                for a, b in zip(cached, sampled):
+                    self.assertTrue(torch.equal(a["feature"], b["feature"]))
+            finally:
+                inkid.data.set_cache_dir(cache_dir)
+
+
+class DatasetTestCase(unittest.TestCase):
+    @staticmethod
+    def items(*values):
+        return [
+            {
+                "feature_metadata": inkid.data.FeatureMetadata.from_coordinates(
+                    v, 0, 0, 0, 0, 0, 0, 1
+                ),
+                "feature": torch.full((1, 2, 2, 2), float(v)),
+            }
+            for v in values
+        ]
+
+    def test_global_index(self):
+        ds = inkid.data.Dataset([])
+        ds.sources = [
+            self.items(0, 1, 2),
+            [],
+            self.items(10, 11, 12, 13, 14),
+            [],
+            self.items(20),
+        ]
+
+        def value(i):
+            return int(ds[i]["feature_metadata"].surface_x)
+
+        self.assertEqual(len(ds), 9)
+        self.assertEqual(
+            [value(i) for i in range(9)], [0, 1, 2, 10, 11, 12, 13, 14, 20]
+        )
+        self.assertEqual(
+            [ds[i]["feature_metadata"].source_index for i in (0, 3, 8)], [0, 2, 4]
+        )
+        self.assertEqual(value(-1), 20)
+        with self.assertRaises(IndexError):
+            ds[9]
+        ds.sources.append(self.items(30, 31))
+        self.assertEqual(value(10), 31)
+        ds.sources[0].pop()
+        self.assertEqual(len(ds), 10)
+        self.assertEqual(value(2), 10)
+
+    def test_getitems_groups_by_source(self):
+        class ListSource(list):
+            calls = []
+
+            def get_items(self, items):
+                ListSource.calls.append(list(items))
+                return [self[i] for i in items]
+
+        ds = inkid.data.Dataset([])
+        ds.sources = [ListSource(self.items(0, 1)), ListSource(self.items(10, 11, 12))]
+        batch = ds.__getitems__([4, 0, 2, 1, -1])
+        self.assertEqual(
+            [int(item["feature_metadata"].surface_x) for item in batch],
+            [12, 0, 10, 1, 12],
+        )
+        self.assertEqual(
+            [item["feature_metadata"].source_index for item in batch], [1, 0, 1, 0, 1]
+        )
+        self.assertEqual(ListSource.calls, [[2, 0, 2], [0, 1]])
+
+    def test_region_get_items_matches_getitem(self):
+        test_file_path = os.path.join(
+            os.path.dirname(inkid.__file__),
+            "examples",
+            "DummyTest.volpkg",
+            "working",
+            "DummyTestMultiChannelInkLabel.json",
+        )
+        region = inkid.data.RegionSource(test_file_path)
+        region.feature_args = dict(
+            shape_voxels=(4, 6, 6),
+            shape_microns=None,
+            move_along_normal=0,
+            jitter_max=0,
+            augment_subvolume=False,
+            method="nearest_neighbor",
+        )
+        region.label_types = ["ink_classes", "rgb_values"]
+        region.label_args = dict(
+            ink_classes=dict(shape=(1, 1)), rgb_values=dict(shape=(2, 2))
+        )
+        items = list(range(0, len(region), max(1, len(region) // 16)))
+        batch = region.get_items(items)
+        self.assertEqual(len(batch), len(items))
+        for i, item in zip(items, batch):
+            expected = region[i]
+            self.assertEqual(item.keys(), expected.keys())
+            np.testing.assert_array_equal(
+                item["feature_metadata"].coordinates,
+                expected["feature_metadata"].coordinates,
+            )
+            for key in ("feature", "ink_classes", "rgb_values"):
+                np.testing.assert_array_equal(item[key], expected[key])
+
+    def test_collate_features(self):
+        ds = inkid.data.Dataset([])
+        ds.sources = [self.items(0, 1), self.items(10, 11, 12)]
+        batch = inkid.data.collate_features([ds[i] for i in (4, 0, 2)])
+        metadata = batch["feature_metadata"]
+        self.assertEqual(batch["feature"].shape, (3, 1, 2, 2, 2))
+        self.assertEqual(metadata.source_index.tolist(), [1, 0, 1])
+        self.assertEqual(metadata.coordinates.shape, (3, 8))
+        self.assertEqual(metadata.coordinates.dtype, torch.float32)
+        self.assertEqual(metadata.surface_x.tolist(), [12, 0, 10])
+        self.assertEqual(metadata.n_z.tolist(), [1, 1, 1])
+
+    def test_index_follows_sampler_changes(self):
+        test_file_path = os.path.join(
+            os.path.dirname(inkid.__file__),
+            "examples",
+            "DummyTest.volpkg",
+            "working",
+            "DummyTestMultiChannelInkLabel.json",
+        )
+        region = inkid.data.RegionSource(test_file_path)
+        region.feature_args = dict(
+            shape_voxels=(4, 6, 6),
+            shape_microns=None,
+            move_along_normal=0,
+            jitter_max=0,
+            augment_subvolume=False,
+            method="nearest_neighbor",
+        )
+        ds = inkid.data.Dataset([])
+        ds.sources = [self.items(0, 1), region]
+        old_length = len(ds)
+        # Change the sampler without calling len() before indexing again
+        region.sampler = inkid.data.RegionPointSampler(grid_spacing=2)
+
+        def coordinates(item):
+            return item["feature_metadata"].coordinates
+
+        last_item = ds[-1]
+        self.assertLess(len(region) + 2, old_length)
+        np.testing.assert_array_equal(
+            coordinates(last_item), coordinates(region[len(region) - 1])
+        )
+        with self.assertRaises(IndexError):
+            ds[old_length - 1]
+        region.sampler = inkid.data.RegionPointSampler(grid_spacing=3)
+        batch = ds.__getitems__([-1, 2])
+        self.assertEqual(len(region) + 2, len(ds))
+        np.testing.assert_array_equal(
+            coordinates(batch[0]), coordinates(region[len(region) - 1])
+        )
+        np.testing.assert_array_equal(coordinates(batch[1]), coordinates(region[0]))
+        # Likewise for the bounding box
+        x0, y0, x1, y1 = region.bounding_box
+        region.bounding_box = (x0, y0, x0 + (x1 - x0) // 2, y1)
+        last_item = ds[-1]
+        self.assertEqual(len(region) + 2, len(ds))
+        np.testing.assert_array_equal(
+            coordinates(last_item), coordinates(region[len(region) - 1])
+        )
+
+    def test_lookups_reuse_index(self):
+        class CountingSource(list):
+            len_calls = 0
+
+            def __len__(self):
+                CountingSource.len_calls += 1
+                return super().__len__()
+
+        ds = inkid.data.Dataset([])
+        ds.sources = [CountingSource(self.items(0, 1)), CountingSource(self.items(10))]
+        self.assertEqual(len(ds), 3)
+        CountingSource.len_calls = 0
+        for i in (0, 1, 2, -1):
+            ds[i]
+        self.assertEqual(CountingSource.len_calls, 0)
+        # Adding, removing or replacing sources rebuilds the index once
+        ds.sources.append(CountingSource(self.items(20)))
+        self.assertEqual(int(ds[3]["feature_metadata"].surface_x), 20)
+        self.assertEqual(int(ds[-1]["feature_metadata"].surface_x), 20)
+        self.assertEqual(CountingSource.len_calls, 3)
+        ds.sources = ds.sources[1:]
+        self.assertEqual(int(ds[0]["feature_metadata"].surface_x), 10)
+        with self.assertRaises(IndexError):
+            ds[2]
+
+    def test_worker_init_fn_reaches_spawned_workers(self):
+        cache_dir = inkid.data.get_cache_dir()
+        with tempfile.TemporaryDirectory() as directory:
+            inkid.data.set_cache_dir(directory)
+            inkid.data.set_sampling_threads(3)
+            try:
+                dl = torch.utils.data.DataLoader(
+                    SettingsDataset(),
+                    batch_size=None,
+                    num_workers=1,
+                    multiprocessing_context="spawn",
+                    worker_init_fn=inkid.data.worker_init_fn(directory, 3),
+                )
+                self.assertEqual([list(settings) for settings in dl], [[directory, 3]])
+            finally:
+                inkid.data.set_cache_dir(cache_dir)
+                inkid.data.set_sampling_threads(None)
+
+    def test_augment_features(self):
+        features = torch.arange(64 * 3 * 4 * 5, dtype=torch.float32).reshape(
+            64, 1, 3, 4, 5
+        )
+        augmented = inkid.data.augment_features(
+            features.clone(), generator=torch.Generator().manual_seed(0)
+        )
+        flips = set()
+        for original, flipped in zip(features, augmented):
+            for flip_w, flip_h in itertools.product((False, True), repeat=2):
+                expected = original
+                if flip_w:
+                    expected = expected.flip(-1)
+                if flip_h:
+                    expected = expected.flip(-2)
+                if torch.equal(flipped, expected):
+                    flips.add((flip_w, flip_h))
+                    break
+            else:
+                self.fail("Subvolume is not a flip of the original")
+        self.assertEqual(len(flips), 4)
+
 
 if __name__ == "__main__":
     unittest.main()
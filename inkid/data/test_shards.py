@@ -0,0 +1,127 @@
+import os
+import tempfile
+import unittest
+import unittest.mock
+
+import numpy as np
+import torch
+
+import inkid
+
+
+class ShardsTestCase(unittest.TestCase):
+    def setUp(self):
+        test_file_path = os.path.join(
+            os.path.dirname(inkid.__file__),
+            "examples",
+            "DummyTest.volpkg",
+            "working",
+            "DummyTestMultiChannelInkLabel.json",
+        )
+        self.ds = inkid.data.Dataset([test_file_path])
+        for region in self.ds.regions():
+            region.feature_args = dict(
+                shape_voxels=(4, 6, 6),
+                shape_microns=None,
+                move_along_normal=0,
+                jitter_max=0,
+                method="nearest_neighbor",
+            )
+            region.label_types = ["ink_classes", "rgb_values"]
+            region.label_args = dict(
+                ink_classes=dict(shape=(1, 1)), rgb_values=dict(shape=(1, 1))
+            )
+        step = max(1, len(self.ds) // 25)
+        self.indices = list(range(0, step * 25, step))
+        self.directory = tempfile.TemporaryDirectory()
+        dl = torch.utils.data.DataLoader(
+            torch.utils.data.Subset(self.ds, self.indices),
+            batch_size=7,
+            collate_fn=inkid.data.collate_features,
+        )
+        with inkid.data.ShardWriter(
+            self.directory.name, shard_size=10, source_json=self.ds.source_json()
+        ) as writer:
+            for batch in dl:
+                writer.write(batch)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def assertItemsEqual(self, a, b):
+        self.assertEqual(a.keys(), b.keys())
+        self.assertEqual(
+            a["feature_metadata"].source_index, b["feature_metadata"].source_index
+        )
+        np.testing.assert_array_equal(
+            a["feature_metadata"].coordinates, b["feature_metadata"].coordinates
+        )
+        for key in ("feature", "ink_classes", "rgb_values"):
+            np.testing.assert_array_equal(a[key], b[key], key)
+
+    def test_round_trip(self):
+        shards = inkid.data.ShardDataset(self.directory.name)
+        self.assertEqual(len(shards), 25)
+        self.assertEqual(shards.source_json(), self.ds.source_json())
+        self.assertEqual(
+            [shard["length"] for shard in shards.index["shards"]], [10, 10, 5]
+        )
+        items = list(shards)
+        self.assertEqual(len(items), 25)
+        for index, item in zip(self.indices, items):
+            self.assertItemsEqual(item, self.ds[index])
+
+    def test_subvolumes_are_memory_mapped(self):
+        shards = inkid.data.ShardDataset(self.directory.name)
+        with unittest.mock.patch("numpy.load", wraps=np.load) as load:
+            items = list(shards)
+        mmap_modes = {
+            os.path.basename(call.args[0]).split("-", 2)[2]: call.kwargs["mmap_mode"]
+            for call in load.call_args_list
+        }
+        self.assertEqual(mmap_modes["feature.npy"], "r")
+        self.assertEqual(mmap_modes["ink_classes.npy"], "r")
+        # Items are converted one by one into their own arrays
+        self.assertEqual(items[0]["feature"].dtype, torch.float32)
+        items[0]["feature"][:] = 0
+        self.assertFalse(torch.equal(items[1]["feature"], items[0]["feature"]))
+
+    def test_shuffle_and_workers_cover_every_item(self):
+        def surface_points(items):
+            return sorted(
+                tuple(item["feature_metadata"].coordinates[0:2].tolist())
+                for item in items
+            )
+
+        expected = surface_points(self.ds[i] for i in self.indices)
+        shards = inkid.data.ShardDataset(self.directory.name, shuffle=True)
+        self.assertEqual(surface_points(shards), expected)
+        dl = torch.utils.data.DataLoader(
+            shards,
+            batch_size=4,
+            num_workers=2,
+            collate_fn=inkid.data.collate_features,
+        )
+        batches = list(dl)
+        coordinates = torch.cat([b["feature_metadata"].coordinates for b in batches])
+        self.assertEqual(
+            sorted(map(tuple, coordinates[:, 0:2].tolist())),
+            expected,
+        )
+        self.assertEqual(batches[0]["ink_classes"].dtype, torch.long)
+
+    def test_label_types(self):
+        shards = inkid.data.ShardDataset(
+            self.directory.name, label_types=["ink_classes", "autoencoded"]
+        )
+        self.assertEqual(
+            next(iter(shards)).keys(), {"feature_metadata", "feature", "ink_classes"}
+        )
+        with self.assertRaises(ValueError):
+            inkid.data.ShardDataset(
+                self.directory.name, label_types=["volcart_texture"]
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
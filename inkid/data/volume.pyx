@@ -3,19 +3,158 @@
 Define the Volume class to represent volumetric data.
 """
 
+import atexit
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from cpython.mem cimport PyMem_Malloc, PyMem_Free
+from cython.parallel cimport prange
+import fcntl
+import glob
+import hashlib
+import io
 import json
 cimport libc.math as math
 import logging
+import mmap
 import os
 import random
+import tempfile
 from typing import Optional
+import uuid
 
 import numpy as np
 cimport numpy as cnp
 from PIL import Image
+import torch
 from tqdm import tqdm
 
 cimport inkid.data.mathutils as mathutils
+from inkid.data.cache import get_cache_dir
+
+
+# Volumes can be held entirely in memory, in a shared memory file that
+# processes unpickling the volume attach to, served from a cache of cubic
+# bricks in a memory-mapped file that is built next to the volume meta.json,
+# or decoded slice by slice on demand into an LRU cache
+cdef enum StorageMode:
+    STORAGE_MEMORY
+    STORAGE_SHARED
+    STORAGE_CHUNKED
+    STORAGE_LAZY
+
+# Subvolumes can be written to uint16 or float32 buffers
+ctypedef fused sample_t:
+    uint16
+    float
+
+# Basis vector components this close to 0 or 1 are taken as exactly that
+# when looking for axis-aligned subvolumes. The basis for a normal of
+# (0, 0, -1), for example, is a rotation of the axes off by about 1e-7.
+cdef float AXIS_TOLERANCE = 1e-6
+
+# Edge length of the bricks in the chunked cache (1 << BRICK_SHIFT voxels)
+cdef enum:
+    BRICK_SHIFT = 6
+    BRICK_SIZE = 1 << BRICK_SHIFT
+    BRICK_MASK = BRICK_SIZE - 1
+
+
+# Number of threads used by the sampling kernels, or 0 to choose per process, see get_sampling_threads()
+cdef int _sampling_threads = 0
+
+
+def set_sampling_threads(num_threads):
+    """Set the number of threads used to sample subvolumes, or None for the default.
+
+    Only has an effect if the module was built with OpenMP.
+
+    """
+    global _sampling_threads
+    assert num_threads is None or num_threads >= 1
+    _sampling_threads = num_threads or 0
+
+
+def get_sampling_threads():
+    """Return the number of threads used to sample subvolumes.
+
+    Unless set, this is the number of CPUs available to the process,
+    divided between the DataLoader workers when called in one. Otherwise
+    N workers would each start a full team of threads.
+
+    """
+    if _sampling_threads > 0:
+        return _sampling_threads
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    worker_info = torch.utils.data.get_worker_info()
+    if worker_info is not None:
+        return max(1, cpus // worker_info.num_workers)
+    return cpus
+
+
+# PIL raw modes of uncompressed 16-bit grayscale images, see Volume._read_raw_slice()
+_RAW_UINT16_DTYPES = {'I;16': np.dtype('<u2'), 'I;16B': np.dtype('>u2')}
+
+
+def _shared_memory_dir():
+    # /dev/shm is backed by RAM, so attaching to a file there costs no disk I/O
+    if os.path.isdir('/dev/shm'):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+
+# Descriptors of the shared volume files created by this process, each holding a lock on its file
+_shared_file_locks = dict()  # Dict[str, int]
+
+
+def _create_shared_file(path):
+    """Create a shared volume file and lock it for as long as this process (or its forks) runs."""
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o600)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    _shared_file_locks[path] = fd
+
+
+def _remove_stale_shared_files():
+    """Remove the shared volume files whose creating processes are no longer running.
+
+    A process that is killed, e.g. by the OOM killer, never runs its
+    atexit handlers, and its file would otherwise hold a whole volume in
+    RAM-backed /dev/shm until reboot. The creator holds a lock on its
+    file until it and any processes forked from it exit, so a file whose
+    lock can be taken is stale. Unlike process IDs, this also holds for
+    processes in other PID namespaces sharing /dev/shm.
+
+    """
+    for path in glob.glob(os.path.join(_shared_memory_dir(), 'inkid_volume_*_*.npy')):
+        if path in _shared_file_locks:
+            continue
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            # Already removed, or another user's
+            continue
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            # Empty files are still being created, and are not locked yet
+            if os.fstat(fd).st_size > 0:
+                os.remove(path)
+                logging.info('Removed stale shared volume file {}'.format(path))
+        except OSError:
+            # Locked by a running process, or could not be removed
+            pass
+        finally:
+            os.close(fd)
+
+
+def _remove_shared_file(path, owner_pid):
+    # Forked processes inherit atexit handlers, only the creating process removes the file
+    if os.getpid() == owner_pid:
+        if os.path.exists(path):
+            os.remove(path)
+        os.close(_shared_file_locks.pop(path))
+
+
+def _unpickle_volume(slices_path, bounding_box, storage, kwargs):
+    return Volume(slices_path, bounding_box=bounding_box, storage=storage, **kwargs)
 
 
 cpdef norm(vec):
@@ -81,6 +220,115 @@ cpdef BasisVectors get_component_vectors_from_normal(const Float3 n):
     return basis
 
 
+# Float subvolumes are written as (value * scale - mean) / std, the same
+# float32 operations as dividing by the uint16 maximum and then applying
+# torchvision's Normalize((mean,), (std,))
+cdef struct ValueScale:
+    float scale
+    float mean
+    float std
+
+
+cdef ValueScale value_scale_for_range(value_range):
+    """Return the scaling that maps [0, uint16 max] onto value_range, or no scaling for None."""
+    cdef ValueScale value_scale
+    value_scale.scale = 1
+    value_scale.mean = 0
+    value_scale.std = 1
+    if value_range is not None:
+        low, high = value_range
+        assert high > low
+        value_scale.scale = 1.0 / np.iinfo(np.uint16).max
+        value_scale.mean = -low / (high - low)
+        value_scale.std = 1.0 / (high - low)
+    return value_scale
+
+
+cdef struct LatticeView:
+    Int3 shape
+    Float3 ratio
+    const float * offsets_x
+    const float * offsets_y
+    const float * offsets_z
+
+
+cdef class SamplingLattice:
+    """The positions of the voxels of a subvolume relative to its center.
+
+    Along each subvolume axis, the offset of each voxel from the center
+    in subvolume voxels, and the ratio of the subvolume voxel size to
+    the volume voxel size. These depend only on the subvolume shape and
+    the volume voxel size, so a lattice is computed once and reused for
+    every subvolume of that shape.
+
+    """
+    cdef float[::1] offsets_x, offsets_y, offsets_z
+    cdef LatticeView view
+
+    def __init__(self, shape_voxels, shape_microns, float voxelsize_um):
+        cdef Int3 shape
+        cdef Float3 subvolume_voxel_size_microns
+        shape.z, shape.y, shape.x = shape_voxels
+
+        subvolume_voxel_size_microns.z = <float> shape_microns[0] / shape.z
+        subvolume_voxel_size_microns.y = <float> shape_microns[1] / shape.y
+        subvolume_voxel_size_microns.x = <float> shape_microns[2] / shape.x
+
+        self.view.shape = shape
+        self.view.ratio.x = subvolume_voxel_size_microns.x / voxelsize_um
+        self.view.ratio.y = subvolume_voxel_size_microns.y / voxelsize_um
+        self.view.ratio.z = subvolume_voxel_size_microns.z / voxelsize_um
+
+        self.offsets_x = self._offsets(shape.x)
+        self.offsets_y = self._offsets(shape.y)
+        self.offsets_z = self._offsets(shape.z)
+        self.view.offsets_x = &self.offsets_x[0]
+        self.view.offsets_y = &self.offsets_y[0]
+        self.view.offsets_z = &self.offsets_z[0]
+
+    @staticmethod
+    def _offsets(int n):
+        cdef int i
+        offsets = np.empty(n, dtype=np.float32)
+        for i in range(n):
+            # Convert from an index relative to an origin in the
+            # corner to a position relative to the subvolume center
+            # (which may not correspond exactly to one of the
+            # subvolume voxel positions if any of the side lengths are
+            # even).
+            offsets[i] = <int>((-1 * (n - 1) / 2.0 + i) + 0.5)
+        return offsets
+
+    def num_terms(self):
+        """Return the number of floats in the per-subvolume table of axis terms."""
+        return 3 * (self.view.shape.x + self.view.shape.y + self.view.shape.z)
+
+
+_sampling_lattices = dict()  # Dict[tuple, SamplingLattice]
+
+
+cdef SamplingLattice get_sampling_lattice(Int3 shape_voxels, Float3 shape_microns, float voxelsize_um):
+    key = (
+        shape_voxels.z, shape_voxels.y, shape_voxels.x,
+        shape_microns.z, shape_microns.y, shape_microns.x,
+        voxelsize_um,
+    )
+    lattice = _sampling_lattices.get(key)
+    if lattice is None:
+        lattice = SamplingLattice(key[0:3], key[3:6], voxelsize_um)
+        _sampling_lattices[key] = lattice
+    return lattice
+
+
+cdef void axis_terms(float * terms, const float * offsets, int n, Float3 axis, float ratio) noexcept nogil:
+    """Fill terms[3 * i:3 * i + 3] with the volume space step from the center to position i along one subvolume axis."""
+    cdef int i
+    for i in range(n):
+        terms[3 * i + 0] = offsets[i] * axis.x * ratio
+        terms[3 * i + 1] = offsets[i] * axis.y * ratio
+        terms[3 * i + 2] = offsets[i] * axis.z * ratio
+
+
 cdef class Volume:
     """Represent a volume and support accesses of the volume data.
 
@@ -100,32 +348,93 @@ cdef class Volume:
     - Volume shapes are (z, y, x)
 
     """
-    cdef const unsigned short [:, :, :] _data_view
+    cdef const unsigned short [:, :, ::1] _data_view
+    cdef const unsigned short [:, :, :, :, :, :] _bricks_view
     cdef int shape_z, shape_y, shape_x
     cdef int offset_x, offset_y, offset_z
     cdef dict _metadata
     cdef float _voxelsize_um
+    cdef StorageMode _storage
+    cdef str _storage_name
+    cdef str _slices_path
+    cdef tuple _bounding_box
+    cdef str _shared_path
+    cdef str _brick_cache_path
+    cdef list _slice_files
+    cdef object _slice_cache  # OrderedDict[int, np.ndarray], least recently used first
+    cdef Py_ssize_t _slice_cache_bytes
+    cdef const unsigned short ** _slice_ptrs  # Data of each cached slice, or NULL
+    cdef const unsigned short * _data_ptr  # Start of _data_view, or NULL
+    cdef object _num_workers
 
     initialized_volumes = dict()  # Dict[str, Volume]
 
+    storage_choices = ["memory", "shared", "chunked", "lazy"]
+
     @classmethod
-    def from_path(cls, path: str, bounding_box: Optional[tuple] = None) -> Volume:
+    def from_path(cls, path: str, bounding_box: Optional[tuple] = None, **kwargs) -> Volume:
         if path in cls.initialized_volumes:
             return cls.initialized_volumes[path]
-        cls.initialized_volumes[path] = Volume(path, bounding_box=bounding_box)
+        cls.initialized_volumes[path] = Volume(path, bounding_box=bounding_box, **kwargs)
         return cls.initialized_volumes[path]
     
-    def __init__(self, slices_path, bounding_box=None):
+    def __cinit__(self):
+        self._slice_ptrs = NULL
+        self._data_ptr = NULL
+
+    def __dealloc__(self):
+        PyMem_Free(self._slice_ptrs)
+
+    def __init__(self, slices_path, bounding_box=None, storage="memory", slice_cache_bytes=4 * 1024 ** 3,
+                 num_workers=None, shared_path=None):
         """Initialize a volume using a path to the slices directory.
 
         Get the absolute path and filename for each slice in the given
-        directory. Load them into a contiguous volume in memory,
-        represented as a numpy array and indexed self._data[z, y, x].
-
-        Ignores hidden files in that directory, but will get all other
-        files, so it must be a directory with only image files.
+        directory. Ignores hidden files in that directory, but will
+        get all other files, so it must be a directory with only image
+        files.
+
+        With storage='memory' (the default) the slices are loaded into
+        a contiguous volume in memory, represented as a numpy array and
+        indexed self._data[z, y, x].
+
+        With storage='shared' the volume is loaded the same way, but
+        into a file in shared memory (/dev/shm where available) instead
+        of private memory. When the volume is pickled, e.g. to send a
+        dataset to DataLoader workers, the copy in the other process
+        attaches to that file (passed as shared_path) rather than
+        loading the slices again, so every process reads the same pages.
+        The file is removed when the process that created it exits, or,
+        if that process is killed, by the next process creating a shared
+        volume.
+
+        With storage='chunked' the slices are instead written once to a
+        cache of 64^3 voxel bricks in a single memory-mapped file next
+        to meta.json, and voxel lookups are served from that file. Only
+        the bricks that are actually sampled are paged into memory, so
+        memory use scales with the working set rather than the volume
+        size. Later runs reuse the cache as long as meta.json and the
+        slices are unchanged. If the volume directory is not writable
+        the cache is kept in the inkid cache directory instead, and
+        without one the volume is loaded into memory.
+
+        With storage='lazy' nothing is read up front. A slice is
+        decoded the first time a subvolume or region needs it, and kept
+        in an LRU cache holding up to slice_cache_bytes of slices. The
+        slices needed by a single request are always kept, even if they
+        alone exceed the budget.
+
+        Slices are decoded by num_workers threads when loading into
+        memory or building the chunked cache (None uses the
+        ThreadPoolExecutor default).
 
         """
+        assert storage in self.storage_choices
+        self._slices_path = slices_path
+        self._storage_name = storage
+        self._bounding_box = tuple(bounding_box) if bounding_box is not None else None
+        self._slice_cache_bytes = slice_cache_bytes
+        self._num_workers = num_workers
 
         # Load metadata
         self._metadata = dict()
@@ -153,9 +462,165 @@ cdef class Volume:
             self.offset_y = min_y
             self.offset_z = min_z
 
-        # Get list of slice image filenames
+        if storage == 'shared' and shared_path is not None:
+            self._storage = STORAGE_SHARED
+            self._shared_path = shared_path
+            data = np.load(shared_path, mmap_mode='r')
+            assert data.shape == self.shape()
+            self._data_view = data
+            self._data_ptr = &self._data_view[0, 0, 0]
+            logging.info('Attached to shared volume {} with shape (z, y, x) = {}'.format(
+                slices_path,
+                data.shape
+            ))
+            return
+
+        slice_files = self._find_slice_files()
+
+        if storage == 'chunked':
+            bricks = self._open_brick_cache(slice_files, num_workers)
+            if bricks is not None:
+                self._storage = STORAGE_CHUNKED
+                self._bricks_view = bricks
+                logging.info('Opened chunked volume {} with shape (z, y, x) = {}'.format(
+                    slices_path,
+                    self.shape()
+                ))
+                return
+            logging.warning('Could not write a chunked cache for {}, loading it into memory'.format(
+                slices_path
+            ))
+
+        if storage == 'lazy':
+            self._storage = STORAGE_LAZY
+            self._slice_files = slice_files
+            self._slice_cache = OrderedDict()
+            self._slice_ptrs = <const unsigned short **> PyMem_Malloc(
+                self.shape_z * sizeof(unsigned short *)
+            )
+            if self._slice_ptrs == NULL:
+                raise MemoryError()
+            for slice_i in range(self.shape_z):
+                self._slice_ptrs[slice_i] = NULL
+            logging.info('Opened lazy volume {} with shape (z, y, x) = {}'.format(
+                slices_path,
+                self.shape()
+            ))
+            return
+
+        # Load slice images into volume
+        logging.info('Loading volume slices from {}...'.format(slices_path))
+        if storage == 'shared':
+            self._storage = STORAGE_SHARED
+            _remove_stale_shared_files()
+            # Locked while this process runs, so the file can be removed if it is killed
+            self._shared_path = os.path.join(
+                _shared_memory_dir(), 'inkid_volume_{}_{}.npy'.format(os.getpid(), uuid.uuid4().hex)
+            )
+            _create_shared_file(self._shared_path)
+            atexit.register(_remove_shared_file, self._shared_path, os.getpid())
+            data = np.lib.format.open_memmap(
+                self._shared_path, mode='w+', dtype=np.uint16, shape=self.shape()
+            )
+        else:
+            self._storage = STORAGE_MEMORY
+            data = np.empty((self.shape_z, self.shape_y, self.shape_x), dtype=np.uint16)
+        self._map_slices(
+            lambda slice_i: self._load_slice(slice_files[slice_i], out=data[slice_i]),
+            num_workers,
+        )
+        self._data_view = data
+        self._data_ptr = &self._data_view[0, 0, 0]
+        logging.info('Loaded volume {} with shape (z, y, x) = {}'.format(
+            slices_path,
+            data.shape
+        ))
+
+    def __reduce__(self):
+        kwargs = dict(slice_cache_bytes=self._slice_cache_bytes, num_workers=self._num_workers)
+        if self._storage == STORAGE_SHARED:
+            kwargs['shared_path'] = self._shared_path
+        return _unpickle_volume, (self._slices_path, self._bounding_box, self._storage_name, kwargs)
+
+    def shared_path(self):
+        """Return the shared memory file backing a shared volume, or None."""
+        return self._shared_path
+
+    def _load_slice(self, slice_file, out=None):
+        """Load one slice image, cropped to the bounding box.
+
+        Uncompressed slices are copied straight from the file into out
+        (or a new array), see _read_raw_slice(). Others are decoded by
+        PIL and cropped, and the crop is then copied once into out.
+
+        The encoded file is read into memory before decoding. Given a
+        real file, PIL's libtiff decoder closes the descriptor itself,
+        which races with other threads opening slices.
+
+        """
+        if out is None:
+            out = np.empty((self.shape_y, self.shape_x), dtype=np.uint16)
+        if self._read_raw_slice(slice_file, out):
+            return out
+        with open(slice_file, 'rb') as f:
+            encoded = io.BytesIO(f.read())
+        with Image.open(encoded) as slice_img:
+            slice_img = slice_img.crop((
+                self.offset_x,
+                self.offset_y,
+                self.offset_x + self.shape_x,
+                self.offset_y + self.shape_y,
+            ))
+        out[...] = slice_img
+        return out
+
+    def _read_raw_slice(self, slice_file, out):
+        """Copy the cropped slice from a memory map of the file into out, if it is uncompressed.
+
+        Only the header is parsed by PIL. The rows of the bounding box
+        are then read from the strips of the file, with no decoded copy
+        of the whole slice. Returns False without reading any pixel data
+        if the slice is stored any other way, e.g. compressed.
+
+        """
+        cdef int y0 = self.offset_y, y1 = self.offset_y + self.shape_y
+        cdef int x0 = self.offset_x, x1 = self.offset_x + self.shape_x
+        with Image.open(slice_file) as slice_img:
+            width = slice_img.size[0]
+            tiles = slice_img.tile
+        strips = []
+        for decoder, extents, offset, args in tiles:
+            # Whole rows of uint16 pixels, stored top to bottom with no row padding
+            if decoder != 'raw' or extents[0] != 0 or extents[2] != width \
+               or args[0] not in _RAW_UINT16_DTYPES or args[1] not in (0, width * 2) or args[2] != 1:
+                return False
+            strips.append((extents[1], extents[3], offset, _RAW_UINT16_DTYPES[args[0]]))
+        with open(slice_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            for strip_y0, strip_y1, offset, dtype in strips:
+                a, b = max(strip_y0, y0), min(strip_y1, y1)
+                if a < b:
+                    strip = np.frombuffer(
+                        m, dtype=dtype, count=(strip_y1 - strip_y0) * width, offset=offset
+                    ).reshape(strip_y1 - strip_y0, width)
+                    out[a - y0:b - y0] = strip[a - strip_y0:b - strip_y0, x0:x1]
+                    del strip  # Release the buffer before the map is closed
+        return True
+
+    def _map_slices(self, fn, num_workers):
+        """Call fn(slice_i) for every slice using a pool of threads.
+
+        PIL releases the GIL while decoding, so slices are decoded in
+        parallel and loading is bound by I/O rather than a single core.
+
+        """
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            for _ in tqdm(executor.map(fn, range(self.shape_z)), total=self.shape_z):
+                pass
+
+    def _find_slice_files(self):
+        """Return the filenames of the slices within the bounding box, in order."""
         slice_files = []
-        for root, dirs, files in os.walk(slices_path):
+        for root, dirs, files in os.walk(self._slices_path):
             for filename in files:
                 # Make sure it is not a hidden file and it's a
                 # .tif. In the future we might add other formats.
@@ -164,71 +629,270 @@ cdef class Volume:
         slice_files.sort()
         slice_files = slice_files[self.offset_z:self.offset_z + self.shape_z]
         assert len(slice_files) == self.shape_z
+        return slice_files
 
-        # Load slice images into volume
-        logging.info('Loading volume slices from {}...'.format(slices_path))
-        data = np.empty((self.shape_z, self.shape_y, self.shape_x), dtype=np.uint16)
-        for slice_i, slice_file in tqdm(list(enumerate(slice_files))):
-            slice_img = Image.open(slice_file)
-            slice_np = np.array(slice_img, dtype=np.uint16)[
-                self.offset_y:self.offset_y + self.shape_y,
-                self.offset_x:self.offset_x + self.shape_x
+    def data_version(self, slice_files=None):
+        """Return a string that changes whenever meta.json or the slices of this volume change.
+
+        Built from the newest modification time, the total size and the
+        number of those files, so caches of data derived from the volume
+        can be keyed by it. Reads the directory each call rather than
+        remembering the result, so it also notices a volume that was
+        reconstructed again while this process was running.
+
+        """
+        if slice_files is None:
+            slice_files = self._find_slice_files()
+        paths = [os.path.join(self._slices_path, 'meta.json')] + list(slice_files)
+        stats = [os.stat(path) for path in paths]
+        return '{}_{}_{}'.format(
+            max(stat.st_mtime_ns for stat in stats),
+            sum(stat.st_size for stat in stats),
+            len(stats),
+        )
+
+    def brick_cache_path(self):
+        """Return the chunked cache file this volume was opened from, or None."""
+        return self._brick_cache_path
+
+    def _brick_cache_paths(self, slice_files):
+        """Return the (path, stale path pattern) of the chunked cache in each place it can be kept.
+
+        The file name includes a hash of the bounding box and of
+        data_version(), so editing or replacing meta.json or any slice
+        selects a new cache.
+
+        """
+        bounds = (
+            self.offset_x, self.offset_y, self.offset_z,
+            self.offset_x + self.shape_x, self.offset_y + self.shape_y, self.offset_z + self.shape_z,
+        )
+        key = hashlib.sha1('\0'.join([
+            os.path.abspath(self._slices_path),
+            '_'.join(str(b) for b in bounds),
+            self.data_version(slice_files),
+        ]).encode('utf-8')).hexdigest()[:16]
+        # Hidden file next to the slices, so it is never picked up as a slice
+        prefix = os.path.join(
+            self._slices_path,
+            '.inkid_bricks{}_{}_'.format(BRICK_SIZE, '_'.join(str(b) for b in bounds)),
+        )
+        paths = [(prefix + key + '.npy', prefix + '*.npy')]
+        if get_cache_dir() is not None:
+            prefix = os.path.join(
+                get_cache_dir(),
+                '{}-bricks{}-'.format(os.path.basename(os.path.abspath(self._slices_path)), BRICK_SIZE),
+            )
+            paths.append((prefix + key + '.npy', None))
+        return paths
+
+    def _open_brick_cache(self, slice_files, num_workers):
+        """Memory map the chunked cache, building it first if there is no current one.
+
+        Returns None if the cache can be written neither next to the
+        volume nor in the inkid cache directory.
+
+        """
+        for cache_path, stale_pattern in self._brick_cache_paths(slice_files):
+            try:
+                if not os.path.exists(cache_path):
+                    self._build_brick_cache(slice_files, cache_path, num_workers)
+                    if stale_pattern is not None:
+                        # Caches of earlier versions of the slices are never read again
+                        for stale_path in glob.glob(stale_pattern):
+                            if stale_path != cache_path:
+                                os.remove(stale_path)
+                bricks = np.load(cache_path, mmap_mode='r')
+            except OSError as e:
+                logging.warning('Could not use chunked cache {}: {}'.format(cache_path, e))
+                continue
+            assert bricks.shape == self._brick_cache_shape()
+            self._brick_cache_path = cache_path
+            return bricks
+        return None
+
+    def _brick_cache_shape(self):
+        # Bricks are indexed [brick_z, brick_y, brick_x, z, y, x]
+        return (
+            -(-self.shape_z // BRICK_SIZE),
+            -(-self.shape_y // BRICK_SIZE),
+            -(-self.shape_x // BRICK_SIZE),
+            BRICK_SIZE,
+            BRICK_SIZE,
+            BRICK_SIZE,
+        )
+
+    def _build_brick_cache(self, slice_files, cache_path, num_workers):
+        """Write the slices into a memory-mapped file of bricks.
+
+        Only one slice per worker is held in memory at a time. The cache is
+        written to a uniquely named temporary file and then moved into
+        place, so an interrupted build is never mistaken for a complete
+        cache, and processes building the same cache at once each write
+        their own file.
+
+        """
+        logging.info('Building chunked volume cache {}...'.format(cache_path))
+        shape = self._brick_cache_shape()
+        n_bricks_z, n_bricks_y, n_bricks_x = shape[:3]
+        directory = os.path.dirname(cache_path)
+        os.makedirs(directory, exist_ok=True)
+        # Hidden, so it is never picked up as a slice
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.', suffix='.npy.tmp')
+        os.close(fd)
+        try:
+            bricks = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint16, shape=shape)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+        def write_slice(slice_i):
+            padded_slice = np.zeros((n_bricks_y * BRICK_SIZE, n_bricks_x * BRICK_SIZE), dtype=np.uint16)
+            self._load_slice(slice_files[slice_i], out=padded_slice[:self.shape_y, :self.shape_x])
+            # [y, x] -> [brick_y, brick_x, y, x]
+            bricks[slice_i >> BRICK_SHIFT, :, :, slice_i & BRICK_MASK, :, :] = padded_slice.reshape(
+                n_bricks_y, BRICK_SIZE, n_bricks_x, BRICK_SIZE
+            ).transpose(0, 2, 1, 3)
+
+        try:
+            self._map_slices(write_slice, num_workers)
+            bricks.flush()
+            bricks = None  # Close the memory map before moving the file into place
+            os.replace(tmp_path, cache_path)
+        except BaseException:
+            bricks = None
+            os.remove(tmp_path)
+            raise
+
+    def _ensure_slices(self, slices):
+        """Make the given slices resident in the slice cache of a lazy volume.
+
+        Slices not requested are evicted, least recently used first,
+        until the cache is back within its byte budget. This is only
+        done here, before any sampling kernel runs, so the kernels never
+        see a slice disappear under them.
+
+        """
+        cdef int z
+        cdef const unsigned short [:, ::1] slice_view
+        if self._storage != STORAGE_LAZY:
+            return
+        requested = set(z for z in slices if 0 <= z < self.shape_z)
+        for z in sorted(requested):
+            if z in self._slice_cache:
+                self._slice_cache.move_to_end(z)
+            else:
+                slice_np = np.ascontiguousarray(self._load_slice(self._slice_files[z]))
+                slice_view = slice_np
+                self._slice_cache[z] = slice_np
+                self._slice_ptrs[z] = &slice_view[0, 0]
+        slice_bytes = self.shape_y * self.shape_x * sizeof(unsigned short)
+        while len(self._slice_cache) * slice_bytes > self._slice_cache_bytes:
+            z = next(iter(self._slice_cache))
+            if z in requested:
+                # Everything left was requested just now
+                break
+            del self._slice_cache[z]
+            self._slice_ptrs[z] = NULL
+
+    def cached_slices(self):
+        """Return the indices of the slices currently decoded by a lazy volume."""
+        if self._storage != STORAGE_LAZY:
+            return list(range(self.shape_z))
+        return list(self._slice_cache)
+
+    def _read_region(self, int z0, int z1, int y0, int y1, int x0, int x1):
+        """Return a copy of the volume in [z0, z1) x [y0, y1) x [x0, x1).
+
+        Positions outside the volume are filled with zeros.
+
+        """
+        cdef int x, y, z
+        cdef unsigned short [:, :, :] region_view
+        region = np.zeros((max(z1 - z0, 0), max(y1 - y0, 0), max(x1 - x0, 0)), dtype=np.uint16)
+        if self._storage == STORAGE_MEMORY or self._storage == STORAGE_SHARED:
+            src = np.asarray(self._data_view)[
+                max(z0, 0):max(z1, 0), max(y0, 0):max(y1, 0), max(x0, 0):max(x1, 0)
             ]
-            data[slice_i, :, :] = slice_np.copy()
-        print()
-        self._data_view = data
-        logging.info('Loaded volume {} with shape (z, y, x) = {}'.format(
-            slices_path,
-            data.shape
-        ))
+            region[
+                max(-z0, 0):max(-z0, 0) + src.shape[0],
+                max(-y0, 0):max(-y0, 0) + src.shape[1],
+                max(-x0, 0):max(-x0, 0) + src.shape[2],
+            ] = src
+            return region
+        region_view = region
+        self._ensure_slices(range(z0, z1))
+        with nogil:
+            for z in range(z0, z1):
+                for y in range(y0, y1):
+                    for x in range(x0, x1):
+                        region_view[z - z0, y - y0, x - x0] = self.intensity_at(x, y, z)
+        return region
 
     def z_slice(self, int idx):
-        if 0 <= idx < self.shape_z:
-            return np.array(self._data_view[idx, :, :], dtype=np.uint16)
-        else:
-            return np.zeros((self.shape_y, self.shape_x), dtype=np.uint16)
+        return self._read_region(idx, idx + 1, 0, self.shape_y, 0, self.shape_x)[0, :, :]
 
     def y_slice(self, int idx):
-        if 0 <= idx < self.shape_y:
-            return np.array(self._data_view[:, idx, :], dtype=np.uint16)
-        else:
-            return np.zeros((self.shape_z, self.shape_x), dtype=np.uint16)
+        return self._read_region(0, self.shape_z, idx, idx + 1, 0, self.shape_x)[:, 0, :]
 
     def x_slice(self, int idx):
-        if 0 <= idx < self.shape_x:
-            return np.array(self._data_view[:, :, idx], dtype=np.uint16)
-        else:
-            return np.zeros((self.shape_z, self.shape_y), dtype=np.uint16)
+        return self._read_region(0, self.shape_z, 0, self.shape_y, idx, idx + 1)[:, :, 0]
 
     def shape(self):
         return self.shape_z, self.shape_y, self.shape_x
 
-    cdef unsigned short intensity_at(self, int x, int y, int z) nogil:
+    cdef inline unsigned short voxel_at(self, int x, int y, int z) noexcept nogil:
+        """Get the intensity value at a voxel position known to be inside the volume."""
+        if self._storage == STORAGE_CHUNKED:
+            return self._bricks_view[
+                z >> BRICK_SHIFT, y >> BRICK_SHIFT, x >> BRICK_SHIFT,
+                z & BRICK_MASK, y & BRICK_MASK, x & BRICK_MASK
+            ]
+        if self._storage == STORAGE_LAZY:
+            # Callers make the slices they need resident first
+            if self._slice_ptrs[z] == NULL:
+                return 0
+            return self._slice_ptrs[z][y * self.shape_x + x]
+        return self._data_ptr[(<Py_ssize_t> z * self.shape_y + y) * self.shape_x + x]
+
+    cdef unsigned short intensity_at(self, int x, int y, int z) noexcept nogil:
         """Get the intensity value at a voxel position."""
         if 0 <= x < self.shape_x and 0 <= y < self.shape_y and 0 <= z < self.shape_z:
-            return self._data_view[z, y, x]
+            return self.voxel_at(x, y, z)
         else:
             return 0
 
-
-    cdef unsigned short interpolate_at(self, float x, float y, float z) nogil:
+    cdef unsigned short interpolate_at(self, float x, float y, float z) noexcept nogil:
         """Get the intensity value at a subvoxel position.
 
-        Values are trilinearly interpolated.
+        Values are trilinearly interpolated, and positions outside the
+        volume read as zero.
 
         https://en.wikipedia.org/wiki/Trilinear_interpolation
 
-        Potential speed improvement:
-        https://stackoverflow.com/questions/6427276/3d-interpolation-of-numpy-arrays-without-scipy
+        """
+        return self._interpolate(x, y, z, True)
+
+    cdef inline unsigned short _interpolate(self, float x, float y, float z, bint checked) noexcept nogil:
+        """Trilinearly interpolate at a subvoxel position.
+
+        Without checked, all eight neighboring voxels must be inside
+        the volume.
 
         """
         cdef double dx, dy, dz, x0d, y0d, z0d
         cdef int x0, y0, z0, x1, y1, z1
+        cdef double c000, c100, c010, c110, c001, c101, c011, c111
         cdef double c00, c10, c01, c11, c0, c1
+        cdef Py_ssize_t row, plane
+        cdef const unsigned short * p
         cdef unsigned short c
-        dx = math.modf(x, &x0d)
-        dy = math.modf(y, &y0d)
-        dz = math.modf(z, &z0d)
+        x0d = math.floor(x)
+        y0d = math.floor(y)
+        z0d = math.floor(z)
+        dx = x - x0d
+        dy = y - y0d
+        dz = z - z0d
 
         x0 = <int> x0d
         y0 = <int> y0d
@@ -238,10 +902,43 @@ cdef class Volume:
         y1 = y0 + 1
         z1 = z0 + 1
 
-        c00 = self.intensity_at(x0, y0, z0) * (1 - dx) + self.intensity_at(x1, y0, z0) * dx
-        c10 = self.intensity_at(x0, y1, z0) * (1 - dx) + self.intensity_at(x1, y0, z0) * dx
-        c01 = self.intensity_at(x0, y0, z1) * (1 - dx) + self.intensity_at(x1, y0, z1) * dx
-        c11 = self.intensity_at(x0, y1, z1) * (1 - dx) + self.intensity_at(x1, y1, z1) * dx
+        if checked:
+            c000 = self.intensity_at(x0, y0, z0)
+            c100 = self.intensity_at(x1, y0, z0)
+            c010 = self.intensity_at(x0, y1, z0)
+            c110 = self.intensity_at(x1, y1, z0)
+            c001 = self.intensity_at(x0, y0, z1)
+            c101 = self.intensity_at(x1, y0, z1)
+            c011 = self.intensity_at(x0, y1, z1)
+            c111 = self.intensity_at(x1, y1, z1)
+        elif self._data_ptr != NULL:
+            # The eight neighbors are at fixed offsets in the contiguous array
+            row = self.shape_x
+            plane = <Py_ssize_t> self.shape_y * self.shape_x
+            p = self._data_ptr + z0 * plane + y0 * row + x0
+            c000 = p[0]
+            c100 = p[1]
+            c010 = p[row]
+            c110 = p[row + 1]
+            c001 = p[plane]
+            c101 = p[plane + 1]
+            c011 = p[plane + row]
+            c111 = p[plane + row + 1]
+        else:
+            c000 = self.voxel_at(x0, y0, z0)
+            c100 = self.voxel_at(x1, y0, z0)
+            c010 = self.voxel_at(x0, y1, z0)
+            c110 = self.voxel_at(x1, y1, z0)
+            c001 = self.voxel_at(x0, y0, z1)
+            c101 = self.voxel_at(x1, y0, z1)
+            c011 = self.voxel_at(x0, y1, z1)
+            c111 = self.voxel_at(x1, y1, z1)
+
+        # cYZ: interpolated along x at (y, z) in {y0, y1} x {z0, z1}
+        c00 = c000 * (1 - dx) + c100 * dx
+        c10 = c010 * (1 - dx) + c110 * dx
+        c01 = c001 * (1 - dx) + c101 * dx
+        c11 = c011 * (1 - dx) + c111 * dx
 
         c0 = c00 * (1 - dy) + c10 * dy
         c1 = c01 * (1 - dy) + c11 * dy
@@ -249,6 +946,14 @@ cdef class Volume:
         c = <unsigned short>(c0 * (1 - dz) + c1 * dz)
         return c
 
+    def _read_clipped_region(self, int z0, int z1, int y0, int y1, int x0, int x1):
+        """Return the part of [z0, z1) x [y0, y1) x [x0, x1) inside the volume."""
+        return self._read_region(
+            max(z0, 0), min(z1, self.shape_z),
+            max(y0, 0), min(y1, self.shape_y),
+            max(x0, 0), min(x1, self.shape_x),
+        )
+
     cpdef get_subvolume_snap_to_axis_aligned(self,
                                              center,
                                              shape,
@@ -276,17 +981,17 @@ cdef class Volume:
 
         # z in subvolume space is along x in volume space
         if strongest_normal_axis == 0:
-            subvolume = np.asarray(self._data_view[z-y_r:z+y_r, y-x_r:y+x_r, x-z_r:x+z_r])
+            subvolume = self._read_clipped_region(z-y_r, z+y_r, y-x_r, y+x_r, x-z_r, x+z_r)
             subvolume = np.rot90(subvolume, axes=(2, 0))
 
         # z in subvolume space is along y in volume space
         elif strongest_normal_axis == 1:
-            subvolume = np.asarray(self._data_view[z-x_r:z+x_r, y-z_r:y+z_r, x-y_r:x+y_r])
+            subvolume = self._read_clipped_region(z-x_r, z+x_r, y-z_r, y+z_r, x-y_r, x+y_r)
             subvolume = np.rot90(subvolume, axes=(1, 0))
 
         # z in subvolume space is along z in volume space
         elif strongest_normal_axis == 2:
-            subvolume = np.asarray(self._data_view[z-z_r:z+z_r, y-y_r:y+y_r, x-x_r:x+x_r])
+            subvolume = self._read_clipped_region(z-z_r, z+z_r, y-y_r, y+y_r, x-x_r, x+x_r)
 
         # If the normal was pointed along a negative axis, flip the
         # subvolume over
@@ -300,107 +1005,188 @@ cdef class Volume:
 
         return subvolume
 
-    cdef void interpolated_with_basis_vectors(self, Float3 center, Int3 shape_voxels, Float3 shape_microns, BasisVectors basis, uint16[:,:,:] array) nogil:
-        cdef int x, y, z, x_offset, y_offset, z_offset
-        cdef Float3 volume_point, subvolume_voxel_size_microns, subvolume_voxel_size_volume_voxel_size_ratio
-        cdef Int3 offset
-
-        subvolume_voxel_size_microns.x = shape_microns.x / shape_voxels.x
-        subvolume_voxel_size_microns.y = shape_microns.y / shape_voxels.y
-        subvolume_voxel_size_microns.z = shape_microns.z / shape_voxels.z
-
-        subvolume_voxel_size_volume_voxel_size_ratio.x = subvolume_voxel_size_microns.x / self._voxelsize_um
-        subvolume_voxel_size_volume_voxel_size_ratio.y = subvolume_voxel_size_microns.y / self._voxelsize_um
-        subvolume_voxel_size_volume_voxel_size_ratio.z = subvolume_voxel_size_microns.z / self._voxelsize_um
-        
-        for z in range(shape_voxels.z):
-            for y in range(shape_voxels.y):
-                for x in range(shape_voxels.x):
-                    # Convert from an index relative to an origin in
-                    # the corner to a position relative to the
-                    # subvolume center (which may not correspond
-                    # exactly to one of the subvolume voxel positions
-                    # if any of the side lengths are even).
-                    offset.x = <int>((-1 * (shape_voxels.x - 1) / 2.0 + x) + 0.5)
-                    offset.y = <int>((-1 * (shape_voxels.y - 1) / 2.0 + y) + 0.5)
-                    offset.z = <int>((-1 * (shape_voxels.z - 1) / 2.0 + z) + 0.5)
-
-                    # Calculate the corresponding position in the
-                    # volume.
-                    volume_point.x = center.x
-                    volume_point.y = center.y
-                    volume_point.z = center.z
-                    
-                    volume_point.x += offset.x * basis.x.x * subvolume_voxel_size_volume_voxel_size_ratio.x
-                    volume_point.y += offset.x * basis.x.y * subvolume_voxel_size_volume_voxel_size_ratio.x
-                    volume_point.z += offset.x * basis.x.z * subvolume_voxel_size_volume_voxel_size_ratio.x
-
-                    volume_point.x += offset.y * basis.y.x * subvolume_voxel_size_volume_voxel_size_ratio.y
-                    volume_point.y += offset.y * basis.y.y * subvolume_voxel_size_volume_voxel_size_ratio.y
-                    volume_point.z += offset.y * basis.y.z * subvolume_voxel_size_volume_voxel_size_ratio.y
-
-                    volume_point.x += offset.z * basis.z.x * subvolume_voxel_size_volume_voxel_size_ratio.z
-                    volume_point.y += offset.z * basis.z.y * subvolume_voxel_size_volume_voxel_size_ratio.z
-                    volume_point.z += offset.z * basis.z.z * subvolume_voxel_size_volume_voxel_size_ratio.z
-                    
-                    array[z, y, x] = self.interpolate_at(
-                        volume_point.x,
-                        volume_point.y,
-                        volume_point.z
-                    )
+    cdef void interpolated_with_basis_vectors(self, Float3 center, LatticeView lattice, BasisVectors basis, float * terms, ValueScale value_scale,
+                                              sample_t[:,:,:] array, int num_threads) noexcept nogil:
+        cdef int z
+        cdef bint interior
+        cdef float * terms_x = terms
+        cdef float * terms_y = terms_x + 3 * lattice.shape.x
+        cdef float * terms_z = terms_y + 3 * lattice.shape.y
+
+        # The volume position of each subvolume voxel is the center
+        # plus one step along each of the basis vectors, so the steps
+        # are computed once per position along each axis
+        axis_terms(terms_x, lattice.offsets_x, lattice.shape.x, basis.x, lattice.ratio.x)
+        axis_terms(terms_y, lattice.offsets_y, lattice.shape.y, basis.y, lattice.ratio.y)
+        axis_terms(terms_z, lattice.offsets_z, lattice.shape.z, basis.z, lattice.ratio.z)
+        interior = self._in_interior(center, lattice.shape, terms_x, terms_y, terms_z)
+
+        # Each thread samples whole z slices of the subvolume
+        for z in prange(lattice.shape.z, num_threads=num_threads, schedule='static'):
+            self._interpolated_z_slice(center, lattice.shape, terms_x, terms_y, terms_z, interior, value_scale, array, z)
+
+    cdef bint _in_interior(self, Float3 center, Int3 shape_voxels, const float * terms_x,
+                           const float * terms_y, const float * terms_z) noexcept nogil:
+        """Return whether every sample point of a subvolume is safely inside the volume.
+
+        The bounds of the sample points are found from the extremes of
+        the axis terms. They are compared with a margin of one voxel,
+        which covers the neighbors read by interpolation and any
+        rounding differences from summing the terms in another order.
+        Subvolumes inside the volume can then be sampled without
+        checking the bounds of each voxel.
 
-    cdef void nearest_neighbor_with_basis_vectors(self, Float3 center, Int3 shape_voxels, Float3 shape_microns, BasisVectors basis, uint16[:,:,:] array) nogil:
-        cdef int x, y, z, x_offset, y_offset, z_offset
-        cdef Float3 volume_point, subvolume_voxel_size_microns, subvolume_voxel_size_volume_voxel_size_ratio
-        cdef Int3 offset
-
-        subvolume_voxel_size_microns.x = shape_microns.x / shape_voxels.x
-        subvolume_voxel_size_microns.y = shape_microns.y / shape_voxels.y
-        subvolume_voxel_size_microns.z = shape_microns.z / shape_voxels.z
-
-        subvolume_voxel_size_volume_voxel_size_ratio.x = subvolume_voxel_size_microns.x / self._voxelsize_um
-        subvolume_voxel_size_volume_voxel_size_ratio.y = subvolume_voxel_size_microns.y / self._voxelsize_um
-        subvolume_voxel_size_volume_voxel_size_ratio.z = subvolume_voxel_size_microns.z / self._voxelsize_um
-        
-        for z in range(shape_voxels.z):
-            for y in range(shape_voxels.y):
-                for x in range(shape_voxels.x):
-                    # Convert from an index relative to an origin in
-                    # the corner to a position relative to the
-                    # subvolume center (which may not correspond
-                    # exactly to one of the subvolume voxel positions
-                    # if any of the side lengths are even).
-                    offset.x = <int>((-1 * (shape_voxels.x - 1) / 2.0 + x) + 0.5)
-                    offset.y = <int>((-1 * (shape_voxels.y - 1) / 2.0 + y) + 0.5)
-                    offset.z = <int>((-1 * (shape_voxels.z - 1) / 2.0 + z) + 0.5)
-
-                    # Calculate the corresponding position in the
-                    # volume.
-                    volume_point.x = center.x
-                    volume_point.y = center.y
-                    volume_point.z = center.z
-
-                    volume_point.x += offset.x * basis.x.x * subvolume_voxel_size_volume_voxel_size_ratio.x
-                    volume_point.y += offset.x * basis.x.y * subvolume_voxel_size_volume_voxel_size_ratio.x
-                    volume_point.z += offset.x * basis.x.z * subvolume_voxel_size_volume_voxel_size_ratio.x
-
-                    volume_point.x += offset.y * basis.y.x * subvolume_voxel_size_volume_voxel_size_ratio.y
-                    volume_point.y += offset.y * basis.y.y * subvolume_voxel_size_volume_voxel_size_ratio.y
-                    volume_point.z += offset.y * basis.y.z * subvolume_voxel_size_volume_voxel_size_ratio.y
-
-                    volume_point.x += offset.z * basis.z.x * subvolume_voxel_size_volume_voxel_size_ratio.z
-                    volume_point.y += offset.z * basis.z.y * subvolume_voxel_size_volume_voxel_size_ratio.z
-                    volume_point.z += offset.z * basis.z.z * subvolume_voxel_size_volume_voxel_size_ratio.z
-                    
-                    array[z, y, x] = self.intensity_at(
+        """
+        cdef int axis, i, j
+        cdef float lo, hi, step_lo, step_hi
+        cdef float position[3]
+        cdef int shape[3]
+        cdef int lengths[3]
+        cdef const float * terms[3]
+        position[:] = [center.x, center.y, center.z]
+        shape[:] = [self.shape_x, self.shape_y, self.shape_z]
+        lengths[:] = [shape_voxels.x, shape_voxels.y, shape_voxels.z]
+        terms[0] = terms_x
+        terms[1] = terms_y
+        terms[2] = terms_z
+        for i in range(3):
+            lo = position[i]
+            hi = position[i]
+            for axis in range(3):
+                step_lo = terms[axis][i]
+                step_hi = terms[axis][i]
+                for j in range(lengths[axis]):
+                    step_lo = min(step_lo, terms[axis][3 * j + i])
+                    step_hi = max(step_hi, terms[axis][3 * j + i])
+                lo += step_lo
+                hi += step_hi
+            if not (1 <= lo and hi <= shape[i] - 2):
+                return False
+        return True
+
+    cdef void _interpolated_z_slice(self, Float3 center, Int3 shape_voxels, const float * terms_x,
+                                    const float * terms_y, const float * terms_z, bint interior, ValueScale value_scale,
+                                    sample_t[:,:,:] array, int z) noexcept nogil:
+        cdef int x, y
+        cdef Float3 volume_point
+        cdef unsigned short value
+
+        for y in range(shape_voxels.y):
+            for x in range(shape_voxels.x):
+                # Calculate the corresponding position in the
+                # volume.
+                volume_point.x = center.x + terms_x[3 * x + 0]
+                volume_point.y = center.y + terms_x[3 * x + 1]
+                volume_point.z = center.z + terms_x[3 * x + 2]
+
+                volume_point.x += terms_y[3 * y + 0]
+                volume_point.y += terms_y[3 * y + 1]
+                volume_point.z += terms_y[3 * y + 2]
+
+                volume_point.x += terms_z[3 * z + 0]
+                volume_point.y += terms_z[3 * z + 1]
+                volume_point.z += terms_z[3 * z + 2]
+
+                value = self._interpolate(volume_point.x, volume_point.y, volume_point.z, not interior)
+                if sample_t is float:
+                    array[z, y, x] = (value * value_scale.scale - value_scale.mean) / value_scale.std
+                else:
+                    array[z, y, x] = value
+
+    cdef void nearest_neighbor_with_basis_vectors(self, Float3 center, LatticeView lattice, BasisVectors basis, float * terms, ValueScale value_scale,
+                                                  sample_t[:,:,:] array, int num_threads) noexcept nogil:
+        cdef int z
+        cdef bint interior
+        cdef float * terms_x = terms
+        cdef float * terms_y = terms_x + 3 * lattice.shape.x
+        cdef float * terms_z = terms_y + 3 * lattice.shape.y
+
+        axis_terms(terms_x, lattice.offsets_x, lattice.shape.x, basis.x, lattice.ratio.x)
+        axis_terms(terms_y, lattice.offsets_y, lattice.shape.y, basis.y, lattice.ratio.y)
+        axis_terms(terms_z, lattice.offsets_z, lattice.shape.z, basis.z, lattice.ratio.z)
+        interior = self._in_interior(center, lattice.shape, terms_x, terms_y, terms_z)
+
+        # Each thread samples whole z slices of the subvolume
+        for z in prange(lattice.shape.z, num_threads=num_threads, schedule='static'):
+            self._nearest_neighbor_z_slice(center, lattice.shape, terms_x, terms_y, terms_z, interior, value_scale, array, z)
+
+    cdef void _nearest_neighbor_z_slice(self, Float3 center, Int3 shape_voxels, const float * terms_x,
+                                        const float * terms_y, const float * terms_z, bint interior, ValueScale value_scale,
+                                        sample_t[:,:,:] array, int z) noexcept nogil:
+        cdef int x, y
+        cdef Float3 volume_point
+        cdef unsigned short value
+
+        for y in range(shape_voxels.y):
+            for x in range(shape_voxels.x):
+                # Calculate the corresponding position in the
+                # volume.
+                volume_point.x = center.x + terms_x[3 * x + 0]
+                volume_point.y = center.y + terms_x[3 * x + 1]
+                volume_point.z = center.z + terms_x[3 * x + 2]
+
+                volume_point.x += terms_y[3 * y + 0]
+                volume_point.y += terms_y[3 * y + 1]
+                volume_point.z += terms_y[3 * y + 2]
+
+                volume_point.x += terms_z[3 * z + 0]
+                volume_point.y += terms_z[3 * z + 1]
+                volume_point.z += terms_z[3 * z + 2]
+
+                if interior:
+                    value = self.voxel_at(
+                        <int>(volume_point.x + 0.5),
+                        <int>(volume_point.y + 0.5),
+                        <int>(volume_point.z + 0.5)
+                    )
+                else:
+                    value = self.intensity_at(
                         <int>(volume_point.x + 0.5),
                         <int>(volume_point.y + 0.5),
                         <int>(volume_point.z + 0.5)
                     )
+                if sample_t is float:
+                    array[z, y, x] = (value * value_scale.scale - value_scale.mean) / value_scale.std
+                else:
+                    array[z, y, x] = value
+
+    cdef tuple _sample_bounds(self, Float3 center, Int3 shape_voxels, Float3 shape_microns, BasisVectors basis):
+        """Return the (min, max) volume-space corners of all sample points of a subvolume.
+
+        Uses the same subvolume offsets as the sampling kernels, so the
+        result bounds exactly the positions they will look up.
+
+        """
+        cdef float ratio, step_first, step_last
+        cdef float lo[3]
+        cdef float hi[3]
+        cdef float components[3][3]
+        cdef int shape[3]
+        cdef float extent[3]
+        cdef int axis, i, first_offset, last_offset
+        shape[:] = [shape_voxels.x, shape_voxels.y, shape_voxels.z]
+        extent[:] = [shape_microns.x, shape_microns.y, shape_microns.z]
+        components[0][:] = [basis.x.x, basis.x.y, basis.x.z]
+        components[1][:] = [basis.y.x, basis.y.y, basis.y.z]
+        components[2][:] = [basis.z.x, basis.z.y, basis.z.z]
+        lo[:] = [center.x, center.y, center.z]
+        hi[:] = [center.x, center.y, center.z]
+        for axis in range(3):
+            ratio = extent[axis] / shape[axis] / self._voxelsize_um
+            # First and last offsets along this subvolume axis, as computed in the kernels
+            first_offset = <int>((-1 * (shape[axis] - 1) / 2.0) + 0.5)
+            last_offset = <int>(((shape[axis] - 1) / 2.0) + 0.5)
+            for i in range(3):
+                step_first = first_offset * components[axis][i] * ratio
+                step_last = last_offset * components[axis][i] * ratio
+                lo[i] += min(step_first, step_last)
+                hi[i] += max(step_first, step_last)
+        return (lo[0], lo[1], lo[2]), (hi[0], hi[1], hi[2])
 
     def get_subvolume(self, center, shape_voxels, shape_microns, normal,
                       move_along_normal, jitter_max,
-                      augment_subvolume, method, normalize=False, square_corners=None, window_min_max=None):
+                      augment_subvolume, method, normalize=False, square_corners=None, window_min_max=None,
+                      value_range=None, device=None):
         """Get a subvolume from a center point and normal vector.
 
         At the time of writing, this function very closely resembles
@@ -424,25 +1210,90 @@ cdef class Volume:
             jitter_max: Jitter the center point a random amount up to
                 this value in either direction along the normal vector.
             method: String to indicate how to get the volume data.
+            value_range: Optional (low, high) to map the values onto, as
+                for get_subvolumes().
+            device: Torch device to run the 'grid_sample' method on.
+
+        Returns:
+            A np.uint16 array of the requested shape, or np.float32
+            with value_range.
+
+        """
+        normals = None if normal is None else [normal]
+        subvolumes = self.get_subvolumes(
+            [center], normals, shape_voxels, shape_microns, move_along_normal, jitter_max, method,
+            value_range=value_range, device=device,
+        )
+
+        # Singleton dimension for number of channels: [C(1), D, H, W]
+        return subvolumes[0]
+
+    cpdef get_subvolumes(self, centers, normals, shape_voxels, shape_microns=None,
+                         move_along_normal=None, jitter_max=None, method=None, out=None, value_range=None,
+                         device=None):
+        """Get a batch of subvolumes from center points and normal vectors.
+
+        Equivalent to calling get_subvolume() once per center point, but
+        the per-sample work is done in C and the subvolumes are written
+        directly into one buffer.
+
+        Args:
+            centers: (N, 3) array of the starting center points.
+            normals: (N, 3) array of the normal vectors at the center
+                points, or None. Zero normals are replaced by (0, 0, 1).
+            shape_voxels: The desired shape of each subvolume in voxels.
+            shape_microns: The desired spatial extent of each subvolume in microns.
+            move_along_normal: Scalar of how many units to translate
+                the center points along their normal vectors.
+            jitter_max: Jitter each center point a random amount up to
+                this value in either direction along its normal vector.
+            method: String to indicate how to get the volume data.
+            out: Optional array of shape (N, 1, D, H, W) and dtype
+                np.uint16 or np.float32 to write the subvolumes into.
+            value_range: Optional (low, high) to linearly map the uint16
+                values onto, written as np.float32. (0, 1) matches
+                inkid.util.uint16_to_float32_normalized_0_1() and (-1, 1)
+                that followed by Normalize((0.5,), (0.5,)).
+            device: Torch device to run the 'grid_sample' method on.
 
         Returns:
-            A np.uint16 array of the requested shape.
+            out, or a new array of shape (N, 1, D, H, W), np.uint16 or
+            np.float32 if value_range is given.
 
         """
-        assert len(center) == 3
+        cdef Py_ssize_t i, num
+        cdef Float3 s_m
+        cdef Int3 s_v
+        cdef Float3 * c
+        cdef BasisVectors * bases
+        cdef bint interpolated
+        cdef ValueScale value_scale = value_scale_for_range(value_range)
+        cdef SamplingLattice lattice
+        cdef int num_threads = get_sampling_threads()
+        cdef float[:, ::1] terms
+        cdef int[:, ::1] indices
+        cdef uint16[:, :, :, :, :] out_uint16
+        cdef float[:, :, :, :, :] out_float32
+
         assert len(shape_voxels) == 3
+        centers = np.asarray(centers, dtype=np.float64).reshape(-1, 3)
+        num = centers.shape[0]
 
         # If shape_microns not specified, fall back to the old method
         # (spatial extent based only on number of voxels and not voxel size)
         if shape_microns is None:
             shape_microns = list(np.array(shape_voxels) * self._voxelsize_um)
-
         assert len(shape_microns) == 3
 
-        if normal is None or not np.any(normal):
-            normal = np.array([0, 0, 1])
-        else:
-            normal = normalize_fl3(normal)
+        if normals is None:
+            normals = np.zeros((num, 3))
+        normals = np.array(normals, dtype=np.float64).reshape(-1, 3)
+        assert normals.shape[0] == num
+        lengths = np.sum(normals ** 2, axis=1) ** (1. / 2)
+        missing = lengths == 0
+        normals[missing] = (0, 0, 1)
+        lengths[missing] = 1
+        normals /= lengths[:, np.newaxis]
 
         if move_along_normal is None:
             move_along_normal = 0
@@ -450,20 +1301,26 @@ cdef class Volume:
         if jitter_max is None:
             jitter_max = 0
 
-        center = np.array(center)
-        center += (move_along_normal + random.randint(-jitter_max, jitter_max)) * normal
+        # One draw per sample, as for separate get_subvolume() calls
+        shifts = np.array(
+            [move_along_normal + random.randint(-jitter_max, jitter_max) for _ in range(num)],
+            dtype=np.float64,
+        )
+        centers = centers + shifts[:, np.newaxis] * normals
 
-        cdef BasisVectors basis
-        cdef Float3 n, c, s_m
-        cdef Int3 s_v
-
-        n.x = normal[0]
-        n.y = normal[1]
-        n.z = normal[2]
-
-        c.x = center[0]
-        c.y = center[1]
-        c.z = center[2]
+        if method is None:
+            method = 'nearest_neighbor'
+        assert method in ['interpolated', 'nearest_neighbor', 'grid_sample']
+        interpolated = method == 'interpolated'
+
+        shape = (num, 1) + tuple(shape_voxels)
+        if out is None:
+            out = np.empty(shape, dtype=np.uint16 if value_range is None else np.float32)
+        assert out.shape == shape
+        assert out.dtype in (np.uint16, np.float32)
+        assert value_range is None or out.dtype == np.float32
+        if num == 0:
+            return out
 
         s_v.z = shape_voxels[0]
         s_v.y = shape_voxels[1]
@@ -473,20 +1330,227 @@ cdef class Volume:
         s_m.y = shape_microns[1]
         s_m.x = shape_microns[2]
 
-        subvolume = np.zeros(shape_voxels, dtype=np.uint16)
-
-        basis = get_component_vectors_from_normal(n)
-        if method is None:
-            method = 'nearest_neighbor'
-        assert method in ['interpolated', 'nearest_neighbor']
-        if method == 'interpolated':
-            self.interpolated_with_basis_vectors(c, s_v, s_m, basis, subvolume)
-        elif method == 'nearest_neighbor':
-            self.nearest_neighbor_with_basis_vectors(c, s_v, s_m, basis, subvolume)
+        lattice = get_sampling_lattice(s_v, s_m, self._voxelsize_um)
+        # Scratch space for the axis terms of each subvolume
+        terms = np.empty((num, lattice.num_terms()), dtype=np.float32)
+        # And for the volume indices and offsets of axis-aligned subvolumes
+        indices = np.empty((num, lattice.num_terms() // 3 * 2), dtype=np.intc)
+
+        c = <Float3 *> PyMem_Malloc(num * sizeof(Float3))
+        bases = <BasisVectors *> PyMem_Malloc(num * sizeof(BasisVectors))
+        try:
+            if c == NULL or bases == NULL:
+                raise MemoryError()
+            for i in range(num):
+                c[i].x = centers[i, 0]
+                c[i].y = centers[i, 1]
+                c[i].z = centers[i, 2]
+                bases[i] = get_component_vectors_from_normal(
+                    Float3(normals[i, 0], normals[i, 1], normals[i, 2])
+                )
+
+            if self._storage == STORAGE_LAZY:
+                needed = set()
+                for i in range(num):
+                    lo, hi = self._sample_bounds(c[i], s_v, s_m, bases[i])
+                    # Nearest neighbor rounds up and interpolation reads the next voxel
+                    needed.update(range(<int>math.floor(lo[2]), <int>math.floor(hi[2]) + 2))
+                self._ensure_slices(needed)
+
+            if method == 'grid_sample':
+                bases_np = np.empty((num, 3, 3), dtype=np.float32)
+                for i in range(num):
+                    bases_np[i] = [
+                        [bases[i].x.x, bases[i].x.y, bases[i].x.z],
+                        [bases[i].y.x, bases[i].y.y, bases[i].y.z],
+                        [bases[i].z.x, bases[i].z.y, bases[i].z.z],
+                    ]
+                self._grid_sample(centers, bases_np, lattice, value_range, device, out)
+            elif out.dtype == np.uint16:
+                out_uint16 = out
+                self._sample_batch(c, bases, num, lattice.view, terms, indices, interpolated, value_scale, out_uint16,
+                                   num_threads)
+            else:
+                out_float32 = out
+                self._sample_batch(c, bases, num, lattice.view, terms, indices, interpolated, value_scale, out_float32,
+                                   num_threads)
+        finally:
+            PyMem_Free(c)
+            PyMem_Free(bases)
+
+        return out
+
+    def _grid_sample(self, centers, bases, SamplingLattice lattice, value_range, device, out):
+        """Trilinearly interpolate a batch of subvolumes with torch grid_sample.
+
+        The sample positions of the whole batch are computed at once,
+        the brick of the volume around each subvolume is read into one
+        (N, 1, D, H, W) tensor of bricks of a common size, and all of
+        them are interpolated by a single grid_sample call on the given
+        device. Values are truncated to integers as in the
+        'interpolated' method, and then scaled to value_range.
 
-        assert subvolume.shape == tuple(shape_voxels)
+        """
+        cdef ValueScale value_scale
+        num = centers.shape[0]
+        centers = centers.astype(np.float32)
+        ratio = (lattice.view.ratio.x, lattice.view.ratio.y, lattice.view.ratio.z)
+        offsets = (np.asarray(lattice.offsets_x), np.asarray(lattice.offsets_y), np.asarray(lattice.offsets_z))
+        # Steps from the center along each subvolume axis: [N, n_axis, (x, y, z)]
+        steps = [offsets[axis][np.newaxis, :, np.newaxis] * bases[:, np.newaxis, axis] * ratio[axis]
+                 for axis in range(3)]
+        # Volume space (x, y, z) position of every subvolume voxel: [N, D, H, W, 3]
+        positions = (
+            centers[:, np.newaxis, np.newaxis, np.newaxis]
+            + steps[0][:, np.newaxis, np.newaxis, :]
+            + steps[1][:, np.newaxis, :, np.newaxis]
+            + steps[2][:, :, np.newaxis, np.newaxis]
+        )
+        flat_positions = positions.reshape(num, -1, 3)
+        lo = np.floor(flat_positions.min(axis=1)).astype(np.int64)
+        # Interpolation also reads the next voxel
+        size = (np.floor(flat_positions.max(axis=1)).astype(np.int64) + 2 - lo).max(axis=0)
+        bricks = np.stack([
+            self._read_region(z, z + size[2], y, y + size[1], x, x + size[0])
+            for x, y, z in lo
+        ])
+        # With align_corners, -1 and 1 are the centers of the first and last voxels of each brick
+        grid = 2 * (positions - lo[:, np.newaxis, np.newaxis, np.newaxis]) / (size - 1).astype(np.float32) - 1
+        sampled = torch.nn.functional.grid_sample(
+            torch.from_numpy(bricks.astype(np.float32)).unsqueeze(1).to(device),
+            torch.from_numpy(grid.astype(np.float32)).to(device),
+            mode='bilinear',
+            padding_mode='zeros',
+            align_corners=True,
+        ).trunc()
+        if value_range is not None:
+            value_scale = value_scale_for_range(value_range)
+            sampled = (sampled * value_scale.scale - value_scale.mean) / value_scale.std
+        out[...] = sampled.cpu().numpy()
+
+    cdef bint _axis_aligned_subvolume(self, Float3 center, LatticeView lattice, BasisVectors basis, bint interpolated,
+                                      int * indices, ValueScale value_scale, sample_t[:,:,:] array) noexcept nogil:
+        """Copy a subvolume whose axes lie along the volume axes directly from the volume.
+
+        This is the case for every subvolume of a flattened surface
+        volume, where the normals are all (0, 0, 1). The volume index
+        along each subvolume axis is then computed once per position,
+        with the same float operations and rounding as the kernels, and
+        each voxel is a plain lookup. Positions outside the volume are
+        zero.
+
+        Basis vectors within AXIS_TOLERANCE of a signed unit axis are
+        treated as that axis. Returns False without writing anything
+        if the basis is not axis-aligned, or when interpolating if any
+        sample point falls between voxels.
 
-        # Add singleton dimension for number of channels: [C(1), D, H, W]
-        subvolume = np.expand_dims(subvolume, 0)
+        """
+        cdef int a, v, n, x, y, z
+        cdef int axes[3]  # Volume axis of each subvolume axis
+        cdef float signs[3]
+        cdef float components[3][3]
+        cdef float position
+        cdef float center_components[3]
+        cdef float ratios[3]
+        cdef const float * offsets[3]
+        cdef int lengths[3]
+        cdef int shape[3]
+        cdef Py_ssize_t strides[3]
+        cdef int * idx[3]  # Volume index of each position along each subvolume axis
+        cdef int * linear[3]  # The same as an offset into _data_ptr
+        cdef bint inside = True
+        cdef unsigned short value
+
+        components[0][:] = [basis.x.x, basis.x.y, basis.x.z]
+        components[1][:] = [basis.y.x, basis.y.y, basis.y.z]
+        components[2][:] = [basis.z.x, basis.z.y, basis.z.z]
+        for a in range(3):
+            axes[a] = -1
+            for v in range(3):
+                if math.fabs(math.fabs(components[a][v]) - 1) <= AXIS_TOLERANCE:
+                    axes[a] = v
+                    signs[a] = 1 if components[a][v] > 0 else -1
+                elif math.fabs(components[a][v]) > AXIS_TOLERANCE:
+                    return False
+            if axes[a] == -1:
+                return False
+        if axes[0] == axes[1] or axes[1] == axes[2] or axes[0] == axes[2]:
+            return False
+
+        center_components[:] = [center.x, center.y, center.z]
+        ratios[:] = [lattice.ratio.x, lattice.ratio.y, lattice.ratio.z]
+        offsets[:] = [lattice.offsets_x, lattice.offsets_y, lattice.offsets_z]
+        lengths[:] = [lattice.shape.x, lattice.shape.y, lattice.shape.z]
+        shape[:] = [self.shape_x, self.shape_y, self.shape_z]
+        strides[:] = [1, self.shape_x, <Py_ssize_t> self.shape_x * self.shape_y]
+        idx[0] = indices
+        idx[1] = idx[0] + lengths[0]
+        idx[2] = idx[1] + lengths[1]
+        linear[0] = idx[2] + lengths[2]
+        linear[1] = linear[0] + lengths[0]
+        linear[2] = linear[1] + lengths[1]
+
+        for a in range(3):
+            for n in range(lengths[a]):
+                # The other two axis terms are zero, and adding them does not change the sum
+                position = center_components[axes[a]] + offsets[a][n] * signs[a] * ratios[a]
+                if interpolated:
+                    if position != math.floor(position):
+                        return False
+                    idx[a][n] = <int> position
+                else:
+                    idx[a][n] = <int>(position + 0.5)
+                if not 0 <= idx[a][n] < shape[axes[a]]:
+                    inside = False
+                linear[a][n] = idx[a][n] * strides[axes[a]]
+
+        cdef int coords[3]
+        cdef bint direct = inside and self._data_ptr != NULL
+        for z in range(lengths[2]):
+            coords[axes[2]] = idx[2][z]
+            for y in range(lengths[1]):
+                coords[axes[1]] = idx[1][y]
+                for x in range(lengths[0]):
+                    if direct:
+                        value = self._data_ptr[linear[2][z] + linear[1][y] + linear[0][x]]
+                    else:
+                        coords[axes[0]] = idx[0][x]
+                        value = self.intensity_at(coords[0], coords[1], coords[2])
+                    if sample_t is float:
+                        array[z, y, x] = (value * value_scale.scale - value_scale.mean) / value_scale.std
+                    else:
+                        array[z, y, x] = value
+        return True
+
+    cdef void _sample_batch(self, const Float3 * c, const BasisVectors * bases, Py_ssize_t num,
+                            LatticeView lattice, float[:, ::1] terms, int[:, ::1] indices, bint interpolated,
+                            ValueScale value_scale, sample_t[:, :, :, :, :] out, int num_threads) noexcept nogil:
+        """Sample each subvolume of a batch, using num_threads threads.
+
+        Subvolumes with axis-aligned bases are copied straight from the
+        volume where possible, the rest are sampled by the kernels.
+
+        A single subvolume is split between the threads along z. A batch
+        is split by sample, and each sample is then done by one thread.
 
-        return subvolume
+        """
+        cdef Py_ssize_t i
+        if num == 1:
+            if self._axis_aligned_subvolume(c[0], lattice, bases[0], interpolated, &indices[0, 0], value_scale, out[0, 0]):
+                pass
+            elif interpolated:
+                self.interpolated_with_basis_vectors(
+                    c[0], lattice, bases[0], &terms[0, 0], value_scale, out[0, 0], num_threads
+                )
+            else:
+                self.nearest_neighbor_with_basis_vectors(
+                    c[0], lattice, bases[0], &terms[0, 0], value_scale, out[0, 0], num_threads
+                )
+            return
+        for i in prange(num, num_threads=num_threads, schedule='dynamic'):
+            if self._axis_aligned_subvolume(c[i], lattice, bases[i], interpolated, &indices[i, 0], value_scale, out[i, 0]):
+                pass
+            elif interpolated:
+                self.interpolated_with_basis_vectors(c[i], lattice, bases[i], &terms[i, 0], value_scale, out[i, 0], 1)
+            else:
+                self.nearest_neighbor_with_basis_vectors(c[i], lattice, bases[i], &terms[i, 0], value_scale, out[i, 0], 1)
@@ -209,6 +209,34 @@ def main(argv=None):
     )
     inkid.data.add_subvolume_arguments(parser)
 
+    # Shard export options
+    parser.add_argument(
+        "--shards",
+        action="store_true",
+        help="write every subvolume of the input set to shards for "
+        "inkid.data.ShardDataset instead of writing --number image stacks",
+    )
+    parser.add_argument(
+        "--shard-size", metavar="n", type=int, default=1024, help="subvolumes per shard"
+    )
+    parser.add_argument(
+        "--label-types",
+        nargs="*",
+        choices=["ink_classes", "rgb_values", "volcart_texture"],
+        default=[],
+        help="labels to write to the shards",
+    )
+    parser.add_argument(
+        "--label-shape",
+        metavar="n",
+        nargs=2,
+        type=int,
+        default=[1, 1],
+        help="shape of the labels written to the shards",
+    )
+    parser.add_argument("--batch-size", metavar="n", type=int, default=64)
+    parser.add_argument("--dataloaders-num-workers", metavar="n", type=int, default=0)
+
     # Image rendering option
     parser.add_argument(
         "--visualize", action="store_true", help="generate and save 2D/3D renderings"
@@ -243,13 +271,36 @@ def main(argv=None):
     for region in input_ds.regions():
         region.feature_args = subvolume_args
         region.sampler = sampler
+        region.label_types = args.label_types
+        region.label_args = {
+            label_type: dict(shape=tuple(args.label_shape))
+            for label_type in args.label_types
+        }
 
     np.random.seed(args.random_seed)
     torch.manual_seed(args.random_seed)
 
+    if args.shards:
+        # Subvolumes are written as sampled, flips are left to the training loop
+        shards_dl = torch.utils.data.DataLoader(
+            input_ds,
+            batch_size=args.batch_size,
+            shuffle=False,
+            num_workers=args.dataloaders_num_workers,
+            collate_fn=inkid.data.collate_features,
+        )
+        with inkid.data.ShardWriter(
+            args.output, args.shard_size, source_json=input_ds.source_json()
+        ) as writer:
+            for batch in shards_dl:
+                writer.write(batch)
+        return
+
     input_dl = None
     if len(input_ds) > 0:
-        input_dl = torch.utils.data.DataLoader(input_ds, shuffle=True)
+        input_dl = torch.utils.data.DataLoader(
+            input_ds, shuffle=True, collate_fn=inkid.data.collate_features
+        )
 
     square_side_length = math.ceil(math.sqrt(args.number))
     pad = 20
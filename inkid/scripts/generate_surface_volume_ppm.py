@@ -2,7 +2,6 @@ import argparse
 from pathlib import Path
 
 import imageio.v3 as iio
-from tqdm import tqdm
 import numpy as np
 
 from inkid.data import PPM
@@ -26,9 +25,9 @@ def main():
     dim = 6
     data = np.zeros((height, width, dim), dtype=float)
     z = (num_slices - 1) / 2.0
-    for y in tqdm(range(height)):
-        for x in range(width):
-            data[y, x, :] = [x, y, z, 0.0, 0.0, 1.0]
+    data[:, :, 1], data[:, :, 0] = np.indices((height, width))
+    data[:, :, 2] = z
+    data[:, :, 5] = 1.0
 
     print("Writing output PPM...")
     PPM.write_ppm_from_data(
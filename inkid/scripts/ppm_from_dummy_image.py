@@ -1,10 +1,10 @@
 import argparse
 from pathlib import Path
-import struct
 
 import numpy as np
 from PIL import Image
-from tqdm import tqdm
+
+from inkid.data import PPM
 
 
 def main():
@@ -48,19 +48,8 @@ def main():
     ink_label_img.save(filename + "_ink-mask.png")
     rgb_label_img.save(filename + "_rgb-mask.png")
 
-    with open(args.output_ppm, "wb") as f:
-        print("Writing PPM to file {}...".format(args.output_ppm))
-        f.write("width: {}\n".format(w).encode("utf-8"))
-        f.write("height: {}\n".format(h).encode("utf-8"))
-        f.write("dim: {}\n".format(dim).encode("utf-8"))
-        f.write("ordered: {}\n".format("true").encode("utf-8"))
-        f.write("type: double\n".encode("utf-8"))
-        f.write("version: {}\n".format(version).encode("utf-8"))
-        f.write("<>\n".encode("utf-8"))
-        for y in tqdm(range(h)):
-            for x in range(w):
-                for idx in range(dim):
-                    f.write(struct.pack("d", ppm_data[y, x, idx]))
+    print("Writing PPM to file {}...".format(args.output_ppm))
+    PPM.write_ppm_from_data(args.output_ppm, ppm_data, w, h, dim, version=version)
 
 
 if __name__ == "__main__":
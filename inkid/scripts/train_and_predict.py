@@ -54,6 +54,13 @@ def main(argv=None):
         help="training dataset(s)",
         default=[],
     )
+    parser.add_argument(
+        "--training-shards",
+        metavar="path",
+        default=None,
+        help="train from subvolumes exported by generate_subvolumes.py --shards "
+        "instead of --training-set",
+    )
     parser.add_argument(
         "--validation-set",
         metavar="path",
@@ -118,6 +125,9 @@ def main(argv=None):
 
     # How samples are generated
     inkid.data.add_subvolume_arguments(parser)
+    inkid.data.add_volume_arguments(parser)
+    inkid.data.add_ppm_arguments(parser)
+    inkid.data.add_cache_arguments(parser)
 
     # CycleGAN args
     inkid.model.cyclegan_networks.add_cyclegan_args(parser)
@@ -229,12 +239,22 @@ def main(argv=None):
     # Make sure some sort of input is provided, else there is nothing to do
     if (
         len(args.training_set) == 0
+        and args.training_shards is None
         and len(args.prediction_set) == 0
         and len(args.validation_set) == 0
     ):
         raise ValueError(
-            "At least one of --training-set, --prediction-set, or --validation-set "
-            "must be specified."
+            "At least one of --training-set, --training-shards, --prediction-set, or "
+            "--validation-set must be specified."
+        )
+    if args.training_shards is not None and (
+        len(args.training_set) > 0
+        or args.cross_validate_on is not None
+        or args.training_max_samples is not None
+    ):
+        raise ValueError(
+            "--training-shards cannot be combined with --training-set, "
+            "--cross-validate-on, or --training-max-samples."
         )
 
     # If this is part of a cross-validation job, append n (--cross-validate-on) to the output path
@@ -338,6 +358,18 @@ def main(argv=None):
         if slurm_var in os.environ:
             metadata[slurm_var] = os.getenv(slurm_var)
 
+    # Specify the compute device for PyTorch purposes
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    logging.info(f"PyTorch device: {device}")
+    if device.type == "cuda":
+        logging.info(f"    {torch.cuda.get_device_name(0)}")
+        logging.info(
+            f"    Memory Allocated: {round(torch.cuda.memory_allocated(0) / 1024 ** 3, 1)} GB"
+        )
+        logging.info(
+            f"    Memory Cached:    {round(torch.cuda.memory_reserved(0) / 1024 ** 3, 1)} GB"
+        )
+
     # Define the feature inputs to the network
     subvolume_args = dict(
         method=args.subvolume_method,
@@ -346,6 +378,13 @@ def main(argv=None):
         move_along_normal=args.move_along_normal,
         normalize=args.normalize_subvolumes,
     )
+    # grid_sample runs on the same device as the model
+    dataloaders_context = None
+    if args.subvolume_method == "grid_sample":
+        subvolume_args["device"] = device
+        if device.type == "cuda" and args.dataloaders_num_workers > 0:
+            # CUDA cannot be used in forked worker processes
+            dataloaders_context = "spawn"
     train_feature_args = subvolume_args.copy()
     train_feature_args.update(
         augment_subvolume=args.augmentation,
@@ -477,15 +516,48 @@ def main(argv=None):
         args.validation_set.append(nth_source)
         args.prediction_set.append(nth_source)
 
-    train_ds = inkid.data.Dataset(args.training_set)
-    val_ds = inkid.data.Dataset(args.validation_set)
-    pred_ds = inkid.data.Dataset(args.prediction_set)
+    volume_args = dict(
+        storage=args.volume_storage,
+        slice_cache_bytes=int(args.volume_slice_cache_gb * 1024**3),
+        num_workers=args.volume_load_workers,
+    )
+    if args.volume_sampling_threads is not None:
+        inkid.data.set_sampling_threads(args.volume_sampling_threads)
+    if args.data_cache_dir is not None:
+        inkid.data.set_cache_dir(args.data_cache_dir or None)
+    # Spawned workers do not inherit the settings above
+    dataloaders_worker_init_fn = inkid.data.worker_init_fn(
+        inkid.data.get_cache_dir(), args.volume_sampling_threads
+    )
+    if dataloaders_context == "spawn" and args.volume_storage == "memory":
+        logging.warning(
+            "Spawned DataLoader workers each load the volumes into memory again, "
+            "use --volume-storage shared (or chunked) to share them"
+        )
+    ppm_args = inkid.data.ppm_args_from_storage(args.ppm_storage)
+    train_ds = inkid.data.Dataset(
+        args.training_set, volume_args=volume_args, ppm_args=ppm_args
+    )
+    val_ds = inkid.data.Dataset(
+        args.validation_set, volume_args=volume_args, ppm_args=ppm_args
+    )
+    pred_ds = inkid.data.Dataset(
+        args.prediction_set, volume_args=volume_args, ppm_args=ppm_args
+    )
 
     # Perform cross validation after flattening the sources into their expanded lists
     if args.cross_validate_on is not None and not args.cross_validate_at_top_level:
         nth_region_path = train_ds.pop_nth_region(args.cross_validate_on).path
-        val_ds.sources.append(inkid.data.DataSource.from_path(nth_region_path))
-        pred_ds.sources.append(inkid.data.DataSource.from_path(nth_region_path))
+        val_ds.sources.append(
+            inkid.data.DataSource.from_path(
+                nth_region_path, volume_args=volume_args, ppm_args=ppm_args
+            )
+        )
+        pred_ds.sources.append(
+            inkid.data.DataSource.from_path(
+                nth_region_path, volume_args=volume_args, ppm_args=ppm_args
+            )
+        )
 
     for region in train_ds.regions():
         region.sampler = copy.deepcopy(train_sampler)
@@ -496,16 +568,24 @@ def main(argv=None):
         volume.feature_args = train_feature_args
     for region in val_ds.regions():
         region.feature_args = val_feature_args
+        region.cache_features = args.cache_features
         region.label_types = model.labels
         region.label_args = label_args
     for region in pred_ds.regions():
         region.sampler = copy.deepcopy(pred_sampler)
         region.feature_args = pred_feature_args
+        region.cache_features = args.cache_features
 
     if args.ambiguous_ink_labels_filter_radius is not None:
         for region in train_ds.regions():
             region.write_ambiguous_labels_diagnostic_mask(diagnostic_images_dir)
 
+    # Stream the training subvolumes from shards, without loading the training volumes
+    if args.training_shards is not None:
+        train_ds = inkid.data.ShardDataset(
+            args.training_shards, shuffle=True, label_types=model.labels
+        )
+
     metadata["Data"] = {
         "training": train_ds.source_json(),
         "validation": val_ds.source_json(),
@@ -537,7 +617,8 @@ def main(argv=None):
         logging.info("done")
     else:
         train_sampler = None
-        shuffle_train_dl = True
+        # ShardDataset shuffles itself
+        shuffle_train_dl = args.training_shards is None
     # Only take n samples for validation, not the entire region
     if args.validation_max_samples is not None:
         logging.info(f"Trimming validation dataset to {args.validation_max_samples}...")
@@ -557,6 +638,9 @@ def main(argv=None):
             batch_size=args.batch_size,
             shuffle=shuffle_train_dl,
             num_workers=args.dataloaders_num_workers,
+            multiprocessing_context=dataloaders_context,
+            worker_init_fn=dataloaders_worker_init_fn,
+            collate_fn=inkid.data.collate_features,
             sampler=train_sampler,
         )
     if len(val_ds) > 0:
@@ -565,6 +649,9 @@ def main(argv=None):
             batch_size=args.batch_size * 2,
             shuffle=shuffle_val_dl,
             num_workers=args.dataloaders_num_workers,
+            multiprocessing_context=dataloaders_context,
+            worker_init_fn=dataloaders_worker_init_fn,
+            collate_fn=inkid.data.collate_features,
             sampler=val_sampler,
         )
     if len(pred_ds) > 0:
@@ -573,21 +660,12 @@ def main(argv=None):
             batch_size=args.batch_size * 2,
             shuffle=True,  # Not really necessary for actual prediction but helps sample visualization
             num_workers=args.dataloaders_num_workers,
+            multiprocessing_context=dataloaders_context,
+            worker_init_fn=dataloaders_worker_init_fn,
+            collate_fn=inkid.data.collate_features,
         )
     logging.info("done")
 
-    # Specify the compute device for PyTorch purposes
-    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-    logging.info(f"PyTorch device: {device}")
-    if device.type == "cuda":
-        logging.info(f"    {torch.cuda.get_device_name(0)}")
-        logging.info(
-            f"    Memory Allocated: {round(torch.cuda.memory_allocated(0) / 1024 ** 3, 1)} GB"
-        )
-        logging.info(
-            f"    Memory Cached:    {round(torch.cuda.memory_reserved(0) / 1024 ** 3, 1)} GB"
-        )
-
     # Load pretrained weights if specified, and freeze them
     if args.load_weights_from is not None:
         logging.info("Loading pretrained weights...")
@@ -673,6 +751,7 @@ def main(argv=None):
             train_dl,
             diagnostic_images_dir,
             "sample_subvolume_batch_training.png",
+            include_vol_slices=args.training_shards is None,
             domain_transfer_model=training_domain_transfer_model,
         )
     if pred_dl is not None:
@@ -718,6 +797,8 @@ def main(argv=None):
             for batch_num, batch in enumerate(train_dl):
                 xb = batch["feature"]
                 xb = xb.to(device)
+                if args.augmentation:
+                    xb = inkid.data.augment_features(xb)
                 if args.training_domain_transfer_weights is not None:
                     xb = torch.squeeze(xb, 1)
                     xb = training_domain_transfer_model(xb)
@@ -862,16 +943,22 @@ def main(argv=None):
             all_sources = list(
                 set(args.training_set + args.validation_set + args.prediction_set)
             )
-            final_pred_ds = inkid.data.Dataset(all_sources)
+            final_pred_ds = inkid.data.Dataset(
+                all_sources, volume_args=volume_args, ppm_args=ppm_args
+            )
             for region in final_pred_ds.regions():
                 region.sampler = copy.deepcopy(pred_sampler)
                 region.feature_args = pred_feature_args
+                region.cache_features = args.cache_features
             if len(final_pred_ds) > 0:
                 final_pred_dl = DataLoader(
                     final_pred_ds,
                     batch_size=args.batch_size * 2,
                     shuffle=False,
                     num_workers=args.dataloaders_num_workers,
+                    multiprocessing_context=dataloaders_context,
+                    worker_init_fn=dataloaders_worker_init_fn,
+                    collate_fn=inkid.data.collate_features,
                 )
                 inkid.util.generate_prediction_images(
                     final_pred_dl,
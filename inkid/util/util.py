@@ -1,6 +1,6 @@
 """Miscellaneous operations used in ink-id."""
 
-from copy import deepcopy
+import io
 import itertools
 from io import BytesIO
 import json
@@ -84,11 +84,8 @@ def generate_prediction_images(
     model.eval()  # Turn off training mode for batch norm and dropout purposes
     with torch.no_grad():
         for batch in tqdm(dataloader):
-            batch_copy = deepcopy(
-                batch
-            )  # https://github.com/pytorch/pytorch/issues/973#issuecomment-459398189
-            batch_metadata = batch_copy["feature_metadata"]
-            batch_features = batch_copy["feature"]
+            batch_metadata = batch["feature_metadata"]
+            batch_features = batch["feature"]
             # Only do those label types actually included in model output
             for label_type in {
                 "ink_classes",
@@ -123,9 +120,7 @@ def generate_prediction_images(
                     pred = preds[label_type]
                     if label_type == "ink_classes":
                         pred = F.softmax(pred, dim=1)
-                    pred = deepcopy(
-                        pred.cpu()
-                    )  # https://github.com/pytorch/pytorch/issues/973#issuecomment-459398189
+                    pred = pred.cpu()
                     # Example pred.shape = [64, 2, 48, 48] (BxCxHxW)
                     # Undo flip and rotation
                     if flip:
@@ -147,13 +142,14 @@ def generate_prediction_images(
                     batch_preds = np.append(batch_preds, pred, axis=0)
                 # Average over batch of predictions after augmentation
                 batch_pred = batch_preds.mean(0)
-                # Separate these three lists
-                source_paths, xs, ys, _, _, _, _, _, _ = batch_metadata
-                for prediction, source_path, x, y in zip(
-                    batch_pred, source_paths, xs, ys
-                ):
-                    dataloader.dataset.source(source_path).store_prediction(
-                        int(x), int(y), prediction, label_type
+                source_indices = batch_metadata.source_index.numpy()
+                xs = batch_metadata.surface_x.numpy().astype(int)
+                ys = batch_metadata.surface_y.numpy().astype(int)
+                # Store each source's predictions at once
+                for source_index in np.unique(source_indices):
+                    in_source = source_indices == source_index
+                    dataloader.dataset.sources[source_index].store_predictions(
+                        xs[in_source], ys[in_source], batch_pred[in_source], label_type
                     )
     for region in dataloader.dataset.regions():
         region.write_predictions(predictions_dir, suffix, step=global_step)
@@ -205,6 +201,92 @@ def get_raw_data_from_file_or_url(filename, return_relative_url=False):
         return BytesIO(data)
 
 
+class HTTPRangeReader(io.RawIOBase):
+    """Read-only, seekable file over HTTP, fetching only the byte ranges read.
+
+    Requires a server that answers Range requests with 206 Partial
+    Content. Wrap in io.BufferedReader for efficient small reads such as
+    readline().
+
+    """
+
+    def __init__(self, url, session=None):
+        super().__init__()
+        self.url = url
+        self._session = session or requests.Session()
+        self._position = 0
+        response = self._session.head(url, allow_redirects=True)
+        if response.status_code != 200:
+            raise ValueError(
+                f"Unable to fetch URL (code={response.status_code}): {url}"
+            )
+        if response.headers.get("Accept-Ranges") != "bytes":
+            raise ValueError(f"Server does not support range requests: {url}")
+        self.size = int(response.headers["Content-Length"])
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._position = offset
+        elif whence == io.SEEK_CUR:
+            self._position += offset
+        elif whence == io.SEEK_END:
+            self._position = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+        return self._position
+
+    def readinto(self, b):
+        b = memoryview(b).cast("B")
+        end = min(self._position + len(b), self.size)
+        if end <= self._position:
+            return 0
+        response = self._session.get(
+            self.url,
+            headers={"Range": f"bytes={self._position}-{end - 1}"},
+            stream=True,
+        )
+        if response.status_code != 206:
+            raise ValueError(
+                f"Range request failed (code={response.status_code}): {self.url}"
+            )
+        n = 0
+        for chunk in response.iter_content(chunk_size=2**20):
+            b[n : n + len(chunk)] = chunk
+            n += len(chunk)
+        self._position += n
+        return n
+
+
+def open_file_or_url(filename, buffer_size=2**20):
+    """Open a filename or URL as a seekable binary file object.
+
+    Local paths are opened directly. http and https URLs are read with
+    range requests, so reading part of a file only transfers that part.
+    If the server does not support range requests, the whole file is
+    fetched as a fallback.
+
+    """
+    url = urlsplit(filename)
+    if url.scheme in ("http", "https"):
+        try:
+            return io.BufferedReader(HTTPRangeReader(filename), buffer_size)
+        except ValueError:
+            return get_raw_data_from_file_or_url(filename)
+    elif url.scheme == "":
+        return open(filename, "rb", buffering=buffer_size)
+    else:
+        raise ValueError(f"Unsupported URL: {filename}")
+
+
 def normalize_path(path, relative_url):
     """Normalize path to be absolute and with URL where appropriate."""
     url = urlsplit(path)
@@ -415,16 +497,18 @@ def save_subvolume_batch_to_img(
 
     imgs = []
     for i, (subvolume, autoencoded, domain_transfer_subvolume) in enumerate(zip(subvolumes, autoencodeds, domain_transfer_subvolumes)):
-        dataloader.dataset.source(batch["feature_metadata"].path[i])
-        volume = dataloader.dataset.source(batch["feature_metadata"].path[i]).volume
+        volume = None
+        if include_vol_slices:
+            source_index = int(batch["feature_metadata"].source_index[i])
+            volume = dataloader.dataset.sources[source_index].volume
         imgs.append(
             subvolume_to_sample_img(
                 subvolume,
                 volume,
                 (
-                    batch["feature_metadata"].x[i],
-                    batch["feature_metadata"].y[i],
-                    batch["feature_metadata"].z[i],
+                    float(batch["feature_metadata"].x[i]),
+                    float(batch["feature_metadata"].y[i]),
+                    float(batch["feature_metadata"].z[i]),
                 ),
                 padding,
                 background_color,
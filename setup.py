@@ -1,7 +1,12 @@
+import sys
+
 from setuptools import Extension, setup
 from Cython.Build import cythonize
 import numpy as np
 
+# Sampling kernels are parallelized with OpenMP where the compiler supports it out of the box
+openmp_args = ["-fopenmp"] if sys.platform.startswith("linux") else []
+
 extensions = [
     Extension(
         "inkid.data.volume",
@@ -9,6 +14,8 @@ extensions = [
         include_dirs=[np.get_include()],
         # https://cython.readthedocs.io/en/latest/src/userguide/migrating_to_cy30.html?highlight=deprecated#numpy-c-api
         #define_macros=[("NPY_NO_DEPRECATED_API", "NPY_1_7_API_VERSION")],
+        extra_compile_args=openmp_args,
+        extra_link_args=openmp_args,
     ),
     Extension("inkid.data.mathutils", ["inkid/data/mathutils.pyx"]),
 ]